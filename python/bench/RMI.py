@@ -0,0 +1 @@
+../lib/RMI.py
\ No newline at end of file
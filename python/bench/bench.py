@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+# benchmarks for RMI: latency and throughput of calls over each transport and serializer
+#   ./runbench.sh                          # everything, one JSON object per result on stdout
+#   ./runbench.sh --quick -o new.json      # fewer iterations, written to a file
+#   ./runbench.sh --compare old.json       # also shows the change from an earlier run, on stderr
+#   ./runbench.sh --only null_call,payload --transports pipes,tcp
+#   ./runbench.sh --only connect --transports pipes,fork_server
+# each result has the benchmark, transport, serializer and payload size which identify it,
+# and latencies in seconds (mean, p50, p90, p99, min) with the operations or megabytes per second
+
+import os
+import sys
+import time
+import json
+import signal
+import asyncio
+import argparse
+import platform
+import concurrent.futures
+import RMI
+
+# functions and classes called by the benchmarks, which the forked servers have as well
+
+def null():
+    return None
+
+def echo(x):
+    return x
+
+def call_back(f):
+    return f()
+
+def total_real(items):
+    return sum(o.real for o in items)
+
+class Target:
+    def m(self):
+        return None
+
+# transports, by name: each returns a client, and closes the server along with the client
+
+def pipes(serialization_protocol):
+    return RMI.Client.ForkedPipes(serialization_protocol = serialization_protocol)
+
+def shared_memory(serialization_protocol):
+    return RMI.Client.ForkedSharedMemory(serialization_protocol = serialization_protocol, ring_size = 2**22)
+
+def tcp(serialization_protocol):
+    server = RMI.Server.Tcp(port = 0, serialization_protocol = serialization_protocol)
+    pid = os.fork()
+    if not pid:
+        server.run()
+        os._exit(0)
+    server.close()
+    c = RMI.Client.Tcp(port = server.port, serialization_protocol = serialization_protocol)
+    close = c.close
+    def close_both():
+        close()
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    c.close = close_both
+    return c
+
+# servers forked from a template which has imported what the benchmarks call
+fork_server = None
+
+def forked_from_template(serialization_protocol):
+    global fork_server
+    if fork_server == None:
+        fork_server = RMI.ForkServer(preload = ['unittest', 'doctest'], resolve = ['__main__.null', '__main__.echo'])
+    return RMI.Client.ForkedPipes(fork_server = fork_server, serialization_protocol = serialization_protocol)
+
+def threaded(serialization_protocol):
+    return RMI.ThreadedClient.ForkedPipes(serialization_protocol = serialization_protocol)
+
+def asyncio_pipes(serialization_protocol):
+    return RMI.AsyncClient.ForkedPipes(serialization_protocol = serialization_protocol)
+
+transports = {
+    'pipes': pipes,
+    'fork_server': forked_from_template,
+    'shared_memory': shared_memory,
+    'tcp': tcp,
+    'threaded': threaded,
+    'asyncio': asyncio_pipes,
+}
+
+payload_sizes = [16, 1024, 2**16, 2**20, 2**23]
+
+# timing
+
+def stats(latencies, bytes_per_op = None):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    total = sum(latencies)
+    result = {
+        'iterations': n,
+        'seconds': total,
+        'mean': total / n,
+        'min': latencies[0],
+        'p50': latencies[n // 2],
+        'p90': latencies[min(n - 1, n * 9 // 10)],
+        'p99': latencies[min(n - 1, n * 99 // 100)],
+        'ops_per_sec': n / total if total else None,
+    }
+    if bytes_per_op != None:
+        # the payload goes both ways
+        result['mb_per_sec'] = 2 * bytes_per_op * n / total / 2**20 if total else None
+    return result
+
+def timed(f, n):
+    latencies = []
+    clock = time.perf_counter
+    for i in range(n):
+        started = clock()
+        f()
+        latencies.append(clock() - started)
+    return latencies
+
+async def timed_async(f, n):
+    latencies = []
+    clock = time.perf_counter
+    for i in range(n):
+        started = clock()
+        await f()
+        latencies.append(clock() - started)
+    return latencies
+
+def payload_iterations(size, n):
+    return max(3, min(n, 2**24 // size))
+
+# the benchmarks, each of which yields (name, payload size, stats)
+
+def sync_benchmarks(c, n, only, transport, serialization_protocol):
+    call = c.send_request_and_receive_response
+    if 'connect' in only and transport in ('pipes', 'fork_server'):
+        # a new server, its first calls, which import a module, and closing it
+        def connect():
+            c2 = transports[transport](serialization_protocol)
+            c2.send_request_and_receive_response('call_function', None, 'unittest.util.safe_repr', ['x'])
+            c2.send_request_and_receive_response('call_function', None, 'doctest.script_from_examples', ['x'])
+            c2.close()
+        yield ('connect', None, stats(timed(connect, max(3, n // 20))))
+    if 'null_call' in only:
+        timed(lambda: call('call_function', None, '__main__.null', []), n // 10)
+        yield ('null_call', None, stats(timed(lambda: call('call_function', None, '__main__.null', []), n)))
+    if 'proxy_method' in only:
+        target = call('call_function', None, '__main__.Target', [])
+        target.m()
+        yield ('proxy_method', None, stats(timed(lambda: target.m(), n)))
+    if 'callback' in only:
+        yield ('callback', None, stats(timed(lambda: call('call_function', None, '__main__.call_back', [null]), n // 2)))
+    if 'batch' in only:
+        def batch():
+            with c.batch() as b:
+                for i in range(100):
+                    b.call_function('__main__.null')
+        result = stats(timed(batch, max(3, n // 100)))
+        result['ops_per_sec'] = result['ops_per_sec'] * 100
+        yield ('batch_of_100', None, result)
+    if 'iterate' in only:
+        remote = call('call_function', None, 'RMI.Node._eval', ['list(range(100000))'])
+        result = stats(timed(lambda: sum(remote), max(1, n // 500)))
+        result['ops_per_sec'] = result['ops_per_sec'] * 100000
+        yield ('iterate_100k', None, result)
+    if 'shipped' in only:
+        # a field summed over 10k remote objects in one round trip
+        remote = call('call_function', None, 'RMI.Node._eval', ['[complex(n, 1) for n in range(10000)]'])
+        result = stats(timed(lambda: c.call_shipped_function(total_real, remote), max(3, n // 100)))
+        result['ops_per_sec'] = result['ops_per_sec'] * 10000
+        yield ('shipped_sum_10k', None, result)
+    if 'payload' in only:
+        for size in payload_sizes:
+            payload = bytes(size)
+            yield ('payload', size, stats(timed(lambda: call('call_function', None, '__main__.echo', [payload]), payload_iterations(size, n)), size))
+
+# decoding text messages with the parser, against eval(), which the s0 protocol used before it
+def decode_benchmarks(n, only):
+    if 'decode' not in only:
+        return
+    s0 = RMI.serializers['s0']
+    messages = [
+        s0.serialize('t:query', [], [0, 1, 'call_function', 0, None, 2, 0, 1, 0, 2]),
+        s0.serialize('t:result', [3, 1], [0, 5, 0, 'list', 0, 100] + [v for i in range(100) for v in (0, 'item %d with "quotes"\n' % i)]),
+        s0.serialize('result', [], [0, 'x' * 100000]),
+    ]
+    for message in messages:
+        text = message.decode('utf-8')
+        iterations = max(3, min(n, 2**22 // len(text)))
+        yield ('decode_eval', len(message), stats(timed(lambda: eval(text), iterations)))
+        yield ('decode_parse', len(message), stats(timed(lambda: s0.parse(text), iterations)))
+
+def threaded_benchmarks(c, n, only, threads):
+    call = c.send_request_and_receive_response
+    if 'concurrent' in only:
+        with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+            started = time.perf_counter()
+            latencies = list(pool.map(lambda i: timed(lambda: call('call_function', None, '__main__.null', []), 1)[0], range(n)))
+            seconds = time.perf_counter() - started
+        result = stats(latencies)
+        result['ops_per_sec'] = n / seconds
+        result['threads'] = threads
+        yield ('concurrent_null_call', None, result)
+
+async def async_benchmarks(c, n, only, threads):
+    await c.connect()
+    call = c.send_request_and_receive_response
+    if 'null_call' in only:
+        await timed_async(lambda: call('call_function', None, '__main__.null', []), n // 10)
+        yield ('null_call', None, stats(await timed_async(lambda: call('call_function', None, '__main__.null', []), n)))
+    if 'concurrent' in only:
+        async def one():
+            return (await timed_async(lambda: call('call_function', None, '__main__.null', []), 1))[0]
+        started = time.perf_counter()
+        latencies = []
+        for start in range(0, n, threads):
+            latencies.extend(await asyncio.gather(*[one() for i in range(min(threads, n - start))]))
+        seconds = time.perf_counter() - started
+        result = stats(latencies)
+        result['ops_per_sec'] = n / seconds
+        result['threads'] = threads
+        yield ('concurrent_null_call', None, result)
+    if 'payload' in only:
+        for size in payload_sizes:
+            payload = bytes(size)
+            yield ('payload', size, stats(await timed_async(lambda: call('call_function', None, '__main__.echo', [payload]), payload_iterations(size, n)), size))
+
+def run(transport, serialization_protocol, n, only, threads, emit, skip):
+    try:
+        c = transports[transport](serialization_protocol)
+    except RMI.Exception as e:
+        # a transport this machine can't make, such as shared memory other than on x86, is skipped
+        skip(transport, serialization_protocol, str(e))
+        return
+    def result(name, size, stats):
+        stats.update({ 'benchmark': name, 'transport': transport, 'serializer': serialization_protocol, 'payload_bytes': size })
+        emit(stats)
+    if transport == 'asyncio':
+        # the connection belongs to the event loop, so it is closed before the loop is
+        async def all_async():
+            try:
+                async for (name, size, stats) in async_benchmarks(c, n, only, threads):
+                    result(name, size, stats)
+            finally:
+                c.close()
+        asyncio.run(all_async())
+        return
+    try:
+        for (name, size, stats) in sync_benchmarks(c, n, only, transport, serialization_protocol):
+            result(name, size, stats)
+        if transport == 'threaded':
+            for (name, size, stats) in threaded_benchmarks(c, n, only, threads):
+                result(name, size, stats)
+    finally:
+        c.close()
+
+def key(result):
+    return (result['benchmark'], result['transport'], result['serializer'], result['payload_bytes'])
+
+def compare(results, old_file):
+    old = {}
+    with open(old_file) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('{'):
+                r = json.loads(line)
+                if 'benchmark' in r:
+                    old[key(r)] = r
+    sys.stderr.write('%-22s %-14s %-4s %9s %12s %12s %8s\n' % ('benchmark', 'transport', 'ser', 'bytes', 'old p50', 'new p50', 'change'))
+    for r in results:
+        o = old.get(key(r))
+        if o == None:
+            continue
+        change = (r['p50'] - o['p50']) / o['p50'] * 100 if o['p50'] else 0
+        sys.stderr.write('%-22s %-14s %-4s %9s %12.6f %12.6f %+7.1f%%\n' % (r['benchmark'], r['transport'] or '', r['serializer'], r['payload_bytes'] or '', o['p50'], r['p50'], change))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'RMI benchmarks')
+    parser.add_argument('-o', '--output', help = 'write results to this file instead of stdout')
+    parser.add_argument('--quick', action = 'store_true', help = 'fewer iterations')
+    parser.add_argument('-n', '--iterations', type = int, help = 'calls per latency benchmark')
+    parser.add_argument('--transports', default = ','.join(transports.keys()))
+    parser.add_argument('--serializers', default = ','.join(RMI.serializers.keys()))
+    parser.add_argument('--only', default = 'decode,connect,null_call,proxy_method,callback,batch,iterate,shipped,payload,concurrent')
+    parser.add_argument('--threads', type = int, default = 8, help = 'concurrent callers for the threaded and asyncio transports')
+    parser.add_argument('--compare', help = 'an earlier output file to compare with')
+    args = parser.parse_args()
+
+    n = args.iterations or (200 if args.quick else 2000)
+    only = set(args.only.split(','))
+
+    # results go to the original stdout, and anything else printed, by this process or by the forked
+    # servers, goes to stderr, so the results stay machine-readable
+    if args.output:
+        out = open(args.output, 'w')
+    else:
+        sys.stdout.flush()
+        out = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    meta = {
+        'meta': True,
+        'rmi_version': RMI.version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'iterations': n,
+    }
+    out.write(json.dumps(meta) + '\n')
+    # flushed before any fork, so the children have nothing of it to write again as they exit
+    out.flush()
+
+    results = []
+    def emit(result):
+        results.append(result)
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+        sys.stderr.write('%-22s %-14s %-4s %9s p50 %.6fs %10.0f/s\n' % (result['benchmark'], result['transport'] or '', result['serializer'], result['payload_bytes'] or '', result['p50'], result['ops_per_sec'] or 0))
+
+    def skip(transport, serialization_protocol, reason):
+        out.write(json.dumps({ 'skipped': True, 'transport': transport, 'serializer': serialization_protocol, 'reason': reason }) + '\n')
+        out.flush()
+        sys.stderr.write('%-22s %-14s %-4s skipped: %s\n' % ('', transport, serialization_protocol, reason))
+
+    for (name, size, result) in decode_benchmarks(n, only):
+        result.update({ 'benchmark': name, 'transport': None, 'serializer': 's0', 'payload_bytes': size })
+        emit(result)
+
+    for transport in args.transports.split(','):
+        for serialization_protocol in args.serializers.split(','):
+            run(transport, serialization_protocol, n, only, args.threads, emit, skip)
+    out.close()
+    if fork_server != None:
+        fork_server.close()
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -2,20 +2,70 @@
 version = '0.10'
 
 import os
+import sys
+import re
+import asyncio
+import inspect
+import threading
+import concurrent.futures
+import collections
+import itertools
+import functools
+import struct
+import mmap
+import select
+import selectors
+import socket
+import time
 import weakref
+import bisect
+import contextlib
 import pprint
+import platform
+import pickle
+import zlib
+import signal
+import importlib
+import importlib.util
+import hashlib
+import marshal
+import types
+import builtins
 import RMI
 
 # for debugging output
 pp = pprint.PrettyPrinter(indent=0,width=10000000)
 
+# a stack with a list of its own for each thread, for what is being executed on that thread
+class ThreadStack(threading.local):
+    def __init__(self):
+        self.items = []
+
+    def append(self, item):
+        self.items.append(item)
+
+    def pop(self):
+        return self.items.pop()
+
+    def __getitem__(self, i):
+        return self.items[i]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
 # required for some methods on the remote side to find the RMI node acting upon them
-executing_nodes = [] # required for some methods on the remote side to find the RMI node acting upon them
+# each thread has a stack of its own, since requests from several nodes, or from one ThreadedNode, run at
+# once on different threads, and executing_nodes[-1] must be the node for the request on this one
+executing_nodes = ThreadStack() # required for some methods on the remote side to find the RMI node acting upon them
 
 # tracks classes which have been fully proxied into this process by some client
 proxied_classes = {} # tracks classes which have been fully proxied into this process by some client
 
 # inside-out tracking of remote object characteristics keeps us from having to possibly taint their API
+# both are keyed by the id() of the proxy
 node_for_object = {}
 remote_id_for_object = {}
 
@@ -25,41 +75,814 @@ try:
 except:
     DEBUG_FLAG = 0 
 
+# objects of these types are passed by value (a recursive copy) instead of as a proxy
+# each node starts with a copy of this, in node.copy_types, which can be changed per node
+# see also Copy, for a single value, and ProxyObject.DEFAULT_OPTS, for functions and methods
+copy_types = set()
+
 # this is used at the beginning of each debug message
 # setting it to a single space for a server makes server/client distinction
 # more readable in combined output.
 DEBUG_MSG_PREFIX = '' 
 
 class Message:
-    def __init__(self,ptype,pdata):
+    def __init__(self,ptype,pdata,request_id=None):
         self.message_type = ptype;
         self.message_data = pdata;
+        # set when the sender tags messages so responses can be matched to requests out of order
+        self.request_id = request_id;
 
 
 class Exception(BaseException):
     def __init__(self, s):
         self.s = s
     
+# raised by a call whose deadline passes before its response arrives (see Node.call_timeout)
+class Timeout(Exception):
+    pass
+
+# raised by a call when the other side has closed the connection, instead of returning nothing
+class Closed(Exception):
+    pass
+
+# raised on the side serving a request which the caller has given up on, while the request waits on
+# a call back to the caller, so the request stops there, instead of carrying on for no one
+class Cancelled(Exception):
+    pass
+
+
+# serialization protocols turn the encoded list of message values into bytes on the stream and back.
+# the protocol of each incoming message is identified by its first byte, so a node can read
+# any of them regardless of which one it is configured to send.
+
+class Serializer:
+
+    # the original text protocol: one pprint()-ed list per line
+    # it has no protocol byte: every message starts with '[', as with the Perl RMI::Serializer::S0
+    # lines are read back with parse(), which takes the Python literals pprint() writes and the Perl ones
+    # Data::Dumper writes, instead of with eval(), which compiles each line, and runs whatever is in it
+    class S0:
+        PROTOCOL_SYM = b'['
+
+        def serialize(self, message_type, received_and_destroyed_ids, encoded):
+            serialized = [message_type, received_and_destroyed_ids]
+            serialized.extend(encoded)
+            serialized_blob = pp.pformat(serialized)
+            if serialized_blob.find('\n') != -1:
+                raise(Exception("newline found in message data!"))
+            return serialized_blob.encode('utf-8') + b'\n'
+
+        def read_frame(self, first, reader):
+            return first + reader.readline()
+
+        async def read_frame_async(self, first, reader):
+            return first + await reader.readline()
+
+        def deserialize(self, serialized_blob):
+            serialized = self.parse(serialized_blob.decode('utf-8'))
+            message_type = serialized[0]
+            received_and_destroyed_ids = serialized[1]
+            del serialized[0:2]
+            return (message_type, received_and_destroyed_ids, serialized)
+
+        # the tokens of a line, found in one pass: strings in either kind of quotes, bytes, list openings
+        # and closings, and numbers and words, with the commas and whitespace between them skipped
+        # an unterminated string is taken as a word, which is then rejected
+        _tokens = re.compile(r"""
+            "[^"\\]*(?:\\.[^"\\]*)*" |
+            '[^'\\]*(?:\\.[^'\\]*)*' |
+            b"[^"\\]*(?:\\.[^"\\]*)*" |
+            b'[^'\\]*(?:\\.[^'\\]*)*' |
+            [\[\]] |
+            [^,\[\]\s]+
+        """, re.S | re.X)
+
+        _words = { 'None': None, 'undef': None, 'True': True, 'False': False, 'inf': float('inf'), '-inf': float('-inf'), 'nan': float('nan') }
+
+        # escapes in Python reprs and in Perl double-quoted strings: \x{263a}, \xe9, \u00e9, \U0001f600, \101, and \n and such
+        _escape = re.compile(r'\\(?:x\{([0-9a-fA-F]+)\}|x([0-9a-fA-F]{2})|u([0-9a-fA-F]{4})|U([0-9a-fA-F]{8})|([0-7]{1,3})|(.))', re.S)
+        _escaped_chars = { 'n': '\n', 'r': '\r', 't': '\t', 'f': '\f', 'b': '\b', 'a': '\a', 'v': '\v', 'e': '\x1b' }
+
+        # the list in a line of text, in one pass over it
+        def parse(self, text):
+            words = self._words
+            unescaped = self._unescaped
+            stack = []
+            current = None
+            result = None
+            for token in self._tokens.findall(text):
+                c = token[0]
+                if c in '0123456789-.':
+                    try:
+                        v = int(token)
+                    except ValueError:
+                        try:
+                            v = float(token)
+                        except ValueError:
+                            raise(Exception("bad number " + token[:40] + " in message: " + text[:80]))
+                elif c == '"' or c == "'":
+                    v = token[1:-1]
+                    if v.find('\\') != -1:
+                        v = unescaped(v)
+                elif c == '[':
+                    new = []
+                    if current != None:
+                        current.append(new)
+                        stack.append(current)
+                    elif result != None:
+                        raise(Exception("more than one list in message: " + text[:80]))
+                    else:
+                        result = new
+                    current = new
+                    continue
+                elif c == ']':
+                    if current == None:
+                        raise(Exception("unbalanced ] in message: " + text[:80]))
+                    current = stack.pop() if len(stack) else None
+                    continue
+                elif c == 'b' and len(token) > 1 and (token[1] == '"' or token[1] == "'"):
+                    v = token[2:-1]
+                    if v.find('\\') != -1:
+                        v = unescaped(v)
+                    v = v.encode('latin-1')
+                else:
+                    try:
+                        v = words[token]
+                    except KeyError:
+                        raise(Exception("unexpected " + token[:40] + " in message: " + text[:80]))
+                if current == None:
+                    raise(Exception("value outside of a list in message: " + text[:80]))
+                current.append(v)
+            if result == None or current != None:
+                raise(Exception("incomplete message: " + text[:80]))
+            return result
+
+        # Python escapes are undone by the unicode_escape codec, which reads bytes as latin-1, so the characters
+        # beyond latin-1 are escaped for it first, and the Perl escapes it does not know are undone one by one
+        def _unescaped(self, v):
+            if v.find('\\x{') == -1 and v.find('\\e') == -1 and v.find('\\$') == -1 and v.find('\\@') == -1:
+                return v.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+            return self._escape.sub(self._unescape, v)
+
+        def _unescape(self, m):
+            i = m.lastindex
+            if i <= 4:
+                return chr(int(m.group(i), 16))
+            if i == 5:
+                return chr(int(m.group(i), 8))
+            c = m.group(i)
+            return self._escaped_chars.get(c, c)
+
+    # the Perl RMI default text protocol: chr(1), then a list as Data::Dumper writes it, on one line,
+    # with the serialization, encoding and request/response protocols, the message type, the count of
+    # destroyed ids, the ids, and then the encoded values
+    # strings are in double quotes with Perl escapes, so they read the same in Perl and in parse()
+    # True and False go as words, which Perl reads as strings, and bytes as b"...", which only Python reads
+    class S1(S0):
+        PROTOCOL_SYM = b'\x01'
+
+        PROTOCOLS = '"s1","python3e1","python3r1",'
+
+        _needs_escape = re.compile('[\\\\"$@\x00-\x1f\x7f-\U0010ffff]')
+        _escapes = { '\\': '\\\\', '"': '\\"', '$': '\\$', '@': '\\@', '\n': '\\n', '\r': '\\r', '\t': '\\t', '\f': '\\f', '\b': '\\b', '\a': '\\a', '\x1b': '\\e' }
+
+        def serialize(self, message_type, received_and_destroyed_ids, encoded):
+            parts = [self._dump(message_type), str(len(received_and_destroyed_ids))]
+            for v in received_and_destroyed_ids:
+                parts.append(self._dump(v))
+            for v in encoded:
+                parts.append(self._dump(v))
+            return (self.PROTOCOL_SYM.decode('ascii') + '[' + self.PROTOCOLS + ','.join(parts) + ']\n').encode('ascii')
+
+        def _dump(self, v):
+            if v is None:
+                return 'undef'
+            elif v is True:
+                return 'True'
+            elif v is False:
+                return 'False'
+            elif isinstance(v,(int,float)):
+                return repr(v)
+            elif isinstance(v,str):
+                if self._needs_escape.search(v) == None:
+                    return '"' + v + '"'
+                return '"' + self._needs_escape.sub(self._quote, v) + '"'
+            elif isinstance(v,bytes):
+                return 'b' + self._dump(v.decode('latin-1'))
+            else:
+                raise(Exception("cannot serialize value of type " + str(type(v)) + ": " + str(v)))
+
+        def _quote(self, m):
+            c = m.group(0)
+            q = self._escapes.get(c)
+            if q == None:
+                q = '\\x{' + format(ord(c), 'x') + '}'
+            return q
+
+        def deserialize(self, serialized_blob):
+            serialized = self.parse(serialized_blob[1:].decode('utf-8'))
+            # the protocols, which only Perl uses
+            del serialized[0:3]
+            message_type = serialized[0]
+            count = serialized[1]
+            received_and_destroyed_ids = serialized[2:2+count]
+            del serialized[0:2+count]
+            return (message_type, received_and_destroyed_ids, serialized)
+
+    # a binary protocol: chr(2), a 4-byte big-endian payload length, then the payload
+    # the payload is the message type, the count of destroyed ids, the ids, and
+    # then the encoded values, each as a one-byte tag followed by its packed data
+    class B1:
+        PROTOCOL_SYM = b'\x02'
+
+        _header = struct.Struct('>cI')
+        _length = struct.Struct('>I')
+        _int = struct.Struct('>q')
+        _float = struct.Struct('>d')
+
+        def serialize(self, message_type, received_and_destroyed_ids, encoded):
+            # the first slot is reserved for the header so the whole frame is joined with one copy
+            parts = [None]
+            self._pack(parts, message_type)
+            parts.append(self._length.pack(len(received_and_destroyed_ids)))
+            for id in received_and_destroyed_ids:
+                self._pack(parts, id)
+            for v in encoded:
+                self._pack(parts, v)
+            length = 0
+            for part in parts[1:]:
+                length = length + len(part)
+            parts[0] = self._header.pack(self.PROTOCOL_SYM, length)
+            return b''.join(parts)
+
+        def _pack(self, parts, v):
+            if v is None:
+                parts.append(b'N')
+            elif v is True:
+                parts.append(b'T')
+            elif v is False:
+                parts.append(b'F')
+            elif isinstance(v,int):
+                if -0x8000000000000000 <= v <= 0x7fffffffffffffff:
+                    parts.append(b'i')
+                    parts.append(self._int.pack(v))
+                else:
+                    # arbitrary precision integers go as decimal text
+                    b = str(v).encode('ascii')
+                    parts.append(b'I')
+                    parts.append(self._length.pack(len(b)))
+                    parts.append(b)
+            elif isinstance(v,float):
+                parts.append(b'd')
+                parts.append(self._float.pack(v))
+            elif isinstance(v,str):
+                b = v.encode('utf-8')
+                parts.append(b's')
+                parts.append(self._length.pack(len(b)))
+                parts.append(b)
+            elif isinstance(v,bytes):
+                parts.append(b'b')
+                parts.append(self._length.pack(len(v)))
+                parts.append(v)
+            else:
+                raise(Exception("cannot serialize value of type " + str(type(v)) + ": " + str(v)))
+
+        def read_frame(self, first, reader):
+            header = reader.read(4)
+            if len(header) != 4:
+                raise(Exception("truncated frame header!"))
+            (length,) = self._length.unpack(header)
+            payload = reader.read(length)
+            if len(payload) != length:
+                raise(Exception("truncated frame: expected " + str(length) + " bytes, got " + str(len(payload))))
+            return first + header + payload
+
+        async def read_frame_async(self, first, reader):
+            header = await reader.readexactly(4)
+            (length,) = self._length.unpack(header)
+            payload = await reader.readexactly(length)
+            return first + header + payload
+
+        def deserialize(self, serialized_blob):
+            buf = memoryview(serialized_blob)
+            pos = 5
+            (message_type, pos) = self._unpack(buf, pos)
+            (count,) = self._length.unpack_from(buf, pos)
+            pos = pos + 4
+            received_and_destroyed_ids = []
+            for n in range(count):
+                (id, pos) = self._unpack(buf, pos)
+                received_and_destroyed_ids.append(id)
+            end = len(buf)
+            encoded = []
+            while pos < end:
+                (v, pos) = self._unpack(buf, pos)
+                encoded.append(v)
+            return (message_type, received_and_destroyed_ids, encoded)
+
+        def _unpack(self, buf, pos):
+            tag = buf[pos]
+            pos = pos + 1
+            if tag == 0x73: # s
+                (length,) = self._length.unpack_from(buf, pos)
+                pos = pos + 4
+                return (str(buf[pos:pos+length], 'utf-8'), pos + length)
+            elif tag == 0x69: # i
+                return (self._int.unpack_from(buf, pos)[0], pos + 8)
+            elif tag == 0x4e: # N
+                return (None, pos)
+            elif tag == 0x64: # d
+                return (self._float.unpack_from(buf, pos)[0], pos + 8)
+            elif tag == 0x54: # T
+                return (True, pos)
+            elif tag == 0x46: # F
+                return (False, pos)
+            elif tag == 0x62: # b
+                (length,) = self._length.unpack_from(buf, pos)
+                pos = pos + 4
+                return (bytes(buf[pos:pos+length]), pos + length)
+            elif tag == 0x49: # I
+                (length,) = self._length.unpack_from(buf, pos)
+                pos = pos + 4
+                return (int(str(buf[pos:pos+length], 'ascii')), pos + length)
+            else:
+                raise(Exception("Unknown tag " + str(tag) + " in serialized data!"))
+
+    # a compressed frame: chr(3), a byte for the algorithm, a 4-byte big-endian length, then the
+    # compressed bytes of a whole frame of one of the protocols above
+    # a node sends these only to a peer which has said it can read them (see Node.compression)
+    class Compressed:
+        PROTOCOL_SYM = b'\x03'
+
+        _header = struct.Struct('>cBI')
+        _rest_of_header = struct.Struct('>BI')
+
+        def compress(self, algorithm, level, frame):
+            (id, compress, decompress) = compression_algorithms[algorithm]
+            compressed = compress(frame, level)
+            return self._header.pack(self.PROTOCOL_SYM, id, len(compressed)) + compressed
+
+        def read_frame(self, first, reader):
+            header = reader.read(5)
+            if len(header) != 5:
+                raise(Exception("truncated frame header!"))
+            (id, length) = self._rest_of_header.unpack(header)
+            payload = reader.read(length)
+            if len(payload) != length:
+                raise(Exception("truncated frame: expected " + str(length) + " bytes, got " + str(len(payload))))
+            return first + header + payload
+
+        async def read_frame_async(self, first, reader):
+            header = await reader.readexactly(5)
+            (id, length) = self._rest_of_header.unpack(header)
+            payload = await reader.readexactly(length)
+            return first + header + payload
+
+        def deserialize(self, serialized_blob):
+            (sym, id, length) = self._header.unpack_from(serialized_blob)
+            try:
+                decompress = compression_algorithms_by_id[id]
+            except KeyError:
+                raise(Exception("Got a frame compressed with unknown algorithm " + str(id)))
+            frame = decompress(serialized_blob[6:])
+            return serializers_by_sym[frame[0:1]].deserialize(frame)
+
+# serializers by name, for the serialization_protocol option on Node
+serializers = {
+    's0': Serializer.S0(),
+    's1': Serializer.S1(),
+    'b1': Serializer.B1(),
+}
+
+# serializers by the first byte of a message, for picking the right one on receipt
+serializers_by_sym = {}
+for _s in serializers.values():
+    serializers_by_sym[_s.PROTOCOL_SYM] = _s
+compressed_frames = Serializer.Compressed()
+serializers_by_sym[compressed_frames.PROTOCOL_SYM] = compressed_frames
+
+# compression algorithms by name, for the compression option on Node, as
+# (id in the frame header, compress(bytes, level), decompress(bytes))
+# a level of None is the default of the algorithm
+compression_algorithms = {
+    'zlib': (1, lambda b, level: zlib.compress(b, -1 if level == None else level), zlib.decompress),
+}
+try:
+    import bz2
+    compression_algorithms['bz2'] = (2, lambda b, level: bz2.compress(b, 9 if level == None else level), bz2.decompress)
+except ImportError:
+    pass
+try:
+    import lzma
+    compression_algorithms['lzma'] = (3, lambda b, level: lzma.compress(b, preset = level), lzma.decompress)
+except ImportError:
+    pass
+
+compression_algorithms_by_id = {}
+for (_id, _compress, _decompress) in compression_algorithms.values():
+    compression_algorithms_by_id[_id] = _decompress
+
+# what a node offers in a handshake (see Node.handshake): its serializers, fastest first, the encodings of
+# message values it reads and writes, and the optional features it has besides compression
+serializer_preference = ['b1', 's0', 's1']
+encodings = ['python3e1']
+features = ['batch', 'out_of_band', 'frames']
+
+# wraps a value which should be passed to the other side by value instead of as a proxy:
+#   c.send_request_and_receive_response('call_function', None, 'F1.save', [RMI.Copy(rows)])
+# functions called on the remote side can return a Copy as well
+# a shallow copy (deep = False) copies only the outer container, and sends its items as usual
+class Copy(object):
+    def __init__(self, value, deep = True):
+        self.value = value
+        self.deep = deep
+
+# the containers which a copy can be made of, by the shape sent for them
+copied_shapes = {
+    'list': list,
+    'tuple': tuple,
+    'set': set,
+    'frozenset': frozenset,
+    'bytes': bytes,
+    'bytearray': bytearray,
+}
+shape_for_copied_type = {}
+for _shape in copied_shapes:
+    shape_for_copied_type[copied_shapes[_shape]] = _shape
+
+# the attributes in the __slots__ of a class and its bases, by the names they are stored under
+def _slot_names(cls):
+    names = []
+    for c in cls.__mro__:
+        slots = c.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for name in slots:
+            if name.startswith('__') and not name.endswith('__'):
+                # a private name is mangled with the name of its class
+                name = '_' + c.__name__.lstrip('_') + name
+            if name not in ('__dict__', '__weakref__') and name not in names:
+                names.append(name)
+    return names
+
+# caches the function or class resolved for each dotted name in a 'call_function' request,
+# so repeated calls skip the import and eval
+# entries remember the modules they came from, the package named and the module which defines the
+# callable, and are dropped when either is reloaded
+# it is shared by the threads of a process, so the entries are only used under a lock
+class ResolvedCallableCache(object):
+    def __init__(self, size = 1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, method):
+        with self._lock:
+            entry = self._entries.get(method)
+            if entry != None:
+                (method_ref, modules) = entry
+                # importlib.reload() gives the module a fresh __spec__, and a re-import after
+                # removal from sys.modules gives a fresh module
+                if all(sys.modules.get(module.__name__) is module and module.__spec__ is spec for (module, spec) in modules):
+                    self._entries.move_to_end(method)
+                    self.hits = self.hits + 1
+                    return method_ref
+                self._entries.pop(method, None)
+            self.misses = self.misses + 1
+
+        modules = []
+        pos = method.find('.')
+        if pos != -1:
+            pkg = method[:pos]
+            exec('import ' + pkg)
+            modules.append(sys.modules[pkg])
+        method_ref = eval(method)
+        owner = sys.modules.get(getattr(method_ref, '__module__', None) or '')
+        if owner != None and owner not in modules:
+            modules.append(owner)
+
+        with self._lock:
+            self._entries[method] = (method_ref, [(module, module.__spec__) for module in modules])
+            if len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+        return method_ref
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return { 'size': self.size, 'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses }
+
+resolved_callables = ResolvedCallableCache()
+
+# caches the functions shipped by clients with call_shipped_function, compiled, by the hash of what was shipped,
+# so a client sends a function once and then only its hash
+# each function gets globals of its own, with just the builtins: it imports what it uses inside itself
+# as with resolved_callables, the entries are only used under a lock
+class ShippedFunctionCache(object):
+    def __init__(self, size = 1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    # the function for a key, compiled from the kind and payload if they were sent and it is not cached
+    def resolve(self, key, kind, payload):
+        with self._lock:
+            f = self._entries.get(key)
+            if f != None:
+                self._entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return f
+            if payload == None:
+                # the client sends it again
+                raise(Exception(self.NOT_CACHED + key))
+            self.misses = self.misses + 1
+
+        f = self._compile(kind, payload)
+        with self._lock:
+            self._entries[key] = f
+            if len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+        return f
+
+    NOT_CACHED = 'shipped function not cached: '
+
+    def _compile(self, kind, payload):
+        namespace = { '__name__': '__shipped__', '__builtins__': builtins }
+        if kind == 'code':
+            magic = importlib.util.MAGIC_NUMBER
+            if bytes(payload[:len(magic)]) != magic:
+                raise(Exception("shipped code is from another version of Python: ship its source instead"))
+            code = marshal.loads(bytes(payload[len(magic):]))
+            return types.FunctionType(code, namespace, code.co_name)
+        # source is an expression for the callable, such as a lambda, or defines a function
+        try:
+            return eval(compile(payload, '<shipped>', 'eval'), namespace)
+        except SyntaxError:
+            pass
+        code = compile(payload, '<shipped>', 'exec')
+        exec(code, namespace)
+        for name in reversed(code.co_names):
+            if callable(namespace.get(name)):
+                return namespace[name]
+        raise(Exception("shipped source defines no function"))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return { 'size': self.size, 'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses }
+
+shipped_functions = ShippedFunctionCache()
+
+# a histogram with buckets for powers of two from base up, for latencies or sizes
+class Histogram(object):
+    def __init__(self, base, buckets):
+        self.bounds = [base * 2**n for n in range(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.count = self.count + 1
+        self.sum = self.sum + v
+        if self.min == None or v < self.min:
+            self.min = v
+        if self.max == None or v > self.max:
+            self.max = v
+
+    # the upper bound of the bucket holding the given fraction of values
+    def percentile(self, fraction):
+        wanted = fraction * self.count
+        seen = 0
+        for n in range(len(self.counts)):
+            seen = seen + self.counts[n]
+            if seen >= wanted and seen > 0:
+                return self.bounds[n] if n < len(self.bounds) else self.max
+        return None
+
+    def snapshot(self):
+        buckets = []
+        for n in range(len(self.counts)):
+            if self.counts[n]:
+                buckets.append([self.bounds[n] if n < len(self.bounds) else None, self.counts[n]])
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': buckets,
+        }
+
+# counters and histograms of what a node does, for node.metrics, which is None (off) by default:
+#   c.metrics = RMI.Metrics()
+#   ...
+#   print(c.metrics.snapshot())
+# times are in seconds, in histograms for each step of a message: encode and write on the way out,
+# wait (for the first byte), read (the rest) and decode on the way in, and for whole requests (call)
+# and requests executed for the other side (execute)
+# depth is how many requests were executing in this process, counting the one just executed,
+# which is more than 1 for callbacks made while waiting on a request to the other side
+# if trace is given, it is called with a dict for each request made and each request executed
+# one Metrics can be shared by several nodes, and by several threads
+class Metrics(object):
+    def __init__(self, trace = None):
+        self.trace = trace
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = collections.Counter()
+            self.histograms = {}
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def time(self, name, seconds):
+        self._add(name, seconds, 1e-6, 32)
+
+    def size(self, name, n):
+        self._add(name, n, 1, 40)
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {}
+            for name in self.histograms:
+                histograms[name] = self.histograms[name].snapshot()
+            return { 'counters': dict(self.counters), 'histograms': histograms }
+
+    def _add(self, name, v, base, buckets):
+        with self._lock:
+            h = self.histograms.get(name)
+            if h == None:
+                h = self.histograms[name] = Histogram(base, buckets)
+            h.add(v)
+
+    # called by the node for each message sent, with its size, and the times it started, finished encoding
+    # and finished writing
+    def sent(self, message_type, size, started, encoded, written):
+        with self._lock:
+            self.counters['messages_sent'] += 1
+            self.counters['messages_sent.' + message_type] += 1
+            self.counters['bytes_sent'] += size
+        self.size('message_size_sent', size)
+        self.time('encode', encoded - started)
+        self.time('write', written - encoded)
+
+    # called by the node for each message received, with the times it started waiting, got the first byte,
+    # had the whole frame, and finished decoding
+    def received(self, message_type, size, started, first, read, decoded):
+        with self._lock:
+            self.counters['messages_received'] += 1
+            self.counters['messages_received.' + message_type] += 1
+            self.counters['bytes_received'] += size
+        self.size('message_size_received', size)
+        if first != None:
+            self.time('wait', first - started)
+            self.time('read', read - first)
+        self.time('decode', decoded - read)
+
+    def called(self, call_type, method, started, requests = 1):
+        seconds = time.perf_counter() - started
+        self.count('calls')
+        self.count('requests', requests)
+        self.time('call', seconds)
+        if self.trace != None:
+            self.trace({ 'event': 'call', 'call_type': call_type, 'method': method, 'requests': requests, 'seconds': seconds, 'pid': os.getpid() })
+
+    def executed(self, method, response_type, depth, started):
+        seconds = time.perf_counter() - started
+        self.count('executed')
+        if response_type == 'exception':
+            self.count('exceptions')
+        self.time('execute', seconds)
+        self._add('depth', depth, 1, 16)
+        if self.trace != None:
+            self.trace({ 'event': 'execute', 'method': method, 'response_type': response_type, 'depth': depth, 'seconds': seconds, 'pid': os.getpid() })
+
+# one dispatcher per argument count, see Node.get_dispatcher
+dispatchers = {}
 
 class Node(object):
-    def __init__(self, reader, writer):
+    # reader and writer are binary streams
+    def __init__(self, reader, writer, serialization_protocol = 's0', compression = None, compression_level = None, call_timeout = None):
         self.reader = reader
         self.writer = writer
+        try:
+            self._serializer = serializers[serialization_protocol]
+        except KeyError:
+            raise(Exception("unknown serialization protocol " + str(serialization_protocol)))
+        self.serialization_protocol = serialization_protocol
+        # the algorithm, from compression_algorithms, with which to compress frames of at least
+        # compression_threshold bytes, once the other side has said it can read them
+        # the sides say which algorithms they can read in a handshake (see Node.handshake), so both must
+        # have compression set and one must call handshake() before anything is compressed, and a peer
+        # without the handshake, such as Perl RMI, is sent nothing it cannot read
+        # out-of-band buffers are not compressed
+        if compression != None and compression not in compression_algorithms:
+            raise(Exception("unknown compression algorithm " + str(compression)))
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threshold = 2**12
+        self._peer_compression = ()
         self._sent_objects = {}
-        self._received_objects = {}
-        self._received_and_destroyed_ids = []
+        self._received_objects = weakref.WeakValueDictionary()
+        # proxies queue (remote id, count) here as they are garbage collected, from any thread,
+        # and the queue is drained into the next message sent
+        self._received_and_destroyed_ids = collections.deque()
         self._tied_objects_for_tied_refs = {}
+        # each side counts how many times it has sent and received each handle, and a release
+        # carries the received count, so a handle which is sent again while its release is on
+        # the way is not dropped out from under the new proxy
+        self._sent_counts = {}
+        self._received_counts = {}
+        # seconds a queued release may wait for a message to ride on before one is sent just for it,
+        # for nodes with a thread or event loop which can do the sending (see _release_queued)
+        self.release_interval = 1.0
+        # objects sent to the other side are identified by small integer handles, which are the keys
+        # of _sent_objects, and which we find again for an object by its id()
+        # the other side learns the class of each handle once, the first time it is sent
+        self._next_handle = 1
+        self._handle_for_object = {}
+        self._remote_classes = {}
+        # whether each (remote class, attribute name) is a method, so method calls on proxies take one request
+        self._remote_methods = {}
+        # requests are tagged with an id once the other side has tagged one of its own messages,
+        # and responses which arrive for a request other than the one being waited-on are held here
+        self._tag_requests = False
+        self._next_request_id = 1
+        self._stashed_responses = {}
+        # types passed by value by this node
+        self.copy_types = set(RMI.copy_types)
+        # how many items iterating over a proxy fetches per request
+        self.iter_chunk_size = 256
+        # bytes, bytearrays and memoryviews of at least this many bytes are sent after the message
+        # as raw buffers, instead of inside it (see _encode_buffer), unless it is None
+        # a peer which predates them could not read them, so they are only sent once a handshake
+        # finds that the other side has them
+        self.out_of_band_threshold = 2**16
+        self._peer_out_of_band = False
+        # the out-of-band buffers of the messages being serialized and deserialized
+        self._outgoing_buffers = None
+        self._incoming_buffers = None
+        # an RMI.Metrics to record what this node does, if any
+        self.metrics = None
+        # messages larger than about this many bytes are sent as a series of frames (see _frames), if set
+        self.max_frame_size = None
+        # the values of the frames received so far of a message sent as a series of frames
+        self._continued_values = None
+        # the optional features both sides have, once a handshake has found them
+        self.peer_features = None
+        # the keys of functions this node has shipped, which the other side has cached
+        self._shipped_keys = set()
+        # seconds a call may wait for its response, including the time spent on calls the other side
+        # makes back in the meantime, unless the call has a timeout of its own; None waits forever
+        # a call which times out raises RMI.Timeout, and tells the other side to cancel the request
+        # since its response may still arrive, requests are tagged from the first call with a deadline,
+        # which needs a Python RMI peer
+        # readers without a file descriptor, such as a SharedMemoryRing, are waited on without a deadline
+        self.call_timeout = call_timeout
+        # the deadline of the call being waited on, which bounds the calls made within it too
+        self._deadline = None
+        # requests this side has given up on, whose responses are dropped when they arrive
+        self._cancelled_requests = set()
+        # the requests from the other side being processed on each thread, innermost last,
+        # and those of them it has cancelled
+        self._executing_requests = ThreadStack()
+        self._cancelled_by_peer = set()
+        # the counts of the last object_stats(), for the growth since
+        self._last_object_counts = {}
 
     def close(self):
         if self.reader:
             if self.reader != self.writer:
-                self.reader.close
+                self.reader.close()
         if self.writer:
-            self.writer.close 
+            try:
+                self.writer.close()
+            except OSError:
+                # the other side has gone, and what was left to send it with it
+                pass
         self.reader = None
         self.writer = None
 
-    def send_request_and_receive_response(self, call_type, obj = None, method = None, params = [], opts = None):
+    # timeout is in seconds, and defaults to call_timeout
+    def send_request_and_receive_response(self, call_type, obj = None, method = None, params = [], opts = None, timeout = None):
         if DEBUG_FLAG: 
             print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) 
                 + " calling via " + str(self) 
@@ -68,25 +891,333 @@ class Node(object):
                 + " with " + pp.pformat(params)
             )
         
-        sendable = [method,0,obj,len(params)]
-        for p in params:
-            sendable.append(p)
+        metrics = self.metrics
+        if metrics != None:
+            started = time.perf_counter()
+
+        sendable = []
+        self._append_query(sendable, call_type, obj, method, params, opts)
+
+        deadline = self._deadline_for(timeout)
+        request_id = self._new_request_id()
+        if not self._send(Message('query',sendable,request_id)):
+            raise(Exception("failed to send! $!"))
+
+        received = self._wait_for_response('result', request_id, deadline)
+        if metrics != None:
+            metrics.called(call_type, method, started)
+        if DEBUG_FLAG:
+            print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " returning " + str(received.message_data[0]) + "\n")
+        return received.message_data[0]
+
+    # sends several requests as one 'batch' message, written with a single flush
+    # each request is [call_type, obj, method, params], as for send_request_and_receive_response
+    # returns the results in order, with an RMI.Exception in place of each request which failed
+    def send_requests_and_receive_responses(self, requests, timeout = None):
+        if self.peer_features != None and 'batch' not in self.peer_features:
+            return self._run_steps(self._one_by_one(requests, timeout))
+        if DEBUG_FLAG: 
+            print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) 
+                + " calling via " + str(self) 
+                + " batch of " + str(len(requests)) + " requests"
+            )
+
+        metrics = self.metrics
+        if metrics != None:
+            started = time.perf_counter()
+
+        sendable = [len(requests)]
+        for (call_type, obj, method, params) in requests:
+            self._append_query(sendable, call_type, obj, method, params, None)
 
-        if not self._send(Message('query',sendable)):
+        deadline = self._deadline_for(timeout)
+        request_id = self._new_request_id()
+        if not self._send(Message('batch',sendable,request_id)):
             raise(Exception("failed to send! $!"))
 
+        received = self._wait_for_response('batch_result', request_id, deadline)
+        if metrics != None:
+            metrics.called('batch', None, started, len(requests))
+        return self._batch_results(received)
+
+    # the deadline of a call with the given timeout, or with call_timeout, which is never later than the
+    # deadline of a call this one is made within, or None for no deadline
+    def _deadline_for(self, timeout):
+        if timeout == None:
+            timeout = self.call_timeout
+        deadline = self._deadline
+        if timeout != None:
+            self._tag_requests = True
+            own = time.monotonic() + timeout
+            if deadline == None or own < deadline:
+                deadline = own
+        return deadline
+
+    # receives the response to a request, giving up on it once the deadline passes
+    def _wait_for_response(self, result_type, request_id, deadline):
+        outer = self._deadline
+        self._deadline = deadline
+        try:
+            received = self._receive_response(result_type, request_id)
+        except (Timeout, Cancelled):
+            self._cancel(request_id)
+            raise
+        finally:
+            self._deadline = outer
+        if received.message_type == 'close':
+            raise(Closed("connection closed while waiting for a response"))
+        return received
+
+    # gives up on a request: its response is dropped when it arrives, and the other side is told, so it
+    # can drop the request if it has not started it, or stop it at its next call back to this side
+    def _cancel(self, request_id):
+        self._cancelled_requests.add(request_id)
+        try:
+            self._send(Message('cancel', request_id))
+        except (OSError, Exception):
+            pass
+
+    # appends one query to sendable: the method, wantarray, the object, the param count and the params
+    # the copy_results and copy_params options come from opts, or when no opts are given,
+    # from ProxyObject.DEFAULT_OPTS for the class or module and name of the method
+    def _append_query(self, sendable, call_type, obj, method, params, opts):
+        if opts == None:
+            opts = self._default_opts(call_type, obj, method)
+        if opts.get('copy_params'):
+            copied = []
+            for p in params:
+                copied.append(p if self._is_primitive(p) else Copy(p))
+            params = copied
+        if opts.get('copy_results'):
+            # the other side calls the method through _copy_result, which returns a copy
+            sendable.extend(['RMI.Node._copy_result',0,None,len(params)+2,method,obj])
+        else:
+            sendable.extend([method,0,obj,len(params)])
+        sendable.extend(params)
+
+    def _default_opts(self, call_type, obj, method):
+        if not ProxyObject.DEFAULT_OPTS:
+            return {}
+        if call_type == 'call_object_method':
+            owner = self._id_to_class(remote_id_for_object.get(id(obj)))
+        else:
+            (owner, dot, method) = method.rpartition('.')
+        return ProxyObject.DEFAULT_OPTS.get(owner, {}).get(method, {})
+
+    # runs steps, a generator which yields the params of each request it makes and is sent back the result,
+    # or has the exception raised where it yielded, and returns what the generator returns
+    # so that the same steps serve a node which waits for each response and one which awaits it
+    def _run_steps(self, steps):
+        (result, error) = (None, None)
+        while True:
+            try:
+                request = steps.send(result) if error == None else steps.throw(error)
+            except StopIteration as e:
+                return e.value
+            try:
+                (result, error) = (self.send_request_and_receive_response(*request), None)
+            except BaseException as e:
+                (result, error) = (None, e)
+
+    # the steps of a batch for a peer without batches, which makes the requests one at a time
+    # the timeout is for all of them
+    def _one_by_one(self, requests, timeout = None):
+        deadline = None if timeout == None else time.monotonic() + timeout
+        results = []
+        for (call_type, obj, method, params) in requests:
+            try:
+                results.append((yield (call_type, obj, method, params, None, None if deadline == None else deadline - time.monotonic())))
+            except (Timeout, Closed):
+                raise
+            except Exception as e:
+                results.append(e)
+        return results
+
+    # asks the other side which serializers, encodings and features it has, and has both sides switch to the
+    # fastest serializer they share, and use only the features they share
+    #   c = RMI.Client.Tcp(host = 'myserver.com', port = 1234)
+    #   c.handshake()
+    # returns the answer, or None from a peer without the handshake, such as Perl RMI or an older Python RMI,
+    # in which case this side keeps its serializer and uses none of the optional features
+    # a connection which closes or times out raises Closed or Timeout as for any other request
+    # it should be the first request on a connection, before any other is underway
+    def handshake(self):
+        try:
+            answer = self.send_request_and_receive_response('call_function', None, 'RMI.Node._handshake', [Copy(self._handshake_offer())])
+        except (Timeout, Closed):
+            raise
+        except Exception:
+            answer = None
+        self._use_handshake_answer(answer)
+        return answer
+
+    def _handshake_offer(self):
+        return {
+            'serializers': [name for name in serializer_preference if name in serializers],
+            'encodings': list(encodings),
+            'features': self._features(),
+            'compression': list(compression_algorithms.keys()) if self.compression != None else None,
+        }
+
+    def _features(self):
+        if self.compression != None:
+            return features + ['compression']
+        return list(features)
+
+    # picks from the offer of the other side, and switches this side to it before the answer is sent
+    def _answer_handshake(self, offer):
+        serializer = None
+        for name in offer['serializers']:
+            if name in serializers:
+                serializer = name
+                break
+        encoding = None
+        for name in offer['encodings']:
+            if name in encodings:
+                encoding = name
+                break
+        if serializer == None or encoding == None:
+            raise(Exception("no serializer and encoding in common with " + str(offer)))
+        mine = self._features()
+        shared = [name for name in offer['features'] if name in mine]
+        answer = {
+            'serializer': serializer,
+            'encoding': encoding,
+            'features': shared,
+            'compression': list(compression_algorithms.keys()) if self.compression != None else None,
+        }
+        self._use_handshake(serializer, shared, offer.get('compression'))
+        return answer
+
+    def _use_handshake_answer(self, answer):
+        if answer == None:
+            self._use_handshake(self.serialization_protocol, [], None)
+        else:
+            self._use_handshake(answer['serializer'], answer['features'], answer.get('compression'))
+
+    def _use_handshake(self, serializer, shared, peer_compression):
+        self._serializer = serializers[serializer]
+        self.serialization_protocol = serializer
+        self.peer_features = set(shared)
+        self._peer_out_of_band = 'out_of_band' in self.peer_features
+        if 'frames' not in self.peer_features:
+            self.max_frame_size = None
+        if 'compression' in self.peer_features and peer_compression != None:
+            self._peer_compression = peer_compression
+        else:
+            self._peer_compression = ()
+
+    # runs the function f on the other side, with params, and returns only its result, so work on remote objects
+    # can be done there in one round trip instead of a request per object:
+    #   total = c.call_shipped_function(lambda_source_or_def, remote_objects)
+    # f is a function without free variables, a code object, or source for a lambda or a def
+    # functions and code objects go as bytecode, which only another process with the same version of
+    # Python can run, and source goes as it is
+    # proxies among the params arrive as the real objects, and a result wrapped in Copy() comes back by value
+    # globals are not shipped, so f should import what it needs inside itself
+    def call_shipped_function(self, f, *params, opts = None):
+        return self._run_steps(self._shipped_call(f, params, opts))
+
+    # the steps of call_shipped_function (see _run_steps): the function is sent by its key alone once the
+    # other side has it, and again in full if the other side has dropped it from its cache
+    def _shipped_call(self, f, params, opts):
+        (key, kind, payload, defaults, kwdefaults) = self._shipped_function(f)
+        if key in self._shipped_keys:
+            try:
+                return (yield ('call_function', None, 'RMI.Node._call_shipped', [key, kind, None, defaults, kwdefaults, *params], opts))
+            except Exception as e:
+                # the other side has dropped it from its cache
+                if str(e.s).find(ShippedFunctionCache.NOT_CACHED) == -1:
+                    raise
+        result = yield ('call_function', None, 'RMI.Node._call_shipped', [key, kind, payload, defaults, kwdefaults, *params], opts)
+        self._shipped_keys.add(key)
+        return result
+
+    # the key, kind, payload, and default params and keyword-only params to ship for a function, code object or source
+    def _shipped_function(self, f):
+        defaults = None
+        kwdefaults = None
+        if isinstance(f, str):
+            kind = 'source'
+            payload = f
+            digest = f.encode('utf-8')
+        else:
+            if isinstance(f, types.FunctionType):
+                if f.__closure__:
+                    raise(Exception("cannot ship " + f.__name__ + " which uses variables from outside itself: pass them as params"))
+                if f.__defaults__:
+                    defaults = Copy(list(f.__defaults__), deep = False)
+                if f.__kwdefaults__:
+                    kwdefaults = Copy(dict(f.__kwdefaults__), deep = False)
+                f = f.__code__
+            if not isinstance(f, types.CodeType):
+                raise(Exception("cannot ship " + str(f) + ": expected a function, code object or source"))
+            kind = 'code'
+            payload = importlib.util.MAGIC_NUMBER + marshal.dumps(f)
+            digest = payload
+        key = hashlib.sha256(kind.encode('ascii') + b':' + digest).hexdigest()
+        return (key, kind, payload, defaults, kwdefaults)
+
+    # starts getting f(*args), for a caller which will want it after it does something else,
+    # and returns a callable which returns it
+    # this node waits for one response at a time, so the call is only made then
+    def _read_ahead(self, f, *args):
+        return lambda: f(*args)
+
+    def _batch_results(self, received):
+        # the batch result is a list of response types and values, one pair per request
+        results = []
+        response_data = received.message_data
+        for n in range(0, len(response_data), 2):
+            if response_data[n] == 'exception':
+                results.append(Exception([response_data[n+1]]))
+            else:
+                results.append(response_data[n+1])
+        return results
+
+    # a context manager which queues up requests and sends them as one batch on exit
+    def batch(self):
+        return RMI.Batch(self)
+
+    def _new_request_id(self):
+        if not self._tag_requests:
+            return None
+        request_id = self._next_request_id
+        self._next_request_id = request_id + 1
+        return request_id
+
+    # receives messages until the response to the last request arrives,
+    # processing any counter-requests from the other side in the meantime
+    def _receive_response(self, result_type = 'result', request_id = None):
         while True: 
-            received = self._receive()
+            # a request being processed for the other side stops once it has been cancelled
+            if len(self._cancelled_by_peer) and len(self._executing_requests) and self._executing_requests[-1] in self._cancelled_by_peer:
+                raise(Cancelled("request " + str(self._executing_requests[-1]) + " was cancelled"))
+            received = None
+            if len(self._stashed_responses):
+                received = self._stashed_responses.pop(request_id, None)
+            if received == None:
+                received = self._receive()
             if DEBUG_FLAG:
                 print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " received" + str(received))
-            if received.message_type == 'result': 
-                if DEBUG_FLAG:
-                    print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " returning " + str(received.message_data[0]) + "\n")
-                return received.message_data[0]
+            if len(self._cancelled_requests) and received.request_id in self._cancelled_requests and (received.message_type == 'result' or received.message_type == 'batch_result' or received.message_type == 'exception'):
+                # the late response to a request given up on
+                self._cancelled_requests.discard(received.request_id)
+            elif received.request_id != request_id and (received.message_type == result_type or received.message_type == 'exception'):
+                # the response to a request further out, made while that one was waiting on the other side
+                self._stashed_responses[received.request_id] = received
+            elif received.message_type == result_type: 
+                return received
             elif received.message_type == 'close':
-                return
+                return received
+            elif received.message_type == 'release':
+                pass
+            elif received.message_type == 'cancel':
+                self._peer_cancelled(received.message_data)
             elif received.message_type == 'query':
-                self._process_query(received.message_data)
+                self._process_query(received.message_data, received.request_id)
+            elif received.message_type == 'batch':
+                self._process_batch(received.message_data, received.request_id)
             elif received.message_type == 'exception':
                 print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " caught exception " + pp.pformat(received.message_data))
                 raise(Exception(received.message_data))
@@ -95,54 +1226,220 @@ class Node(object):
                 raise(Exception("unexpected message type from RMI message:" % received.message_type))
             
     def receive_request_and_send_response(self):
-        received = self._receive()
-        
+        return self._respond(self._receive())
+
+    # processes a message received from the other side, and sends the response if it needs one
+    def _respond(self, received):
         if received.message_type == 'query':
-            response = self._process_query(received.message_data)
+            response = self._process_query(received.message_data, received.request_id)
+            return [received.message_type, received.message_data, response.message_type, response.message_data]
+        elif received.message_type == 'batch':
+            response = self._process_batch(received.message_data, received.request_id)
             return [received.message_type, received.message_data, response.message_type, response.message_data]
+        elif received.message_type == 'release':
+            # only carried released ids, which _receive has already handled
+            return [received.message_type, received.message_data, None, None]
+        elif received.message_type == 'cancel':
+            # the request has been answered already, and the other side drops the response
+            return [received.message_type, received.message_data, None, None]
+        elif received.request_id in self._cancelled_requests and (received.message_type == 'result' or received.message_type == 'batch_result' or received.message_type == 'exception'):
+            # the late response to a request given up on
+            self._cancelled_requests.discard(received.request_id)
+            return [received.message_type, received.message_data, None, None]
         elif received.message_type == 'close': 
             return;
         else:
             raise(Exception("Unexpected message type " % received.message_type % '!  message_data was:' % pp.pformat(received.message_data)))
         
+    # what this node's object tables hold, to find which remote references are keeping memory in use:
+    #   sent_objects, sent_by_class: the objects the other side has proxies for, which this side keeps alive
+    #   sent_bytes: roughly the memory those hold: each object with its attributes, or its items if it is a
+    #     container, but not what those refer to in turn
+    #   proxies, proxies_by_class: the live proxies for objects on the other side, by their remote class
+    #   remote_classes, remote_methods: what has been learned about the other side's classes
+    #   releases_queued, stashed_responses: releases not yet sent, and responses not yet picked up
+    #   growth: the change in each of the counts since the last call, by class as 'sent_by_class.<class>'
+    #     and 'proxies_by_class.<class>', leaving out those which have not changed
+    #   stats = c.object_stats()
+    #   stats['sent_by_class']['mymodule.Row']
+    # see RMI.object_stats for the tables all nodes share, and remote_object_stats for the other side's
+    def object_stats(self):
+        sent_by_class = collections.Counter()
+        sent_bytes = 0
+        for o in list(self._sent_objects.values()):
+            sent_by_class[type(o).__module__ + '.' + type(o).__qualname__] += 1
+            sent_bytes = sent_bytes + Node._approximate_size(o)
+        proxies_by_class = collections.Counter()
+        for remote_id in list(self._received_objects.keys()):
+            proxies_by_class[str(self._id_to_class(remote_id))] += 1
+        stats = {
+            'sent_objects': len(self._sent_objects),
+            'sent_by_class': dict(sent_by_class),
+            'sent_bytes': sent_bytes,
+            'proxies': sum(proxies_by_class.values()),
+            'proxies_by_class': dict(proxies_by_class),
+            'remote_classes': len(self._remote_classes),
+            'remote_methods': len(self._remote_methods),
+            'releases_queued': len(self._received_and_destroyed_ids),
+            'stashed_responses': len(self._stashed_responses),
+        }
+        stats['growth'] = self._object_growth(stats)
+        return stats
+
+    # object_stats of the other side's node for this connection, and RMI.object_stats of its process,
+    # as { 'node': ..., 'process': ... }
+    def remote_object_stats(self):
+        return self.send_request_and_receive_response('call_function', None, 'RMI.Node._object_stats', [])
+
+    def _object_growth(self, stats):
+        counts = {}
+        for (name, v) in stats.items():
+            if isinstance(v, dict):
+                for (c, n) in v.items():
+                    counts[name + '.' + c] = n
+            else:
+                counts[name] = v
+        last = self._last_object_counts
+        self._last_object_counts = counts
+        growth = {}
+        for name in counts.keys() | last.keys():
+            change = counts.get(name, 0) - last.get(name, 0)
+            if change:
+                growth[name] = change
+        return growth
+
+    # sends any queued releases of proxies which have been garbage collected,
+    # when there is no other message for them to ride on
+    def flush_releases(self):
+        if len(self._received_and_destroyed_ids) and self.writer != None:
+            self._send(Message('release', None))
+            return True
+        return False
+
+    # called when a proxy from this node is garbage collected
+    def _proxy_destroyed(self, remote_id, proxy_id):
+        node_for_object.pop(proxy_id, None)
+        remote_id_for_object.pop(proxy_id, None)
+        count = self._received_counts.pop(remote_id, 0)
+        if count:
+            # the other side sends the class again with the handle, if it sends the object again
+            self._remote_classes.pop(remote_id, None)
+            self._received_and_destroyed_ids.append((remote_id, count))
+            self._release_queued()
+
+    # a plain node has no way to send on its own, so releases wait for the next message or flush_releases()
+    def _release_queued(self):
+        pass
 
     def _send(self, message):
-        s = self._serialize(message);
-        if (DEBUG_FLAG):
-            print(DEBUG_MSG_PREFIX + 'N: ' + str(os.getpid()) + " sending: >" + s + "<\n")
-        self.writer.write(s)
-        self.writer.write("\n")
-        self.writer.flush()
+        if self.writer == None:
+            raise(Closed("node is closed"))
+        metrics = self.metrics
+        if metrics != None:
+            started = time.perf_counter()
+        parts = self._serialize(message);
+        if metrics != None:
+            encoded = time.perf_counter()
+        size = 0
+        try:
+            for part in parts:
+                if (DEBUG_FLAG):
+                    print(DEBUG_MSG_PREFIX + 'N: ' + str(os.getpid()) + " sending: >" + pp.pformat(part) + "<\n")
+                self.writer.write(part)
+                if metrics != None:
+                    size = size + (part.nbytes if isinstance(part, memoryview) else len(part))
+            self.writer.flush()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            self.is_closed = 1
+            raise(Closed("connection closed: " + str(e)))
+        if metrics != None:
+            metrics.sent(message.message_type, size, started, encoded, time.perf_counter())
         return True
 
     def _receive(self):
         if (DEBUG_FLAG):
             print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " receiving\n")
 
-        serialized_blob = None
-        try:
-            serialized_blob = self.reader.readline()
-        except:
-            if (DEBUG_FLAG):
-                print(DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " read failure: >\n")
+        metrics = self.metrics
+        if metrics != None:
+            started = time.perf_counter()
 
-        if (serialized_blob == None):
-            # a failure to get data returns a message type of 'close', and undefined message_data
-            if (DEBUG_FLAG):
-                print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " connection closed\n")
-            self.is_closed = 1
-            return(Message('close',undef));
+        # a message sent as a series of frames is read frame by frame until the last
+        message = None
+        size = 0
+        got_first = None
+        while message == None:
+            serialized_blob = None
+            if self._deadline != None:
+                self._wait_for_input(self._deadline)
+            try:
+                # the first byte identifies the serialization protocol, which knows how to read the rest of the frame
+                first = self.reader.read(1)
+                if metrics != None and got_first == None:
+                    got_first = time.perf_counter()
+                if first:
+                    try:
+                        serializer = serializers_by_sym[first]
+                    except KeyError:
+                        raise(Exception("Got message with unknown protocol byte " + pp.pformat(first)))
+                    serialized_blob = serializer.read_frame(first, self.reader)
+            except OSError:
+                if (DEBUG_FLAG):
+                    print(DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " read failure: >\n")
 
-        if (DEBUG_FLAG):
-            print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " got >" + serialized_blob + "<\n")
             if not serialized_blob:
-                print("\n")
+                # a failure to get data returns a message type of 'close', and undefined message_data
+                if (DEBUG_FLAG):
+                    print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " connection closed\n")
+                self.is_closed = 1
+                return(Message('close',None));
+
+            if (DEBUG_FLAG):
+                print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " got >" + pp.pformat(serialized_blob) + "<\n")
 
-        message = self._deserialize(serialized_blob);
+            size = size + len(serialized_blob)
+            if metrics != None:
+                read = time.perf_counter()
+            message = self._deserialize(serialized_blob);
+        if metrics != None:
+            metrics.received(message.message_type, size, started, got_first, read, time.perf_counter())
         return (message);
 
+    # waits until there is something to read, or raises RMI.Timeout once the deadline passes
+    # a frame which has started arriving is read to the end regardless, so the stream stays in step
+    def _wait_for_input(self, deadline):
+        reader = self.reader
+        try:
+            fd = reader.fileno()
+        except (AttributeError, OSError, ValueError):
+            return
+        while not self._has_buffered(reader, fd):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise(Timeout("timed out waiting for a response"))
+            (readable, ignored1, ignored2) = select.select([fd], [], [], remaining)
+            if readable:
+                return
+
+    # whether a buffered reader has data in its buffer, which select() doesn't see
+    def _has_buffered(self, reader, fd):
+        peek = getattr(reader, 'peek', None)
+        if peek == None:
+            return False
+        blocking = os.get_blocking(fd)
+        os.set_blocking(fd, False)
+        try:
+            return len(peek(1)) > 0
+        except OSError:
+            return False
+        finally:
+            os.set_blocking(fd, blocking)
+
     def get_dispatcher(self,l):
-        # TODO: cache these
+        try:
+            return dispatchers[l]
+        except KeyError:
+            pass
         s = 'lambda f,a: f('
         for n in range(0,l):
             s = s + 'a[' + str(n) + ']'
@@ -153,31 +1450,74 @@ class Node(object):
         s = s + ')'
         #print('s: ' + s)
         f = eval(s)
+        dispatchers[l] = f
         return(f)
         
     def testme(a=111,b=222):
         print("hi")
         return(a+b)
 
-    def _process_query(self,message_data):
-        method = message_data.pop(0)
-        wantarray = message_data.pop(0)
-        object = message_data.pop(0)
-        nparams = message_data.pop(0)
+    def _process_query(self,message_data,request_id=None):
+        self._executing_requests.append(request_id)
+        try:
+            message = self._execute_query(message_data)
+        finally:
+            self._executing_requests.pop()
+            self._cancelled_by_peer.discard(request_id)
+        message.request_id = request_id
+        self._send(message)
+        return(message)
+
+    def _process_batch(self,message_data,request_id=None):
+        # the queries are laid out back-to-back, and each execution consumes its own part of the list
+        message_data = iter(message_data)
+        nqueries = next(message_data)
+        results = []
+        self._executing_requests.append(request_id)
+        try:
+            for n in range(0,nqueries):
+                if request_id in self._cancelled_by_peer:
+                    # the rest are dropped, along with the response
+                    break
+                response = self._execute_query(message_data)
+                results.append(response.message_type)
+                results.append(response.message_data)
+        finally:
+            self._executing_requests.pop()
+            self._cancelled_by_peer.discard(request_id)
+        
+        message = Message('batch_result', results, request_id)
+        self._send(message)
+        return(message)
+
+    # notes which of the requests being processed the other side has cancelled
+    # the others have been answered already
+    def _peer_cancelled(self, request_ids):
+        for request_id in request_ids:
+            if request_id in self._executing_requests:
+                self._cancelled_by_peer.add(request_id)
+
+    # executes the query at the start of message_data, a list or an iterator over one, which it advances past
+    # the query, and returns the response message without sending it
+    def _execute_query(self,message_data):
+        message_data = iter(message_data)
+        method = next(message_data)
+        wantarray = next(message_data)
+        object = next(message_data)
+        nparams = next(message_data)
         
         DEBUG_FLAG=0
-        params = []
-        processed = 0
-        while processed < nparams:
-            x = message_data.pop(0)
-            params.append(x)
-            processed = processed + 1
+        params = list(itertools.islice(message_data, nparams))
         
         if DEBUG_FLAG:
             print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " unserialized method/wantarray/object/params:" + method + '/' + str(wantarray) + '/' + str(object) + '/' + str(params))
         
         executing_nodes.append(self)
 
+        metrics = self.metrics
+        if metrics != None:
+            started = time.perf_counter()
+
         return_type = None
         return_data = None
         try:
@@ -188,11 +1528,7 @@ class Node(object):
                 if DEBUG_FLAG:
                     print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " call " + method + " on " + str(object) + " gets result " + str(method_ref)) 
             else:
-                pos = method.find('.')
-                if pos != -1:
-                    pkg = method[:pos]
-                    exec('import ' + pkg)
-                method_ref = eval(method)
+                method_ref = resolved_callables.resolve(method)
                 
                 if DEBUG_FLAG:
                     print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " call " + method + " gets ref" + str(method_ref) + "\n") 
@@ -214,7 +1550,9 @@ class Node(object):
             if (DEBUG_FLAG):
                 print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " executed with result (unserialized): " + pp.pformat(return_data) + "\n")
         
-        executing_nodes.pop
+        if metrics != None:
+            metrics.executed(method, return_type, len(executing_nodes), started)
+        executing_nodes.pop()
         
         DEBUG_FLAG=0
 
@@ -223,10 +1561,7 @@ class Node(object):
         object = None;
         params = None;
         
-        message = Message(return_type, return_data)
-        
-        self._send(message)
-        return(message)
+        return Message(return_type, return_data)
         
     def _is_primitive(self,v):
         if (v == None):
@@ -240,13 +1575,25 @@ class Node(object):
         else:
             return False
         
+    # returns the handle for a local object, and whether it is new, assigning one if needed
     def _object_to_id(self,o):
-        return(str(o))
+        try:
+            return (self._handle_for_object[id(o)], False)
+        except KeyError:
+            pass
+        handle = self._next_handle
+        self._next_handle = handle + 1
+        self._handle_for_object[id(o)] = handle
+        self._sent_objects[handle] = o
+        return (handle, True)
         
     def _id_to_class(self,id):
-        # my ($remote_class,$remote_shape) = ($value =~ /^(.*?=|)(.*?)\(/);
-        # chop $remote_class;
-        return(id[ 1 : (id.find(' object at ')-1) ])
+        if isinstance(id,str):
+            # an id from a peer which identifies objects by their stringification, like Perl
+            # my ($remote_class,$remote_shape) = ($value =~ /^(.*?=|)(.*?)\(/);
+            # chop $remote_class;
+            return(id[ 1 : (id.find(' object at ')-1) ])
+        return self._remote_classes.get(id)
     
     def _id_to_shape(self,id):
         return('unspecified')
@@ -271,51 +1618,175 @@ class Node(object):
     def _exec(s):
         return exec(s)
    
+    # appends the kind and value(s) for one item of message data to the serialized list
+    def _encode_value(self,o,serialized):
+        if self._is_primitive(o):
+            serialized.append(0)
+            serialized.append(o);
+        elif isinstance(o,(bytes,bytearray,memoryview)):
+            self._encode_buffer(o, serialized)
+        elif isinstance(o,Copy):
+            self._encode_copy(o.value, serialized, o.deep)
+        elif type(o) in self.copy_types:
+            self._encode_copy(o, serialized)
+        elif isinstance(o,ProxyObject) or self._class_is_proxied(type(o)):
+            # sending back a proxy, the remote side will convert back to the original value
+            key = None
+            try:
+                key = remote_id_for_object[id(o)];
+            except KeyError: 
+                raise(Exception("no id found for object " + str(o) + '?'))
+                
+            if DEBUG_FLAG:
+                print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " proxy " + pp.pformat(o) + " references remote " + str(key) + "\n")
+            serialized.append(3)
+            serialized.append(key)
+        
+        else:
+            # sending an object local to this side, the remote side will convert to a proxy
+            (handle, is_new) = self._object_to_id(o)
+            
+            #if self.allow_packages:
+            #    if not self.allowed[type(o)]:
+            #        raise(Exception("objects of type " + str(type(o)) + " cannot be passed from this RMI node!"))
+            
+            self._sent_counts[handle] = self._sent_counts.get(handle, 0) + 1
+            if is_new:
+                # the first time, the class name goes along with the handle
+                serialized.append(4)
+                serialized.append(handle)
+                serialized.append(type(o).__module__ + '.' + type(o).__qualname__)
+            else:
+                serialized.append(1)
+                serialized.append(handle)
+
+    # a value passed by copy is kind 5, then its shape, then its parts
+    # containers are copied all the way down, but other objects inside them are encoded
+    # as usual, so they still arrive as proxies unless their type is copied too
+    def _encode_copy(self,v,serialized,deep = True):
+        if self._is_primitive(v):
+            serialized.append(0)
+            serialized.append(v)
+        elif isinstance(v,(list,tuple,set,frozenset)):
+            shape = shape_for_copied_type.get(type(v))
+            if shape == None:
+                # a subclass, such as a namedtuple, arrives as the container it is made from
+                shape = next(name for name in ('list', 'tuple', 'set', 'frozenset') if isinstance(v, copied_shapes[name]))
+            serialized.append(5)
+            serialized.append(shape)
+            serialized.append(len(v))
+            for x in v:
+                self._encode_copied_item(x, serialized, deep)
+        elif isinstance(v,dict):
+            serialized.append(5)
+            serialized.append('dict')
+            serialized.append(len(v))
+            for (k,x) in v.items():
+                self._encode_copied_item(k, serialized, deep)
+                self._encode_copied_item(x, serialized, deep)
+        elif isinstance(v,(bytes,bytearray,memoryview)):
+            self._encode_buffer(v, serialized)
+        elif isinstance(v,ProxyObject):
+            self._encode_value(v, serialized)
+        elif hasattr(v,'__dict__') or len(_slot_names(type(v))):
+            # any other object is rebuilt from its class and its attributes, in its __dict__ and its __slots__
+            # the class goes as its module and its name within the module
+            serialized.append(5)
+            serialized.append('object')
+            serialized.append(type(v).__module__)
+            serialized.append(type(v).__qualname__)
+            state = dict(getattr(v, '__dict__', {}))
+            for name in _slot_names(type(v)):
+                if hasattr(v, name):
+                    state[name] = getattr(v, name)
+            self._encode_copy(state, serialized, deep)
+        else:
+            # an object without attributes of its own, such as a Decimal, is rebuilt by calling its class with
+            # the arguments it gives to pickle, so long as it is rebuilt that way and by nothing else
+            try:
+                reduced = v.__reduce_ex__(4)
+            except (AttributeError, TypeError):
+                reduced = None
+            if not isinstance(reduced, tuple) or len(reduced) != 2 or reduced[0] is not type(v):
+                raise(Exception("cannot copy " + str(type(v)) + ": it has no __dict__ or __slots__, and pickles with more than its class and arguments"))
+            serialized.append(5)
+            serialized.append('instance')
+            serialized.append(type(v).__module__)
+            serialized.append(type(v).__qualname__)
+            self._encode_copy(list(reduced[1]), serialized, deep)
+
+    # bytes, bytearrays and memoryviews are passed by value, as kind 5 with the bytes in the message,
+    # or when large, as kind 6 with the index of a buffer written raw after the message, which the
+    # other side reads into a buffer of its own without unpacking it from the message
+    # a memoryview arrives as a view of bytes, whatever its format
+    def _encode_buffer(self,v,serialized):
+        if isinstance(v,memoryview):
+            shape = 'memoryview'
+        else:
+            shape = shape_for_copied_type.get(type(v), 'bytes')
+        view = memoryview(v)
+        if self._peer_out_of_band and self.out_of_band_threshold != None and view.nbytes >= self.out_of_band_threshold and self._outgoing_buffers != None:
+            if not view.contiguous:
+                view = memoryview(view.tobytes())
+            serialized.append(6)
+            serialized.append(len(self._outgoing_buffers))
+            self._outgoing_buffers.append((shape, view.cast('B')))
+        else:
+            serialized.append(5)
+            serialized.append(shape)
+            serialized.append(v if type(v) is bytes else view.tobytes())
+
+    def _encode_copied_item(self,x,serialized,deep):
+        if deep and isinstance(x,(list,tuple,set,frozenset,dict)):
+            self._encode_copy(x, serialized)
+        else:
+            self._encode_value(x, serialized)
+
     def _serialize(self,message):
         sent_objects = self._sent_objects
        
         #print('serializing: ' + pp.pformat(message) + "\n")
  
-        serialized = [ message.message_type, self._received_and_destroyed_ids ]
-        self._received_and_destroyed_ids = []
+        serialized = []
+
+        # a tagged message goes out with a 't:' prefix on its type, and its request id first
+        message_type = message.message_type
+        if message.request_id != None:
+            message_type = 't:' + message_type
+            serialized.append(0)
+            serialized.append(message.request_id)
        
         targets = None
-        if message.message_type == 'query':
+        if message.message_type == 'query' or message.message_type == 'batch' or message.message_type == 'batch_result':
             targets = message.message_data
         else:
             targets = [message.message_data]
  
-        for o in targets:
-            if self._is_primitive(o):
-                serialized.append(0)
-                serialized.append(o);
-            else:
-                if isinstance(o,ProxyObject) or self._class_is_proxied(type(o)):
-                    # sending back a proxy, the remote side will convert back to the original value
-                    key = None
-                    try:
-                        local_id = self._object_to_id(o)
-                        key = remote_id_for_object[local_id];
-                    except: 
-                        raise(Exception("no id found for object " + str(o) + '?'))
-                        
-                    if DEBUG_FLAG:
-                        print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " proxy " + pp.pformat(o) + " references remote " + str(key) + "\n")
-                    serialized.append(3)
-                    serialized.append(key)
-                
-                else:
-                    # sending an object local to this side, the remote side will convert to 
-                    # TODO: use something better than stringification since this can be overridden!!!
-                    id = self._object_to_id(o)
-                    
-                    #if self.allow_packages:
-                    #    if not self.allowed[type(o)]:
-                    #        raise(Exception("objects of type " + str(type(o)) + " cannot be passed from this RMI node!"))
-                    
-                    serialized.append(1)
-                    serialized.append(id)
-                    sent_objects[id] = o;
+        self._outgoing_buffers = []
+        try:
+            for o in targets:
+                self._encode_value(o, serialized)
+            buffers = self._outgoing_buffers
+        finally:
+            self._outgoing_buffers = None
+
+        # released ids go out as pairs of remote id and count, once the message is sure to go out,
+        # so a value which cannot be encoded leaves them for the next message
+        received_and_destroyed_ids = []
+        queue = self._received_and_destroyed_ids
+        while len(queue):
+            (remote_id, count) = queue.popleft()
+            received_and_destroyed_ids.append(remote_id)
+            received_and_destroyed_ids.append(count)
+
+        # a message with out-of-band buffers goes out with an 'o:' prefix on its type,
+        # and a count of the buffers and the shape and size of each first
+        if len(buffers):
+            message_type = 'o:' + message_type
+            header = [0, len(buffers)]
+            for (shape, view) in buffers:
+                header.extend([0, shape, 0, view.nbytes])
+            serialized[0:0] = header
 
         if DEBUG_FLAG:
             print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " $message_type translated for serialization to @serialized\n")
@@ -325,108 +1796,287 @@ class Node(object):
         if DEBUG_FLAG:
             print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " destroyed proxies: @$received_and_destroyed_ids\n")        
        
-        serialized_blob = pp.pformat(serialized)
-        serialized_blob.replace("\n",' ') 
-        #print('BLOB:' + serialized_blob)
-        
-        if DEBUG_FLAG:
-            print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " " + str(message.message_type) + " serialized as " + serialized_blob)
-        
-        if serialized_blob.find('\n') != -1:
-            raise(Exception("newline found in message data!"))
-            pass
+        if self.max_frame_size != None:
+            return self._frames(message_type, received_and_destroyed_ids, serialized, buffers)
 
-        return serialized_blob
+        serialized_blob = self._frame(message_type, received_and_destroyed_ids, serialized)
         
-    def _deserialize(self,serialized_blob):
         if DEBUG_FLAG:
-            print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " processing (serialized): " + pp.pformat(serialized_blob))
-        
-        serialized = eval(serialized_blob)
-        message_type = serialized.pop(0)
-        if message_type == None:
-            raise(Exception("unexpected undef type from incoming message: " + serialized_blob))
+            print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " " + str(message.message_type) + " serialized as " + pp.pformat(serialized_blob))
+
+        parts = [serialized_blob]
+        for (shape, view) in buffers:
+            parts.append(view)
+        return parts
 
-        received_and_destroyed_ids  = serialized.pop(0)
+    # the values of a message split across frames of about max_frame_size bytes, each serialized as it is
+    # written, so a huge message is never held as one blob
+    # every frame but the last has the type 'continued', and the last has the real type and the released ids
+    # a single value larger than a frame gets a frame of its own
+    def _frames(self, message_type, received_and_destroyed_ids, serialized, buffers):
+        max_frame_size = self.max_frame_size
+        start = 0
+        size = 0
+        for n in range(len(serialized)):
+            v = serialized[n]
+            size = size + (len(v) + 8 if isinstance(v, (str, bytes)) else 8)
+            if size >= max_frame_size and n + 1 < len(serialized):
+                yield self._frame('continued', [], serialized[start:n+1])
+                start = n + 1
+                size = 0
+        yield self._frame(message_type, received_and_destroyed_ids, serialized[start:])
+        for (shape, view) in buffers:
+            yield view
 
+    # one frame, compressed if it is large enough and the other side can read it
+    def _frame(self, message_type, received_and_destroyed_ids, serialized):
+        serialized_blob = self._serializer.serialize(message_type, received_and_destroyed_ids, serialized)
+
+        compression = self.compression
+        if compression != None and len(serialized_blob) >= self.compression_threshold and compression in self._peer_compression:
+            compressed = compressed_frames.compress(compression, self.compression_level, serialized_blob)
+            # incompressible data goes as it is
+            if len(compressed) < len(serialized_blob):
+                if self.metrics != None:
+                    self.metrics.count('frames_compressed')
+                    self.metrics.count('bytes_saved_by_compression', len(serialized_blob) - len(compressed))
+                serialized_blob = compressed
+        return serialized_blob
+        
+    # removes the kind and value(s) for one item of message data from the serialized list, and returns the item
+    # the list is in reverse order, so each value is popped from its end, which takes constant time
+    def _decode_value(self,serialized):
         sent_objects                = self._sent_objects
         received_objects            = self._received_objects
+        received_counts             = self._received_counts
+
+        vtype = serialized.pop()
         
-        message_data = []
-        while (len(serialized)):
-            vtype = serialized.pop(0)
+        if DEBUG_FLAG:
+            print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " processing item: " + str(vtype))
+
+        if (vtype == 0):
+            # primitive value
+            value = serialized.pop()
+            if DEBUG_FLAG:
+                print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " - primitive " + str(value) + "\n")
+            return value
+            
+        elif (vtype == 1 or vtype == 2 or vtype == 4):
+            # an object exists on the other side: make a proxy unless we already have one
+            # note that type 2 is for Perl non-object references, which Python doesn't ever generate, but may receive
+            # type 4 is the first time a handle is sent, and is followed by the class name
+            remote_id = serialized.pop()
+            if vtype == 4:
+                self._remote_classes[remote_id] = serialized.pop()
+            received_counts[remote_id] = received_counts.get(remote_id, 0) + 1
+            o = None
+            try:
+                o = received_objects[remote_id]
+            except KeyError:
+                # no proxy for this id yet...
+                remote_class = self._id_to_class(remote_id)
+                remote_shape = self._id_to_shape(remote_id)
+                
+                if remote_shape == 'ARRAY':
+                    o = ProxyObject(self,remote_id)
+                elif remote_shape == 'HASH':
+                    o = ProxyObject(self,remote_id)
+                elif remote_shape == 'CODE':
+                    o = lambda params: self.send_request_and_receive_response('call_coderef', None, 'RMI.Node._exec_coderef', [remote_id, params])
+                else:
+                    o = ProxyObject(self,remote_id)
+
+                # this is a weak ref: when the proxy goes away, the finalizer queues a release for the other side
+                received_objects[remote_id] = o
+                node_for_object[id(o)] = self;
+                remote_id_for_object[id(o)] = remote_id;
+                finalizer = weakref.finalize(o, self._proxy_destroyed, remote_id, id(o))
+                finalizer.atexit = False
             
             if DEBUG_FLAG:
-                print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " processing item: " + str(vtype))
+                print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " - made proxy for " + str(remote_id)  + "\n")
+            return o
+        
+        elif (vtype == 3):
+            # exists on this side, and was a proxy on the other side: get the real reference by id
+            local_id = serialized.pop()
+            try:
+                o = sent_objects[local_id] 
+            except:
+                print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " reconstituting local object $value, but not found in my sent objects!\n")
+                raise
+            if DEBUG_FLAG:
+                print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " - resolved local object " + str(o) + " for value " + str(local_id))
+            return o
 
-            if (vtype == 0):
-                # primitive value
-                value = serialized.pop(0)
-                if DEBUG_FLAG:
-                    print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " - primitive " + str(value) + "\n")
-                message_data.append(value)
-                
-            elif (vtype == 1 or vtype == 2):
-                # an object exists on the other side: make a proxy unless we already have one
-                # note that type 2 is for Perl non-object references, which Python doesn't ever generate, but may receive
-                remote_id = serialized.pop(0)
-                o = None
-                try:
-                    o = received_objects[remote_id]
-                    message_data.append(o)
-                except KeyError:
-                    # no proxy for this id yet...
-                    remote_class = self._id_to_class(remote_id)
-                    remote_shape = self._id_to_shape(remote_id)
-                    
-                    if remote_shape == 'ARRAY':
-                        o = ProxyObject(self,remote_id)
-                    elif remote_shape == 'HASH':
-                        o = ProxyObject(self,remote_id)
-                    elif remote_shape == 'CODE':
-                        o = lambda params: self.send_request_and_receive_response('call_coderef', None, 'RMI.Node._exec_coderef', [remote_id, params])
+        elif (vtype == 5):
+            # a copy of a value on the other side
+            shape = serialized.pop()
+            if shape == 'dict':
+                n = serialized.pop()
+                value = {}
+                for i in range(n):
+                    k = self._decode_value(serialized)
+                    value[k] = self._decode_value(serialized)
+                return value
+            elif shape == 'bytes' or shape == 'bytearray':
+                return copied_shapes[shape](serialized.pop())
+            elif shape == 'memoryview':
+                return memoryview(bytearray(serialized.pop()))
+            elif shape == 'object':
+                cls = self._copied_class(serialized.pop(), serialized.pop())
+                value = cls.__new__(cls)
+                state = self._decode_value(serialized)
+                slots = _slot_names(cls)
+                attributes = getattr(value, '__dict__', None)
+                for (name, x) in state.items():
+                    if attributes != None and name not in slots:
+                        attributes[name] = x
                     else:
-                        o = ProxyObject(self,remote_id)
-                   
-                    message_data.append(o)
-
-                    # TODO: make sure this is actually a weak ref
-                    received_objects[remote_id] = o
-                    local_id = self._object_to_id(o)
-                    node_for_object[local_id] = self;
-                    remote_id_for_object[local_id] = remote_id;
-                
-                if DEBUG_FLAG:
-                    print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " - made proxy for " + remote_id  + "\n")
-            
-            elif (vtype == 3):
-                # exists on this side, and was a proxy on the other side: get the real reference by id
-                local_id = serialized.pop(0)
-                try:
-                    o = sent_objects[local_id] 
-                except:
-                    print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " reconstituting local object $value, but not found in my sent objects!\n")
-                    raise
-                message_data.append(o)
-                if DEBUG_FLAG:
-                    print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " - resolved local object " + str(o) + " for value " + local_id)
+                        object.__setattr__(value, name, x)
+                return value
+            elif shape == 'instance':
+                cls = self._copied_class(serialized.pop(), serialized.pop())
+                return cls(*self._decode_value(serialized))
             else:
-                raise(Exception("Unknown type in serialized data!"))        
+                n = serialized.pop()
+                items = []
+                for i in range(n):
+                    items.append(self._decode_value(serialized))
+                if shape == 'list':
+                    return items
+                return copied_shapes[shape](items)
+
+        elif (vtype == 6):
+            # a buffer which came after the message
+            return self._incoming_buffers[serialized.pop()]
+
+        else:
+            raise(Exception("Unknown type in serialized data!"))        
+
+    # the class of a copied object, found by importing its module and looking up its name there,
+    # so nothing the other side sends is evaluated
+    def _copied_class(self, module_name, qualname):
+        try:
+            cls = importlib.import_module(module_name)
+            for name in qualname.split('.'):
+                cls = getattr(cls, name)
+        except (ImportError, AttributeError) as e:
+            raise(Exception("cannot find the class " + module_name + '.' + qualname + " of a copied object: " + str(e)))
+        if not isinstance(cls, type):
+            raise(Exception(module_name + '.' + qualname + " is not a class"))
+        return cls
+
+    # the message, or None for a frame of a message which more frames follow
+    def _deserialize(self,serialized_blob):
+        parsed = self._parse(serialized_blob)
+        if parsed == None:
+            return None
+        return self._decode_message(parsed, self._read_buffers(parsed[3]))
+
+    # unpacks a message, and the shape and size of each out-of-band buffer which follows it on the stream
+    def _parse(self,serialized_blob):
+        if DEBUG_FLAG:
+            print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " processing (serialized): " + pp.pformat(serialized_blob))
+        
+        serializer = serializers_by_sym[bytes(serialized_blob[0:1])]
+        (message_type, received_and_destroyed_ids, serialized) = serializer.deserialize(serialized_blob)
+        if message_type == None:
+            raise(Exception("unexpected undef type from incoming message: " + pp.pformat(serialized_blob)))
+
+        # the frames before the last of a message sent as a series of frames
+        if message_type == 'continued':
+            if self._continued_values == None:
+                self._continued_values = serialized
+            else:
+                self._continued_values.extend(serialized)
+            return None
+        if self._continued_values != None:
+            self._continued_values.extend(serialized)
+            serialized = self._continued_values
+            self._continued_values = None
+
+        buffer_sizes = []
+        if message_type.startswith('o:'):
+            message_type = message_type[2:]
+            count = serialized[1]
+            for n in range(count):
+                buffer_sizes.append((serialized[4*n + 3], serialized[4*n + 5]))
+            del serialized[0 : 2 + 4*count]
+        return (message_type, received_and_destroyed_ids, serialized, buffer_sizes)
+
+    # reads the out-of-band buffers of a message straight into buffers of their own
+    def _read_buffers(self,buffer_sizes):
+        buffers = []
+        for (shape, size) in buffer_sizes:
+            if shape == 'bytes':
+                # a buffered reader reads a large block straight into the bytes it returns
+                buffer = self.reader.read(size)
+                if len(buffer) != size:
+                    raise(Exception("truncated out-of-band buffer!"))
+            else:
+                buffer = bytearray(size)
+                view = memoryview(buffer)
+                got = 0
+                while got < size:
+                    n = self.reader.readinto(view[got:])
+                    if not n:
+                        raise(Exception("truncated out-of-band buffer!"))
+                    got = got + n
+                if shape == 'memoryview':
+                    buffer = view
+            buffers.append(buffer)
+        return buffers
+
+    def _decode_message(self,parsed,buffers):
+        (message_type, received_and_destroyed_ids, serialized, buffer_sizes) = parsed
+
+        sent_objects                = self._sent_objects
+        
+        message_data = []
+        self._incoming_buffers = buffers
+        serialized.reverse()
+        try:
+            while (len(serialized)):
+                message_data.append(self._decode_value(serialized))
+        finally:
+            self._incoming_buffers = None
+            # the releases ride along with the message, and are applied even if its values cannot be decoded
+            self._apply_releases(received_and_destroyed_ids)
+
+        request_id = None
+        if message_type.startswith('t:'):
+            message_type = message_type[2:]
+            request_id = message_data.pop(0)
+            # once the other side tags its messages we tag ours, so it can match up our requests too
+            self._tag_requests = True
+
+        return(Message(message_type,message_data,request_id))
+
+    def _apply_releases(self, received_and_destroyed_ids):
+        sent_objects = self._sent_objects
 
         if DEBUG_FLAG:
             print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " remote side destroyed: @$received_and_destroyed_ids\n")
 
         missing = []
-        for id in received_and_destroyed_ids:
-            found = sent_objects[id]
-            if found:
-                del sent_objects[id]
+        sent_counts = self._sent_counts
+        for n in range(0, len(received_and_destroyed_ids), 2):
+            handle = received_and_destroyed_ids[n]
+            remaining = sent_counts.get(handle, 0) - received_and_destroyed_ids[n+1]
+            if remaining > 0:
+                # sent again since the proxy being released was made: a newer proxy still needs it
+                sent_counts[handle] = remaining
+                continue
+            sent_counts.pop(handle, None)
+            found = sent_objects.pop(handle, None)
+            if found is not None:
+                self._handle_for_object.pop(id(found), None)
             else:
-                missing.append(id)
+                missing.append(handle)
         if len(missing) > 0:
-            print("Some IDS not found in the sent list: done: @done, expected: @$received_and_destroyed_ids\n")
-        
-        return(Message(message_type,message_data))
+            print("Some IDS not found in the sent list: " + str(missing) + ", expected: " + str(received_and_destroyed_ids) + "\n")
         
     def _exec_coderef(code,args):
         return code(*args)
@@ -443,22 +2093,146 @@ class Node(object):
     def bind_local_class_to_remote():
         raise(Exception(__LINE__))
     
-    def _remote_has_ref():
-        raise(Exception(__LINE__))
+    # the value of an attribute of a proxy, or a stub which calls it in one request if it is a method
+    # the first access to each name for a remote class asks both questions in one batch
+    def _proxy_attribute(self,proxy,attr):
+        remote_class = self._id_to_class(remote_id_for_object.get(id(proxy)))
+        if remote_class != None:
+            key = (remote_class, attr)
+            is_method = self._remote_methods.get(key)
+            if is_method:
+                return RMI.ProxyMethod(proxy, attr)
+            if is_method == None:
+                results = self.send_requests_and_receive_responses([
+                    ['call_function', None, 'RMI.Node._is_method', [proxy, attr]],
+                    ['call_function', None, 'getattr', [proxy, attr]],
+                ])
+                if isinstance(results[1], Exception):
+                    raise(results[1])
+                self._remote_methods[key] = (results[0] is True)
+                if results[0] is True:
+                    return RMI.ProxyMethod(proxy, attr)
+                return results[1]
+        return self.send_request_and_receive_response('call_function', None, 'getattr', [proxy, attr])
+
+    # the length of a proxied object, or a TypeError for one without a length, as for a local object
+    # special methods are found on the class, so a remote class without a length is remembered
+    def _proxy_len(self,proxy):
+        remote_class = self._id_to_class(remote_id_for_object.get(id(proxy)))
+        key = (remote_class, '__len__')
+        if remote_class == None or self._remote_methods.get(key) != False:
+            n = self.send_request_and_receive_response('call_function', None, 'RMI.Node._len', [proxy])
+            if n != None:
+                return n
+            if remote_class != None:
+                self._remote_methods[key] = False
+        raise TypeError("remote object has no len()")
+
+    def _proxy_iterator(self,proxy):
+        return RMI.ProxyIterator(proxy)
+
+    # whether the other side has a proxy for this local object
+    def _remote_has_ref(self,obj):
+        handle = self._handle_for_object.get(id(obj))
+        if handle == None:
+            return False
+        return self.send_request_and_receive_response('call_function', None, 'RMI.Node._has_received', [handle])
         '''
         my ($self,$obj) = @_;
         my $id = "$obj";
         my $has_sent = $self->send_request_and_receive_response('call_eval', undef, "RMI::Server::_receive_eval", ['exists $RMI::executing_nodes[-1]->{_received_objects}{"' . $id . '"}']);
         '''
         
-    def _remote_has_sent():
-        raise(Exception(__LINE__))
+    # whether the other side still holds the object behind this proxy for us
+    def _remote_has_sent(self,obj):
+        remote_id = remote_id_for_object.get(id(obj))
+        if remote_id == None:
+            return False
+        return self.send_request_and_receive_response('call_function', None, 'RMI.Node._has_sent', [remote_id])
         '''
         my ($self,$obj) = @_;
         my $id = "$obj";
         my $has_sent = $self->send_request_and_receive_response('call_eval', undef, "RMI::Server::_receive_eval", ['exists $RMI::executing_nodes[-1]->{_sent_objects}{"' . $id . '"}']);
         '''
 
+    # the length of an object, or None for one without a length, such as an iterator
+    def _len(obj):
+        if not hasattr(type(obj), '__len__'):
+            return None
+        return len(obj)
+
+    # methods are found on the class, rather than being callables stored on the instance
+    def _is_method(obj, attr):
+        if attr in getattr(obj, '__dict__', ()):
+            return False
+        return inspect.isroutine(getattr(type(obj), attr, None))
+
+    # called in place of a function or method when the caller asked for a copy of its result
+    def _copy_result(method, obj, *params):
+        if obj == None:
+            f = resolved_callables.resolve(method)
+        else:
+            f = getattr(obj, method)
+        return Copy(f(*params))
+
+    # called for handshake, on the side which answers it
+    def _handshake(offer):
+        return Copy(executing_nodes[-1]._answer_handshake(offer))
+
+    # called for call_shipped_function, with the function's key, and its kind and payload unless it was sent before
+    def _call_shipped(key, kind, payload, defaults, kwdefaults, *params):
+        f = shipped_functions.resolve(key, kind, payload)
+        if defaults or kwdefaults:
+            f = types.FunctionType(f.__code__, f.__globals__, f.__name__, tuple(defaults) if defaults else None)
+            f.__kwdefaults__ = dict(kwdefaults) if kwdefaults else None
+        return f(*params)
+
+    # the next n items of iter(obj), for ProxyIterator, after a status and the iterator to continue with:
+    # the status is 0 if there may be more, 1 if the iterator is exhausted, or the error it raised
+    def _iter_chunk(obj, n):
+        it = iter(obj)
+        chunk = [0, it]
+        try:
+            for i in range(n):
+                chunk.append(next(it))
+        except StopIteration:
+            chunk[0] = 1
+            chunk[1] = None
+        except BaseException as e:
+            chunk[0] = str(e)
+            chunk[1] = None
+        return Copy(chunk, deep = False)
+
+    def _has_received(remote_id):
+        return remote_id in executing_nodes[-1]._received_objects
+
+    # called for remote_object_stats
+    def _object_stats():
+        return Copy({ 'node': executing_nodes[-1].object_stats(), 'process': object_stats() })
+
+    # the size of an object, with its attributes, or its items if it is a container, for object_stats
+    # attributes are looked up without __getattr__, which may be a proxy's, and which may do anything
+    def _approximate_size(o):
+        size = sys.getsizeof(o)
+        try:
+            attributes = object.__getattribute__(o, '__dict__')
+        except (AttributeError, TypeError):
+            attributes = None
+        if isinstance(attributes, dict):
+            size = size + sys.getsizeof(attributes)
+            for v in attributes.values():
+                size = size + sys.getsizeof(v)
+        if isinstance(o, (list, tuple, set, frozenset, collections.deque)):
+            for v in o:
+                size = size + sys.getsizeof(v)
+        elif isinstance(o, dict):
+            for (k, v) in o.items():
+                size = size + sys.getsizeof(k) + sys.getsizeof(v)
+        return size
+
+    def _has_sent(handle):
+        return handle in executing_nodes[-1]._sent_objects
+
 class Client(RMI.Node):
     def call_function():
         raise(Exception(__LINE__))
@@ -483,43 +2257,1200 @@ class Client(RMI.Node):
 
 class Client(Node):
     class ForkedPipes(Client):
-        def __init__(self):
-            (client_reader, server_writer) = os.pipe()
-            (server_reader, client_writer) = os.pipe()
+        # with a fork_server, the server is forked from its template instead of from this process
+        # the server exits when the client closes, and server_pid is its process id
+        def __init__(self, fork_server = None, **opts):
+            (client_reader, client_writer, self.server_pid) = RMI._fork_server_on_pipes(fork_server, opts)
+            RMI.Client.__init__(self,os.fdopen(client_reader, 'rb'),os.fdopen(client_writer, 'wb'),**opts)
+
+    # as ForkedPipes, but messages go through ring buffers in shared memory instead of through the kernel
+    # ring_size is the size of the buffer in each direction, and messages larger than it are streamed through
+    class ForkedSharedMemory(Client):
+        def __init__(self, ring_size = 2**20, **opts):
+            to_server = RMI.SharedMemoryRing(ring_size)
+            to_client = RMI.SharedMemoryRing(ring_size)
 
             if not os.fork():
-                # the child process starts a server and exits when done
-                RMI.DEBUG_MSG_PREFIX = '    SERVER'
-                #RMI.DEBUG_FLAG = 1
-                server_reader = os.fdopen(server_reader, 'r')
-                server_writer = os.fdopen(server_writer, 'w')
-                s = RMI.Node(reader = server_reader, writer = server_writer)
-
-                # the server should return fals whenever a client disconnects
-                # somehow it just hangs :( 
-                # we need to fix this
-                response = s.receive_request_and_send_response()
-                while (response):
-                    if response[3] == 'exitnow':
-                        response = None
-                    else:
-                        response = s.receive_request_and_send_response()
-                print("SERVER DONE")
-                exit()
+                RMI._run_forked_server(to_server.reading(), to_client.writing(), opts)
 
             else:
-                # the parent process initializes as the client and continues
                 RMI.DEBUG_MSG_PREFIX = 'CLIENT'
-                #RMI.DEBUG_FLAG = 1 
-                client_reader = os.fdopen(client_reader, 'r')
-                client_writer = os.fdopen(client_writer, 'w')
-                RMI.Client.__init__(self,client_reader,client_writer)
+                RMI.Client.__init__(self,to_client.reading(),to_server.writing(),**opts)
+
+    # connects to an RMI.Server.Tcp, or a Perl RMI::Server::Tcp
+    class Tcp(Client):
+        DEFAULT_HOST = '127.0.0.1'
+        DEFAULT_PORT = 4409
+
+        def __init__(self, host = None, port = None, timeout = None, **opts):
+            self.host = host if host != None else self.DEFAULT_HOST
+            self.port = port if port != None else self.DEFAULT_PORT
+            try:
+                self.socket = socket.create_connection((self.host, self.port), timeout)
+            except OSError as e:
+                raise(Exception("Error connecting to remote host " + str(self.host) + " on port " + str(self.port) + " : " + str(e)))
+            self.socket.settimeout(None)
+            # requests are small and each waits for its response, so don't hold them back to coalesce
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            RMI.Client.__init__(self,self.socket.makefile('rb'),self.socket.makefile('wb'),**opts)
+
+        def close(self):
+            RMI.Client.close(self)
+            if self.socket != None:
+                self.socket.close()
+                self.socket = None
+
+        # whether the connection still looks usable, without a round trip:
+        # an idle connection has nothing to read, unless the server has closed it
+        def is_open(self):
+            if self.socket == None:
+                return False
+            try:
+                (readable, ignored1, ignored2) = select.select([self.socket], [], [], 0)
+            except (OSError, ValueError):
+                return False
+            return not readable
+
+    # connects to an RMI.Server.Multiplexed listening on a unix socket
+    class Unix(Client):
+        def __init__(self, path, **opts):
+            self.path = path
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.socket.connect(path)
+            except OSError as e:
+                self.socket.close()
+                raise(Exception("Error connecting to unix socket " + str(path) + " : " + str(e)))
+            RMI.Client.__init__(self,self.socket.makefile('rb'),self.socket.makefile('wb'),**opts)
+
+        def close(self):
+            RMI.Client.close(self)
+            if self.socket != None:
+                self.socket.close()
+                self.socket = None
+
+# a bounded pool of TCP connections to one server, so that callers which make a few calls each
+# reuse connections which are already open instead of connecting every time
+#   pool = RMI.ClientPool(host = 'myserver.com', port = 1234, size = 8)
+#   with pool.connection() as c:
+#       c.send_request_and_receive_response('call_function', None, 'F1.add', [1,2])
+# a connection is used by one caller at a time, and proxies from it should not be used after it is
+# returned to the pool, since the next caller may be using it
+# connections idle for longer than check_interval seconds are checked with a round trip before reuse,
+# which is given check_timeout seconds; the pool is not locked while a connection is checked or closed
+# with handshake, each new connection starts with a handshake (see Node.handshake)
+class ClientPool(object):
+    def __init__(self, host = None, port = None, size = 8, check_interval = 30.0, check_timeout = 5.0, client_class = None, handshake = False, **opts):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.handshake = handshake
+        self.client_class = client_class if client_class != None else RMI.Client.Tcp
+        self.opts = opts
+        self._idle = []
+        self._open = 0
+        self._condition = threading.Condition()
+        self.connects = 0
+        self.reuses = 0
+
+    # returns an open connection, waiting up to timeout seconds for one if the pool is at its size
+    def acquire(self, timeout = None):
+        deadline = None if timeout == None else time.monotonic() + timeout
+        while True:
+            c = None
+            with self._condition:
+                while not len(self._idle) and self._open >= self.size:
+                    remaining = None if deadline == None else deadline - time.monotonic()
+                    if (remaining != None and remaining <= 0) or not self._condition.wait(remaining):
+                        raise(Exception("timed out waiting for a connection from the pool"))
+                if len(self._idle):
+                    # the most recently used connection is the most likely to be healthy
+                    # it still counts as open while it is checked, so the pool does not grow past its size
+                    (c, idle_since) = self._idle.pop()
+                else:
+                    self._open = self._open + 1
+            if c == None:
+                break
+            if self._check(c, idle_since):
+                with self._condition:
+                    self.reuses = self.reuses + 1
+                return c
+            self._discard(c)
+        try:
+            c = self.client_class(host = self.host, port = self.port, **self.opts)
+            if self.handshake:
+                c.handshake()
+        except BaseException:
+            with self._condition:
+                self._open = self._open - 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self.connects = self.connects + 1
+        return c
+
+    # returns a connection to the pool, or closes it if it is broken
+    def release(self, c, broken = False):
+        if broken or c.writer == None or getattr(c, 'is_closed', False):
+            self._discard(c)
+            return
+        with self._condition:
+            self._idle.append((c, time.monotonic()))
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout = None):
+        c = self.acquire(timeout)
+        try:
+            yield c
+        except (RMI.Timeout, RMI.Closed):
+            # the response may still arrive, or the connection is gone
+            self.release(c, True)
+            raise
+        except RMI.Exception:
+            # the request was answered, with an exception
+            self.release(c)
+            raise
+        except BaseException:
+            # the connection may be left part-way through a request
+            self.release(c, True)
+            raise
+        self.release(c)
+
+    def close(self):
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+        for (c, idle_since) in idle:
+            self._discard(c)
+
+    # client classes without is_open are taken to be open until a round trip says otherwise
+    def _check(self, c, idle_since):
+        is_open = getattr(c, 'is_open', None)
+        if is_open != None and not is_open():
+            return False
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+        try:
+            return c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['1'], timeout = self.check_timeout) == 1
+        except (OSError, Exception):
+            return False
+
+    def _discard(self, c):
+        with self._condition:
+            self._open = self._open - 1
+            self._condition.notify()
+        try:
+            c.close()
+        except OSError:
+            pass
+
+# the sizes of the tables every node in this process shares, and of the caches (see Node.object_stats):
+#   node_for_object, remote_id_for_object: entries for the live proxies of all nodes
+#   nodes_with_proxies: how many nodes those proxies are from
+#   proxied_classes: classes proxied into this process
+#   executing_nodes: the depth of requests being executed on the calling thread
+def object_stats():
+    nodes = set()
+    for node in list(node_for_object.values()):
+        nodes.add(id(node))
+    return {
+        'node_for_object': len(node_for_object),
+        'remote_id_for_object': len(remote_id_for_object),
+        'nodes_with_proxies': len(nodes),
+        'proxied_classes': len(proxied_classes),
+        'executing_nodes': len(executing_nodes),
+        'resolved_callables': resolved_callables.stats(),
+        'shipped_functions': shipped_functions.stats(),
+    }
+
+# makes the pipes for a forked-pipes client, and forks a server on the other ends, or has fork_server
+# fork one from its template, with a node_class node, or an ordinary Node
+# returns the file descriptors of the client's ends and the server's process id, and never returns in the child
+def _fork_server_on_pipes(fork_server, opts, node_class = None):
+    (client_reader, server_writer) = os.pipe()
+    (server_reader, client_writer) = os.pipe()
+
+    server_pid = os.fork() if fork_server == None else None
+    if server_pid == 0:
+        # close the client's ends so we see end-of-file when the client closes its writer
+        os.close(client_reader)
+        os.close(client_writer)
+        RMI._run_forked_server(server_reader, server_writer, opts, node_class)
+
+    # the parent process initializes as the client and continues
+    RMI.DEBUG_MSG_PREFIX = 'CLIENT'
+    #RMI.DEBUG_FLAG = 1
+    if fork_server != None:
+        server_pid = fork_server.serve(server_reader, server_writer, opts, node_class)
+    os.close(server_reader)
+    os.close(server_writer)
+    return (client_reader, client_writer, server_pid)
+
+# the child process of a forked-pipes client starts a server and exits when done
+def _run_forked_server(server_reader, server_writer, opts, node_class = None):
+    RMI.DEBUG_MSG_PREFIX = '    SERVER'
+    #RMI.DEBUG_FLAG = 1
+    if isinstance(server_reader, int):
+        server_reader = os.fdopen(server_reader, 'rb')
+        server_writer = os.fdopen(server_writer, 'wb')
+    if node_class != None:
+        # a multiplexed node serves from its own threads until the client disconnects
+        s = node_class(reader = server_reader, writer = server_writer, **opts)
+        s.run()
+        print("SERVER DONE")
+        exit()
+
+    s = RMI.Node(reader = server_reader, writer = server_writer, **opts)
+
+    # the server returns false when the client disconnects
+    response = s.receive_request_and_send_response()
+    while (response):
+        if response[3] == 'exitnow':
+            response = None
+        else:
+            response = s.receive_request_and_send_response()
+    print("SERVER DONE")
+    exit()
+
+# a template process, forked once, which imports modules up front and then forks a server for each
+# forked-pipes client which asks, so the servers start with those modules loaded instead of importing
+# them on their first calls
+#   fs = RMI.ForkServer(preload = ['F1', 'json'], resolve = ['F1.add'])
+#   c = RMI.Client.ForkedPipes(fork_server = fs)
+#   pool = RMI.ForkedPool(4, fork_server = fs)
+# resolve names functions or classes to put in each server's resolved_callables cache, and warm is
+# called in the template with no arguments, to fill any other caches
+# make it early, before the client has threads or much state, since the template is a copy of the
+# process at that point
+# the ends of the pipes for each server are passed to the template over a unix socket
+class ForkServer(object):
+    def __init__(self, preload = [], resolve = [], warm = None):
+        self.preload = list(preload)
+        self.resolve = list(resolve)
+        self.forks = 0
+        self._lock = threading.Lock()
+        (self._socket, template_socket) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        # so the servers don't write out what this process has buffered as they exit
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if not self.pid:
+            self._socket.close()
+            self._run_template(template_socket, warm)
+        template_socket.close()
+        # the template says whether the preloading worked before it takes requests
+        error = self._receive_message()
+        if error != None:
+            self.close()
+            raise(Exception("error starting the fork server: " + error))
+
+    # has the template fork a server on the given ends of a pair of pipes, and returns its pid
+    def serve(self, server_reader, server_writer, opts, node_class = None):
+        message = pickle.dumps((opts, node_class.__name__ if node_class != None else None))
+        with self._lock:
+            if self._socket == None:
+                raise(Exception("the fork server is closed"))
+            socket.send_fds(self._socket, [struct.pack('!I', len(message)) + message], [server_reader, server_writer])
+            pid = self._receive_message()
+            self.forks = self.forks + 1
+        return pid
+
+    # the template exits when it sees the socket close, and the servers it forked carry on
+    def close(self):
+        with self._lock:
+            if self._socket == None:
+                return
+            # children forked from this process since have a copy of the socket, which shutdown closes too
+            self._socket.shutdown(socket.SHUT_RDWR)
+            self._socket.close()
+            self._socket = None
+        os.waitpid(self.pid, 0)
+
+    def _run_template(self, s, warm):
+        RMI.DEBUG_MSG_PREFIX = '    FORKSERVER'
+        # servers exit when their clients close, without the template waiting for them
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        try:
+            for name in self.preload:
+                importlib.import_module(name)
+            for name in self.resolve:
+                RMI.resolved_callables.resolve(name)
+            if warm != None:
+                warm()
+        except BaseException as e:
+            self._send_message(s, type(e).__name__ + ': ' + str(e))
+            os._exit(1)
+        self._send_message(s, None)
+
+        while True:
+            (first, fds, flags, address) = socket.recv_fds(s, 4, 2)
+            if len(first) < 4:
+                os._exit(0)
+            (opts, node_class) = pickle.loads(self._read_exactly(s, struct.unpack('!I', first)[0]))
+            pid = os.fork()
+            if not pid:
+                s.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                RMI._run_forked_server(fds[0], fds[1], opts, getattr(RMI, node_class) if node_class != None else None)
+            for fd in fds:
+                os.close(fd)
+            self._send_message(s, pid)
+
+    def _send_message(self, s, value):
+        message = pickle.dumps(value)
+        s.sendall(struct.pack('!I', len(message)) + message)
+
+    def _receive_message(self):
+        first = self._read_exactly(self._socket, 4)
+        return pickle.loads(self._read_exactly(self._socket, struct.unpack('!I', first)[0]))
+
+    def _read_exactly(self, s, n):
+        parts = []
+        while n > 0:
+            part = s.recv(n)
+            if not part:
+                raise(Exception("the fork server closed its socket"))
+            parts.append(part)
+            n = n - len(part)
+        return b''.join(parts)
+
+# one direction of a stream between two processes on the same host, as a ring buffer in shared memory,
+# for use as the reader of one Node and the writer of another without copying messages through the kernel
+# it is made before a fork, after which one process calls reading() and the other writing()
+# the header before the buffer holds the total bytes written (head) and read (tail), which only the
+# writer and only the reader change, respectively, and flags for a side waiting and a side closed
+# this relies on the stores of each side being seen by the other in the order they are made, which
+# x86 guarantees and Python gives no fence for, so a ring can't be made on other architectures
+# pipes serve as doorbells: each side rings only when the other has said it is waiting, and a waiting
+# side also polls, so a missed ring costs poll_interval and never hangs
+# the pipes carry end-of-file as well, if the other process goes away without closing
+# it only pays off with a core for each side: with one, a call takes longer than through a pipe
+class SharedMemoryRing(object):
+    HEAD = 0
+    TAIL = 8
+    READER_WAITING = 16
+    WRITER_WAITING = 20
+    READER_CLOSED = 24
+    WRITER_CLOSED = 28
+    HEADER_SIZE = 64
+
+    _u64 = struct.Struct('=Q')
+    _u32 = struct.Struct('=I')
+
+    poll_interval = 0.01
+    # times a side looks at the other side's counter before it sleeps on the doorbell,
+    # since a reply to a short call often arrives sooner than a wakeup through the kernel would
+    # with one core the other side can't run while this one spins, so it doesn't
+    spin = 200 if (os.cpu_count() or 1) > 1 else 0
+
+    # the names platform.machine() gives for x86
+    architectures = ('x86_64', 'amd64', 'i386', 'i486', 'i586', 'i686', 'x86')
+
+    def __init__(self, size = 2**20):
+        if platform.machine().lower() not in self.architectures:
+            raise(Exception("shared memory rings need the store ordering of x86, not " + platform.machine()))
+        self.size = size
+        self._map = mmap.mmap(-1, self.HEADER_SIZE + size)
+        (self._data_bell_reader, self._data_bell_writer) = os.pipe()
+        (self._space_bell_reader, self._space_bell_writer) = os.pipe()
+        self._position = 0
+        self._eof = False
+
+    def reading(self):
+        os.close(self._data_bell_writer)
+        os.close(self._space_bell_reader)
+        self._bell = self._data_bell_reader
+        self._other_bell = self._space_bell_writer
+        return self
+
+    def writing(self):
+        os.close(self._data_bell_reader)
+        os.close(self._space_bell_writer)
+        self._bell = self._space_bell_reader
+        self._other_bell = self._data_bell_writer
+        return self
+
+    # reads n bytes, or fewer only at end-of-file, like a buffered file
+    def read(self, n):
+        parts = []
+        while n > 0:
+            available = self._available()
+            if available == 0:
+                break
+            part = self._take(min(n, available))
+            parts.append(part)
+            n = n - len(part)
+        return b''.join(parts)
+
+    def readinto(self, b):
+        available = self._available()
+        if available == 0:
+            return 0
+        start = self._position % self.size
+        n = min(len(b), available, self.size - start)
+        with memoryview(self._map) as m:
+            b[0:n] = m[self.HEADER_SIZE + start : self.HEADER_SIZE + start + n]
+        self._position = self._position + n
+        self._u64.pack_into(self._map, self.TAIL, self._position)
+        self._ring_if(self.WRITER_WAITING)
+        return n
+
+    def readline(self):
+        parts = []
+        while True:
+            available = self._available()
+            if available == 0:
+                break
+            start = self.HEADER_SIZE + self._position % self.size
+            end = self.HEADER_SIZE + min(self._position % self.size + available, self.size)
+            newline = self._map.find(b'\n', start, end)
+            if newline != -1:
+                parts.append(self._take(newline - start + 1))
+                break
+            parts.append(self._take(end - start))
+        return b''.join(parts)
+
+    def write(self, b):
+        view = memoryview(b)
+        written = 0
+        while written < len(view):
+            space = self._space()
+            start = self._position % self.size
+            count = min(space, len(view) - written, self.size - start)
+            self._map[self.HEADER_SIZE + start : self.HEADER_SIZE + start + count] = view[written : written + count]
+            self._position = self._position + count
+            self._u64.pack_into(self._map, self.HEAD, self._position)
+            self._ring_if(self.READER_WAITING)
+            written = written + count
+        return written
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._bell == None:
+            return
+        if self._bell == self._data_bell_reader:
+            self._u32.pack_into(self._map, self.READER_CLOSED, 1)
+            self._ring_if(self.WRITER_WAITING)
+        else:
+            self._u32.pack_into(self._map, self.WRITER_CLOSED, 1)
+            self._ring_if(self.READER_WAITING)
+        os.close(self._bell)
+        os.close(self._other_bell)
+        self._bell = None
+        self._map.close()
+
+    # copies out n bytes from the current position, up to the end of the buffer
+    def _take(self, n):
+        start = self._position % self.size
+        n = min(n, self.size - start)
+        part = self._map[self.HEADER_SIZE + start : self.HEADER_SIZE + start + n]
+        self._position = self._position + n
+        self._u64.pack_into(self._map, self.TAIL, self._position)
+        self._ring_if(self.WRITER_WAITING)
+        return part
+
+    # bytes ready to read, waiting for some, or 0 at end-of-file
+    def _available(self):
+        while True:
+            available = self._u64.unpack_from(self._map, self.HEAD)[0] - self._position
+            if available or self._eof or self._u32.unpack_from(self._map, self.WRITER_CLOSED)[0]:
+                return available
+            self._wait(self.READER_WAITING, self.HEAD, self._position)
+
+    # bytes free for writing, waiting for some
+    def _space(self):
+        while True:
+            space = self.size - (self._position - self._u64.unpack_from(self._map, self.TAIL)[0])
+            if space:
+                return space
+            if self._eof or self._u32.unpack_from(self._map, self.READER_CLOSED)[0]:
+                raise BrokenPipeError("shared memory reader closed")
+            self._wait(self.WRITER_WAITING, self.TAIL, self._position - self.size)
+
+    # waits until the other side moves the counter at offset off of its old value
+    # the flag is raised before the counter is checked again, so a change after the check will be rung
+    def _wait(self, flag, offset, old):
+        counter = self._u64.unpack_from
+        for n in range(self.spin):
+            if counter(self._map, offset)[0] != old:
+                return
+        self._u32.pack_into(self._map, flag, 1)
+        if self._u64.unpack_from(self._map, offset)[0] == old:
+            (ready, ignored1, ignored2) = select.select([self._bell], [], [], self.poll_interval)
+            if ready and not os.read(self._bell, 4096):
+                # the other process has gone
+                self._eof = True
+        self._u32.pack_into(self._map, flag, 0)
+
+    def _ring_if(self, flag):
+        if self._u32.unpack_from(self._map, flag)[0]:
+            self._u32.pack_into(self._map, flag, 0)
+            try:
+                os.write(self._other_bell, b'\0')
+            except OSError:
+                # the other process has gone, which it will find out for itself
+                pass
+
+# an RMI node for asyncio: the reader and writer are an asyncio.StreamReader and StreamWriter
+# every request is tagged with an id, so any number of coroutines can await calls over one
+# connection at once, and requests from the other side run in their own tasks so they never
+# hold up the routing of responses
+# the request methods are coroutines, and so are the remote calls made through proxies from this node
+class AsyncNode(Node):
+    def __init__(self, reader, writer, **opts):
+        Node.__init__(self, reader, writer, **opts)
+        self._tag_requests = True
+        self._waiting = {}
+        # the tasks handling requests from the other side, by request id, so they can be cancelled
+        self._handlers = {}
+        self._reader_task = None
+        self._loop = None
+        self._release_flush = None
+
+    # starts the task which reads messages, which happens on the first request if not before
+    def start(self):
+        if self._reader_task == None and self.reader != None:
+            self._loop = asyncio.get_running_loop()
+            self._reader_task = asyncio.ensure_future(self._read_messages())
+        return self
+
+    # a stub can be called for a method, or awaited for the value, so there is no need to ask first
+    def _proxy_attribute(self,proxy,attr):
+        return RMI.ProxyMethod(proxy, attr)
+
+    # len() and "for" can't await the other side, so they say what to use instead
+    def _proxy_len(self,proxy):
+        raise(Exception("len() of a proxy from an AsyncNode would wait for the other side: use await node.send_request_and_receive_response('call_function', None, 'len', [proxy])"))
+
+    def _proxy_iterator(self,proxy):
+        raise(Exception("a proxy from an AsyncNode is iterated with \"async for\", or RMI.AsyncProxyIterator"))
+
+    # proxies can be collected in any thread, so the flush is scheduled through the loop
+    def _release_queued(self):
+        if self._loop != None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._schedule_release_flush)
+
+    def _schedule_release_flush(self):
+        if self._release_flush == None:
+            self._release_flush = self._loop.call_later(self.release_interval, self._flush_releases_later)
+
+    def _flush_releases_later(self):
+        self._release_flush = None
+        if self.writer != None and not self.writer.is_closing():
+            self.flush_releases()
+
+    def close(self):
+        if self._release_flush != None:
+            self._release_flush.cancel()
+            self._release_flush = None
+        if self._reader_task != None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self.writer:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def send_request_and_receive_response(self, call_type, obj = None, method = None, params = [], opts = None, timeout = None):
+        if DEBUG_FLAG: 
+            print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) 
+                + " calling via " + str(self) 
+                + " on " + pp.pformat(obj) 
+                + ": " + str(method) 
+                + " with " + pp.pformat(params)
+            )
+
+        metrics = self.metrics
+        if metrics != None:
+            started = time.perf_counter()
+
+        sendable = []
+        self._append_query(sendable, call_type, obj, method, params, opts)
+
+        received = await self._send_and_wait(Message('query',sendable,self._new_request_id()), timeout)
+        if metrics != None:
+            metrics.called(call_type, method, started)
+        return received.message_data[0]
+
+    async def remote_object_stats(self):
+        return await self.send_request_and_receive_response('call_function', None, 'RMI.Node._object_stats', [])
+
+    async def handshake(self):
+        try:
+            answer = await self.send_request_and_receive_response('call_function', None, 'RMI.Node._handshake', [Copy(self._handshake_offer())])
+        except (Timeout, Closed):
+            raise
+        except Exception:
+            answer = None
+        self._use_handshake_answer(answer)
+        return answer
+
+    # as Node._run_steps, awaiting each response, so call_shipped_function returns something to await here
+    async def _run_steps(self, steps):
+        (result, error) = (None, None)
+        while True:
+            try:
+                request = steps.send(result) if error == None else steps.throw(error)
+            except StopIteration as e:
+                return e.value
+            try:
+                (result, error) = (await self.send_request_and_receive_response(*request), None)
+            except BaseException as e:
+                (result, error) = (None, e)
+
+    async def send_requests_and_receive_responses(self, requests, timeout = None):
+        if self.peer_features != None and 'batch' not in self.peer_features:
+            return await self._run_steps(self._one_by_one(requests, timeout))
+        metrics = self.metrics
+        if metrics != None:
+            started = time.perf_counter()
+
+        sendable = [len(requests)]
+        for (call_type, obj, method, params) in requests:
+            self._append_query(sendable, call_type, obj, method, params, None)
+
+        received = await self._send_and_wait(Message('batch',sendable,self._new_request_id()), timeout)
+        if metrics != None:
+            metrics.called('batch', None, started, len(requests))
+        return self._batch_results(received)
+
+    # as with a ThreadedNode, a deadline bounds this wait alone, and a late response is dropped
+    async def _send_and_wait(self, message, timeout = None):
+        self.start()
+        if timeout == None:
+            timeout = self.call_timeout
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[message.request_id] = future
+        try:
+            self._send(message)
+            await self.writer.drain()
+            if timeout == None:
+                return await future
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self._send(Message('cancel', message.request_id))
+                raise(Timeout("timed out waiting for a response"))
+        finally:
+            self._waiting.pop(message.request_id, None)
+
+    def _send(self, message):
+        if self.writer == None:
+            raise(Closed("node is closed"))
+        metrics = self.metrics
+        if metrics != None:
+            started = time.perf_counter()
+        parts = self._serialize(message);
+        if metrics != None:
+            encoded = time.perf_counter()
+        size = 0
+        for part in parts:
+            if (DEBUG_FLAG):
+                print(DEBUG_MSG_PREFIX + 'N: ' + str(os.getpid()) + " sending: >" + pp.pformat(part) + "<\n")
+            self.writer.write(part)
+            if metrics != None:
+                size = size + (part.nbytes if isinstance(part, memoryview) else len(part))
+        if metrics != None:
+            metrics.sent(message.message_type, size, started, encoded, time.perf_counter())
+        return True
+
+    async def _read_messages(self):
+        try:
+            while True:
+                first = await self.reader.read(1)
+                if not first:
+                    break
+                try:
+                    serializer = serializers_by_sym[first]
+                except KeyError:
+                    raise(Exception("Got message with unknown protocol byte " + pp.pformat(first)))
+                serialized_blob = await serializer.read_frame_async(first, self.reader)
+                metrics = self.metrics
+                if metrics != None:
+                    read = time.perf_counter()
+                parsed = self._parse(serialized_blob)
+                if parsed == None:
+                    continue
+                buffers = []
+                for (shape, size) in parsed[3]:
+                    buffer = await self.reader.readexactly(size)
+                    if shape == 'bytearray':
+                        buffer = bytearray(buffer)
+                    elif shape == 'memoryview':
+                        buffer = memoryview(bytearray(buffer))
+                    buffers.append(buffer)
+                received = self._decode_message(parsed, buffers)
+                if metrics != None:
+                    # the wait for a message is the event loop's, so only the decoding is timed here
+                    metrics.received(received.message_type, len(serialized_blob), None, None, read, time.perf_counter())
+                if DEBUG_FLAG:
+                    print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " received" + str(received))
+
+                message_type = received.message_type
+                if message_type == 'result' or message_type == 'batch_result' or message_type == 'exception':
+                    future = self._waiting.get(received.request_id)
+                    if future == None or future.done():
+                        # the caller was cancelled
+                        continue
+                    if message_type == 'exception':
+                        future.set_exception(Exception(received.message_data))
+                    else:
+                        future.set_result(received)
+                elif message_type == 'release':
+                    pass
+                elif message_type == 'cancel':
+                    for request_id in received.message_data:
+                        task = self._handlers.get(request_id)
+                        if task != None:
+                            task.cancel()
+                elif message_type == 'query' or message_type == 'batch':
+                    task = asyncio.ensure_future(self._handle_request(received))
+                    self._handlers[received.request_id] = task
+                    task.add_done_callback(functools.partial(self._handled, received.request_id))
+                else:
+                    raise(Exception("unexpected message type from RMI message: " + str(message_type)))
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            self.is_closed = 1
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(Closed("connection closed while waiting for a response"))
+
+    # a request cancelled before its handler started gets an exception for a response, so the other side
+    # hears back about each request; one cancelled while it awaits something stops there, and the
+    # exception is its response as usual
+    def _handled(self, request_id, task):
+        if self._handlers.get(request_id) is task:
+            del self._handlers[request_id]
+        if task.cancelled() and self.writer != None and not self.writer.is_closing():
+            self._send(Message('exception', 'request ' + str(request_id) + ' was cancelled', request_id))
+
+    async def _handle_request(self, received):
+        if received.message_type == 'batch':
+            message_data = iter(received.message_data)
+            nqueries = next(message_data)
+            results = []
+            for n in range(0,nqueries):
+                response = await self._execute_query_async(message_data)
+                results.append(response.message_type)
+                results.append(response.message_data)
+            response = Message('batch_result', results)
+        else:
+            response = await self._execute_query_async(received.message_data)
+        response.request_id = received.request_id
+        self._send(response)
+        await self.writer.drain()
+
+    # as _execute_query, but a coroutine returned by the called function is awaited for the result
+    async def _execute_query_async(self, message_data):
+        response = self._execute_query(message_data)
+        if response.message_type == 'result' and inspect.isawaitable(response.message_data):
+            try:
+                response = Message('result', await response.message_data)
+            except asyncio.CancelledError:
+                response = Message('exception', 'request was cancelled')
+            except BaseException as e:
+                response = Message('exception', str(e))
+        elif response.message_type == 'result' and isinstance(response.message_data, Copy) and inspect.isawaitable(response.message_data.value):
+            try:
+                response = Message('result', Copy(await response.message_data.value))
+            except asyncio.CancelledError:
+                response = Message('exception', 'request was cancelled')
+            except BaseException as e:
+                response = Message('exception', str(e))
+        return response
+
+# an RMI node which many threads can use at once
+# every request is tagged with an id, a single reader thread routes each response to the thread
+# waiting for it, and requests from the other side are executed in parallel by a pool of workers
+# note that a worker which makes a request back to the other side stays busy until it is answered,
+# so chains of counter-requests deeper than the pool will wait for a free worker
+class ThreadedNode(Node):
+    def __init__(self, reader, writer, workers = 8, **opts):
+        Node.__init__(self, reader, writer, **opts)
+        self._tag_requests = True
+        self._send_lock = threading.Lock()
+        self._waiting_lock = threading.Lock()
+        self._waiting = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        # the futures of the requests from the other side which are queued or running, so they can be cancelled
+        self._requests = {}
+        self._reader_thread = None
+        self._release_timer = None
+        self._release_lock = threading.RLock()
+        # releases from the other side, waiting for the send lock (see _apply_releases)
+        self._incoming_releases = collections.deque()
+
+    # starts the reader thread, which happens on the first request if not before
+    def start(self):
+        with self._waiting_lock:
+            if self._reader_thread == None:
+                self._reader_thread = threading.Thread(target = self._read_messages, daemon = True)
+                self._reader_thread.start()
+        return self
+
+    # serves requests until the other side disconnects
+    def run(self):
+        self.start()
+        self._reader_thread.join()
+        self._executor.shutdown(wait = True)
+        return True
+
+    # closes the writer only: closing the reader would block on the reader thread's read,
+    # so that thread closes it when the other side disconnects in response
+    def close(self):
+        with self._send_lock:
+            if self.writer:
+                self.writer.close()
+            self.writer = None
+        self._executor.shutdown(wait = False)
+
+    def send_request_and_receive_response(self, call_type, obj = None, method = None, params = [], opts = None, timeout = None):
+        if DEBUG_FLAG: 
+            print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) 
+                + " calling via " + str(self) 
+                + " on " + pp.pformat(obj) 
+                + ": " + str(method) 
+                + " with " + pp.pformat(params)
+            )
+
+        metrics = self.metrics
+        if metrics != None:
+            started = time.perf_counter()
+
+        sendable = []
+        self._append_query(sendable, call_type, obj, method, params, opts)
+
+        received = self._send_and_wait(Message('query',sendable), timeout)
+        if metrics != None:
+            metrics.called(call_type, method, started)
+        return received.message_data[0]
+
+    def send_requests_and_receive_responses(self, requests, timeout = None):
+        if self.peer_features != None and 'batch' not in self.peer_features:
+            return self._run_steps(self._one_by_one(requests, timeout))
+        metrics = self.metrics
+        if metrics != None:
+            started = time.perf_counter()
+
+        sendable = [len(requests)]
+        for (call_type, obj, method, params) in requests:
+            self._append_query(sendable, call_type, obj, method, params, None)
+
+        received = self._send_and_wait(Message('batch',sendable), timeout)
+        if metrics != None:
+            metrics.called('batch', None, started, len(requests))
+        return self._batch_results(received)
+
+    def _new_request_id(self):
+        with self._waiting_lock:
+            return Node._new_request_id(self)
+
+    # the call is made on another thread, so it is underway while the caller carries on
+    def _read_ahead(self, f, *args):
+        future = concurrent.futures.Future()
+        def run():
+            try:
+                future.set_result(f(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target = run, daemon = True).start()
+        return future.result
+
+    # proxies are finalized on whichever thread drops them, even one holding another of our locks,
+    # and the finalizer ends up here, so this has a lock of its own which the same thread can re-enter
+    def _release_queued(self):
+        with self._release_lock:
+            if self._release_timer == None:
+                self._release_timer = threading.Timer(self.release_interval, self._flush_releases_later)
+                self._release_timer.daemon = True
+                self._release_timer.start()
+
+    def _flush_releases_later(self):
+        with self._release_lock:
+            self._release_timer = None
+        try:
+            self.flush_releases()
+        except BaseException:
+            # closed in the meantime
+            pass
+
+    # the calls the other side makes back are answered on other threads, so a deadline here bounds this wait
+    # alone, and a late response is dropped by the reader thread, since no one is waiting for it
+    def _send_and_wait(self, message, timeout = None):
+        self.start()
+        if timeout == None:
+            timeout = self.call_timeout
+        # the slot is an event to wait on, and the response
+        slot = [threading.Event(), None]
+        with self._waiting_lock:
+            request_id = Node._new_request_id(self)
+            self._waiting[request_id] = slot
+        message.request_id = request_id
+        try:
+            if not self._send(message):
+                raise(Exception("failed to send! $!"))
+            if not slot[0].wait(timeout):
+                try:
+                    self._send(Message('cancel', request_id))
+                except (OSError, Exception):
+                    pass
+                raise(Timeout("timed out waiting for a response"))
+        finally:
+            with self._waiting_lock:
+                self._waiting.pop(request_id, None)
+        received = slot[1]
+        if received.message_type == 'exception':
+            raise(Exception(received.message_data))
+        if received.message_type == 'close':
+            raise(Closed("connection closed while waiting for a response"))
+        return received
+
+    # serializing a message also updates the sent objects and the destroyed ids,
+    # so it happens under the same lock as the write
+    def _send(self, message):
+        with self._send_lock:
+            try:
+                self._apply_incoming_releases()
+                return Node._send(self, message)
+            finally:
+                self._apply_incoming_releases()
+
+    # releases from the other side change the sent objects as well, so the reader thread applies them
+    # under the send lock if it is free, and otherwise leaves them to the thread sending
+    # it does not wait for the lock, since a sender may be waiting for the other side to read, which it
+    # may not do while it waits for this side to read
+    def _apply_releases(self, received_and_destroyed_ids):
+        if len(received_and_destroyed_ids):
+            self._incoming_releases.append(received_and_destroyed_ids)
+        if self._send_lock.acquire(blocking = False):
+            try:
+                self._apply_incoming_releases()
+            finally:
+                self._send_lock.release()
+
+    def _apply_incoming_releases(self):
+        while len(self._incoming_releases):
+            Node._apply_releases(self, self._incoming_releases.popleft())
+
+    def _read_messages(self):
+        try:
+            while True:
+                received = self._receive()
+                if DEBUG_FLAG:
+                    print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " received" + str(received))
+                message_type = received.message_type
+                if message_type == 'close':
+                    break
+                elif message_type == 'result' or message_type == 'batch_result' or message_type == 'exception':
+                    with self._waiting_lock:
+                        slot = self._waiting.get(received.request_id)
+                    if slot != None:
+                        slot[1] = received
+                        slot[0].set()
+                elif message_type == 'release':
+                    pass
+                elif message_type == 'cancel':
+                    self._cancel_requests(received.message_data)
+                elif message_type == 'query' or message_type == 'batch':
+                    with self._waiting_lock:
+                        self._requests[received.request_id] = self._executor.submit(self._handle_request, received)
+                else:
+                    raise(Exception("unexpected message type from RMI message: " + str(message_type)))
+        finally:
+            # wake everyone still waiting, since no response is coming
+            self.is_closed = 1
+            if self.reader:
+                self.reader.close()
+            self.reader = None
+            with self._waiting_lock:
+                slots = list(self._waiting.values())
+            for slot in slots:
+                slot[1] = Message('close', None)
+                slot[0].set()
+
+    def _handle_request(self, received):
+        try:
+            if received.message_type == 'batch':
+                self._process_batch(received.message_data, received.request_id)
+            else:
+                self._process_query(received.message_data, received.request_id)
+        except BaseException as e:
+            if DEBUG_FLAG:
+                print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " failed to respond: " + str(e))
+        finally:
+            with self._waiting_lock:
+                self._requests.pop(received.request_id, None)
+
+    # requests still queued are dropped, with an exception for a response so the other side hears back
+    # about each request, and those already running carry on
+    def _cancel_requests(self, request_ids):
+        for request_id in request_ids:
+            with self._waiting_lock:
+                future = self._requests.get(request_id)
+            if future != None and future.cancel():
+                with self._waiting_lock:
+                    self._requests.pop(request_id, None)
+                try:
+                    self._send(Message('exception', 'request ' + str(request_id) + ' was cancelled', request_id))
+                except (OSError, Exception):
+                    pass
+
+class ThreadedClient(ThreadedNode):
+    pass
+
+class ThreadedClient(ThreadedClient):
+    # forks a server process which also uses a ThreadedNode, so independent requests run in parallel there
+    class ForkedPipes(ThreadedClient):
+        def __init__(self, fork_server = None, **opts):
+            (client_reader, client_writer, self.server_pid) = RMI._fork_server_on_pipes(fork_server, opts, RMI.ThreadedNode)
+            RMI.ThreadedClient.__init__(self,os.fdopen(client_reader, 'rb'),os.fdopen(client_writer, 'wb'),**opts)
+
+# a pool of forked server processes, one per core by default, to spread work across them
+#   pool = RMI.ForkedPool()
+#   total = pool.call_function('F1.add', 1, 2)
+#   sums = pool.map('F1.add', [1,2,3], [4,5,6])
+# each call_function goes to the child with the fewest requests underway, unless a param is a proxy
+# for an object in one of the children, in which case it goes to that child
+# proxies returned from the pool call back to the child which has their object
+# any number of threads can use the pool at once
+class ForkedPool(object):
+    def __init__(self, size = None, **opts):
+        self.size = size if size != None else (os.cpu_count() or 1)
+        self.clients = []
+        for n in range(self.size):
+            self.clients.append(RMI.ThreadedClient.ForkedPipes(**opts))
+        self._busy = [0] * self.size
+        self._busy_lock = threading.Lock()
+        self._next = 0
+        self._executor = None
+
+    def call_function(self, fname, *params):
+        n = self._pick(params)
+        return self._call(n, self.clients[n].send_request_and_receive_response, 'call_function', None, fname, params)
+
+    # runs a shipped function (see Node.call_shipped_function) in the child with the objects among its params,
+    # or the least busy one
+    def call_shipped_function(self, f, *params):
+        n = self._pick(params)
+        return self._call(n, self.clients[n].call_shipped_function, f, *params)
+
+    def call_object_method(self, obj, method, *params):
+        n = self._owner(obj)
+        if n == None:
+            raise(Exception("object " + str(obj) + " is not from this pool"))
+        with self._busy_lock:
+            self._busy[n] = self._busy[n] + 1
+        return self._call(n, self.clients[n].send_request_and_receive_response, 'call_object_method', obj, method, params)
+
+    # calls the function on each set of params from the iterables, as the builtin map() does, and returns
+    # the results in a list
+    # the calls are sent in batches of chunk_size, in parallel across the children
+    def map(self, fname, *iterables, chunk_size = None):
+        calls = list(zip(*iterables))
+        if chunk_size == None:
+            # enough chunks that a child which finishes early can take more
+            chunk_size = max(1, -(-len(calls) // (self.size * 4)))
+        if self._executor == None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.size)
+        futures = []
+        for start in range(0, len(calls), chunk_size):
+            futures.append(self._executor.submit(self._map_chunk, fname, calls[start : start + chunk_size]))
+        results = []
+        for future in futures:
+            for result in future.result():
+                if isinstance(result, Exception):
+                    raise result
+                results.append(result)
+        return results
+
+    def close(self):
+        if self._executor != None:
+            self._executor.shutdown(wait = True)
+            self._executor = None
+        for c in self.clients:
+            c.close()
+
+    def _map_chunk(self, fname, chunk):
+        requests = []
+        params_in_chunk = []
+        for params in chunk:
+            requests.append(['call_function', None, fname, params])
+            params_in_chunk.extend(params)
+        n = self._pick(params_in_chunk)
+        return self._call(n, self.clients[n].send_requests_and_receive_responses, requests)
+
+    # the index of the child to call, which is counted as busy until _call is done
+    def _pick(self, params):
+        n = None
+        for p in params:
+            n = self._owner(p)
+            if n != None:
+                break
+        with self._busy_lock:
+            if n == None:
+                # the least busy, taking turns among those which are equally busy
+                start = self._next
+                self._next = (start + 1) % self.size
+                busy = self._busy
+                n = min(range(self.size), key = lambda i: (busy[i], (i - start) % self.size))
+            self._busy[n] = self._busy[n] + 1
+        return n
+
+    def _call(self, n, f, *args):
+        try:
+            return f(*args)
+        finally:
+            with self._busy_lock:
+                self._busy[n] = self._busy[n] - 1
+
+    def _owner(self, obj):
+        if not isinstance(obj, ProxyObject):
+            return None
+        node = node_for_object.get(id(obj))
+        for n in range(self.size):
+            if self.clients[n] is node:
+                return n
+        return None
+
+class AsyncClient(AsyncNode):
+    pass
+
+class AsyncClient(AsyncClient):
+    # forks a server process with an ordinary Node, and talks to it over pipes from the event loop
+    #   c = await RMI.AsyncClient.ForkedPipes().connect()
+    #   results = await asyncio.gather(c.send_request_and_receive_response('call_function', None, 'F1.add', [1,2]), ...)
+    class ForkedPipes(AsyncClient):
+        # the largest line read by the text serialization protocol
+        stream_limit = 2**24
+
+        def __init__(self, fork_server = None, **opts):
+            (client_reader, client_writer, self.server_pid) = RMI._fork_server_on_pipes(fork_server, opts)
+            self._client_reader = os.fdopen(client_reader, 'rb', 0)
+            self._client_writer = os.fdopen(client_writer, 'wb', 0)
+            RMI.AsyncClient.__init__(self,None,None,**opts)
+
+        async def connect(self):
+            loop = asyncio.get_running_loop()
+            reader = asyncio.StreamReader(limit = self.stream_limit)
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), self._client_reader)
+            (transport, protocol) = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, self._client_writer)
+            self.reader = reader
+            self.writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+            return self.start()
+
+class Server(RMI.Node):
+    # serves requests until the client closes the connection
+    def run(self):
+        while self.receive_request_and_send_response():
+            pass
 
-class Server:
-    def __init__(self):
-        raise(Exception(__LINE__))
-    def run():
-        raise(Exception(__LINE__))
     def _receive_use():
         raise(Exception(__LINE__))
     def _receive_use_lib():
@@ -527,12 +3458,443 @@ class Server:
     def _receive_eval():
         raise(Exception(__LINE__))
 
+class Server(Server):
+    # listens on a TCP/IP socket, and serves each connection accepted with its own RMI.Server
+    # as with the Perl RMI::Server::Tcp, one process serves them all, one request at a time
+    #   s = RMI.Server.Tcp(port = 1234)
+    #   s.run()
+    # a port of 0 listens on any free port, which is then in s.port
+    class Tcp(object):
+        DEFAULT_HOST = '127.0.0.1'
+        DEFAULT_PORT = 4409
+
+        def __init__(self, host = None, port = None, listen_queue_size = 128, **opts):
+            self.host = host if host != None else self.DEFAULT_HOST
+            self.listen_socket = socket.create_server((self.host, port if port != None else self.DEFAULT_PORT), backlog = listen_queue_size)
+            self.port = self.listen_socket.getsockname()[1]
+            self.opts = opts
+            self._server_for_socket = {}
+
+        def run(self):
+            while self.listen_socket != None:
+                self.receive_request_and_send_response()
+
+        # waits for a request on any connection, accepting new connections in the meantime,
+        # and processes it
+        # returns the result of receive_request_and_send_response on the connection's server,
+        # or None if the timeout passes first
+        def receive_request_and_send_response(self, timeout = None):
+            while True:
+                sockets = [self.listen_socket]
+                sockets.extend(self._server_for_socket.keys())
+                (readable, ignored1, ignored2) = select.select(sockets, [], [], timeout)
+                if not readable:
+                    return
+                for sock in readable:
+                    if sock is self.listen_socket:
+                        self._accept_connection()
+                    else:
+                        return self._serve(sock)
+
+        def _accept_connection(self):
+            (sock, address) = self.listen_socket.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            server = RMI.Server(reader = sock.makefile('rb'), writer = sock.makefile('wb'), **self.opts)
+            self._server_for_socket[sock] = server
+            return sock
+
+        def _serve(self, sock):
+            server = self._server_for_socket[sock]
+            response = server.receive_request_and_send_response()
+            # a client may send more than one message at once, and the rest will already be in the
+            # server's buffer, where select() doesn't see it
+            while response and self._has_buffered(sock, server):
+                response = server.receive_request_and_send_response()
+            if not response:
+                self._close_connection(sock)
+            return response
+
+        def _has_buffered(self, sock, server):
+            sock.setblocking(False)
+            try:
+                return len(server.reader.peek(1)) > 0
+            except OSError:
+                return False
+            finally:
+                sock.setblocking(True)
+
+        def _close_connection(self, sock):
+            server = self._server_for_socket.pop(sock)
+            server.close()
+            sock.close()
+
+        def close(self):
+            for sock in list(self._server_for_socket.keys()):
+                self._close_connection(sock)
+            if self.listen_socket != None:
+                self.listen_socket.close()
+                self.listen_socket = None
+
+class Server(Server):
+    # serves many clients from one process with an event loop, instead of with a process or thread each:
+    #   s = RMI.Server.Multiplexed(executor = concurrent.futures.ThreadPoolExecutor(16))
+    #   s.listen_tcp(port = 1234)
+    #   s.listen_unix('/tmp/rmi.sock')
+    #   s.run()
+    # each connection gets its own RMI.Server, but a socket is read only when the selector says it has data,
+    # into a buffer of its own, and a message is decoded only once all of its frames and out-of-band buffers
+    # are there, while responses go into a buffer which is sent as fast as the client takes it, so a slow or
+    # stalled client holds up no one else
+    # a connection with a response still to send is not read from until the client has taken it
+    # without an executor, requests are processed on the loop, which suits quick calls
+    # with one, such as a concurrent.futures.ThreadPoolExecutor, each request is processed on it, for calls
+    # which may block; each connection still has one request processed at a time, in order, and its socket
+    # is left out of the loop until that request is done
+    # a request which calls back to its client reads the response straight from the socket, as a plain
+    # RMI.Server does
+    class Multiplexed(object):
+        # raised by a connection's reader when the loop reads past what has arrived so far
+        class Incomplete(BaseException):
+            pass
+
+        # the socket of one client, a buffer of what has been received from it, and one of what is to be sent to it,
+        # which its RMI.Server reads and writes as its reader and writer
+        class Connection(object):
+            def __init__(self, sock, opts):
+                self.sock = sock
+                self.buffer = bytearray()
+                self.pos = 0
+                self.outgoing = bytearray()
+                self._sent = 0
+                # the events the selector is watching for on the socket, or None while it is left out of the loop
+                self.events = None
+                # how far the buffer has been searched for the end of a line
+                self._scanned = 0
+                # while the loop looks for a complete message, reading past the end of the buffer raises
+                # Incomplete, and while a request is processed, it waits on the socket instead
+                self.framing = True
+                # a message whose frames have been parsed, while its out-of-band buffers arrive
+                self.parsed = None
+                self.busy = False
+                self.failed = False
+                self.server = RMI.Server(reader = self, writer = self, **opts)
+
+            # reads what the socket has into the buffer, and returns False once it is closed
+            def fill(self):
+                try:
+                    data = self.sock.recv(2**16)
+                except OSError:
+                    return False
+                if not data:
+                    return False
+                if self.pos:
+                    del self.buffer[:self.pos]
+                    self._scanned = max(0, self._scanned - self.pos)
+                    self.pos = 0
+                self.buffer += data
+                return True
+
+            def _wait(self):
+                if self.framing:
+                    raise(RMI.Server.Multiplexed.Incomplete())
+                # a request waiting on a call back to the client has to get the call to it first
+                while self.send():
+                    select.select([], [self.sock], [])
+                return self.fill()
+
+            def write(self, b):
+                self.outgoing += b
+
+            def flush(self):
+                self.send()
+
+            # sends what the socket takes without waiting, and returns whether there is more to send
+            def send(self):
+                while self._sent < len(self.outgoing):
+                    try:
+                        with memoryview(self.outgoing) as view:
+                            n = self.sock.send(view[self._sent:], socket.MSG_DONTWAIT)
+                    except (BlockingIOError, InterruptedError):
+                        return True
+                    self._sent = self._sent + n
+                self.outgoing = bytearray()
+                self._sent = 0
+                return False
+
+            def read(self, n):
+                while len(self.buffer) - self.pos < n:
+                    if not self._wait():
+                        break
+                end = min(self.pos + n, len(self.buffer))
+                with memoryview(self.buffer) as view:
+                    b = bytes(view[self.pos:end])
+                self.pos = end
+                return b
+
+            def readinto(self, b):
+                while len(self.buffer) == self.pos:
+                    if not self._wait():
+                        return 0
+                n = min(len(b), len(self.buffer) - self.pos)
+                b[0:n] = self.buffer[self.pos:self.pos+n]
+                self.pos = self.pos + n
+                return n
+
+            def readline(self):
+                while True:
+                    end = self.buffer.find(b'\n', max(self.pos, self._scanned))
+                    if end != -1:
+                        return self.read(end + 1 - self.pos)
+                    self._scanned = len(self.buffer)
+                    if not self._wait():
+                        return self.read(len(self.buffer) - self.pos)
+
+            # the socket is closed by the Multiplexed server
+            def close(self):
+                pass
+
+            # the next message, if all of it has arrived, or None
+            # as with Node._receive, but each frame is parsed only once it is all in the buffer
+            def next_message(self):
+                server = self.server
+                while True:
+                    if self.parsed == None:
+                        start = self.pos
+                        try:
+                            first = self.read(1)
+                            try:
+                                serializer = serializers_by_sym[first]
+                            except KeyError:
+                                raise(Exception("Got message with unknown protocol byte " + pp.pformat(first)))
+                            serialized_blob = serializer.read_frame(first, self)
+                        except RMI.Server.Multiplexed.Incomplete:
+                            self.pos = start
+                            return None
+                        self.parsed = server._parse(serialized_blob)
+                        if self.parsed == None:
+                            continue
+                    size = 0
+                    for (shape, n) in self.parsed[3]:
+                        size = size + n
+                    if len(self.buffer) - self.pos < size:
+                        return None
+                    parsed = self.parsed
+                    self.parsed = None
+                    return server._decode_message(parsed, server._read_buffers(parsed[3]))
+
+        def __init__(self, executor = None, **opts):
+            self.executor = executor
+            self.opts = opts
+            # made by the process which runs the loop, since a forked copy would share it, so that
+            # the listeners can be set up, and the copy closed, before forking the process which serves
+            self.selector = None
+            self._listeners = []
+            self._paths = []
+            self._connections = set()
+            # connections whose requests are done on the executor, which the loop takes back
+            self._done = collections.deque()
+            self._wakeup_reader = None
+            self._wakeup_writer = None
+
+        # listens on a TCP/IP socket, and returns its address, with the port picked if it is 0
+        def listen_tcp(self, host = None, port = None, listen_queue_size = 128):
+            host = host if host != None else RMI.Server.Tcp.DEFAULT_HOST
+            sock = socket.create_server((host, port if port != None else RMI.Server.Tcp.DEFAULT_PORT), backlog = listen_queue_size)
+            self._listen(sock)
+            return sock.getsockname()
+
+        # listens on a unix socket at path, which is removed on close()
+        def listen_unix(self, path, listen_queue_size = 128):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            sock.listen(listen_queue_size)
+            self._paths.append(path)
+            self._listen(sock)
+            return path
+
+        def _listen(self, sock):
+            sock.setblocking(False)
+            self._listeners.append(sock)
+            if self.selector != None:
+                self.selector.register(sock, selectors.EVENT_READ, None)
+
+        def _start(self):
+            self.selector = selectors.DefaultSelector()
+            (self._wakeup_reader, self._wakeup_writer) = socket.socketpair()
+            self._wakeup_reader.setblocking(False)
+            self.selector.register(self._wakeup_reader, selectors.EVENT_READ, None)
+            for sock in self._listeners:
+                self.selector.register(sock, selectors.EVENT_READ, None)
+
+        # serves until closed
+        def run(self):
+            while self._listeners:
+                self.process_events()
+
+        # waits for something to happen on any socket, and handles it: accepts connections, reads
+        # what has arrived, and processes each request which is complete
+        # returns how many messages were processed or handed to the executor, which is 0 if
+        # the timeout passes first
+        def process_events(self, timeout = None):
+            if self.selector == None:
+                self._start()
+            handled = 0
+            for (key, events) in self.selector.select(timeout):
+                sock = key.fileobj
+                if sock is self._wakeup_reader:
+                    handled = handled + self._take_back_done()
+                elif key.data == None:
+                    self._accept_connection(sock)
+                else:
+                    conn = key.data
+                    if conn not in self._connections or conn.busy:
+                        continue
+                    if events & selectors.EVENT_WRITE:
+                        try:
+                            conn.send()
+                        except OSError:
+                            self._close_connection(conn)
+                            continue
+                    if events & selectors.EVENT_READ:
+                        is_open = conn.fill()
+                        handled = handled + self._serve(conn)
+                        if not is_open and not conn.busy and conn in self._connections:
+                            self._close_connection(conn)
+                    if not conn.busy and conn in self._connections:
+                        self._watch(conn)
+            return handled
+
+        # watches for the client taking what is left to send it, or else for more from it
+        def _watch(self, conn):
+            events = selectors.EVENT_WRITE if len(conn.outgoing) else selectors.EVENT_READ
+            if conn.events == None:
+                self.selector.register(conn.sock, events, conn)
+            elif conn.events != events:
+                self.selector.modify(conn.sock, events, conn)
+            conn.events = events
+
+        def _accept_connection(self, listen_socket):
+            try:
+                (sock, address) = listen_socket.accept()
+            except BlockingIOError:
+                # another process sharing the socket got it first
+                return
+            sock.setblocking(True)
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self.Connection(sock, self.opts)
+            self._connections.add(conn)
+            self._watch(conn)
+            return conn
+
+        # processes the complete messages in a connection's buffer, until it runs out or a request
+        # goes to the executor
+        def _serve(self, conn):
+            handled = 0
+            while not conn.busy and conn in self._connections:
+                try:
+                    received = conn.next_message()
+                except (Exception, builtins.Exception) as e:
+                    if DEBUG_FLAG:
+                        print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " bad message: " + str(e))
+                    self._close_connection(conn)
+                    break
+                if received == None:
+                    break
+                handled = handled + 1
+                if self.executor != None and (received.message_type == 'query' or received.message_type == 'batch'):
+                    conn.busy = True
+                    if conn.events != None:
+                        self.selector.unregister(conn.sock)
+                        conn.events = None
+                    self.executor.submit(self._respond_later, conn, received)
+                elif not self._respond(conn, received):
+                    self._close_connection(conn)
+            return handled
+
+        # returns False if the connection should be closed
+        def _respond(self, conn, received):
+            conn.framing = False
+            try:
+                return conn.server._respond(received) != None
+            except (Exception, builtins.Exception) as e:
+                if DEBUG_FLAG:
+                    print(RMI.DEBUG_MSG_PREFIX + ": " + str(os.getpid()) + " failed to respond: " + str(e))
+                return False
+            finally:
+                conn.framing = True
+
+        # runs on the executor
+        def _respond_later(self, conn, received):
+            try:
+                conn.failed = not self._respond(conn, received)
+            finally:
+                self._done.append(conn)
+                try:
+                    self._wakeup_writer.send(b'\0')
+                except OSError:
+                    # closed in the meantime
+                    pass
+
+        def _take_back_done(self):
+            try:
+                while self._wakeup_reader.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+            handled = 0
+            while self._done:
+                conn = self._done.popleft()
+                conn.busy = False
+                if conn not in self._connections:
+                    continue
+                if conn.failed:
+                    self._close_connection(conn)
+                    continue
+                # what arrived in the meantime is either in the buffer already, or still on the socket,
+                # where the selector sees it
+                handled = handled + self._serve(conn)
+                if not conn.busy and conn in self._connections:
+                    self._watch(conn)
+            return handled
+
+        def _close_connection(self, conn):
+            self._connections.discard(conn)
+            if conn.events != None:
+                self.selector.unregister(conn.sock)
+                conn.events = None
+            try:
+                conn.server.close()
+            except OSError:
+                pass
+            conn.sock.close()
+
+        def close(self):
+            for conn in list(self._connections):
+                self._close_connection(conn)
+            for sock in self._listeners:
+                if self.selector != None:
+                    self.selector.unregister(sock)
+                sock.close()
+            self._listeners = []
+            # unix sockets are removed by the process which served them, and not by a copy closed after forking
+            if self.selector != None:
+                for path in self._paths:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                self.selector.close()
+                self.selector = None
+                self._wakeup_reader.close()
+                self._wakeup_writer.close()
+            self._paths = []
+
 class Wrap:
     def delegate(self,method,*args):
         node = None
         try:
-            local_id = str(self)
-            node = node_for_object[local_id]
+            node = node_for_object[id(self)]
         except KeyError: 
             print("no node for object?! " + str(self))
             raise
@@ -540,31 +3902,154 @@ class Wrap:
         return response
 
 
+# queues requests to a node and sends them all in one message when the "with" block exits
+# results are in .results afterward, in the order the requests were queued
+#   with c.batch() as b:
+#       b.call_function('F1.add', 1, 2)
+#       b.call_object_method(remote_obj, 'm1')
+#   print(b.results)
+class Batch:
+    def __init__(self,node):
+        self.node = node
+        self.requests = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type == None:
+            self.send()
+        return False
+
+    # on an AsyncNode, use "async with" instead
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type == None:
+            requests = self.requests
+            self.requests = []
+            self.results = await self.node.send_requests_and_receive_responses(requests)
+        return False
+
+    # each of these returns the position of the request's result in .results
+    def call_function(self,fname,*params):
+        self.requests.append(['call_function', None, fname, params])
+        return len(self.requests) - 1
+
+    def call_object_method(self,obj,method,*params):
+        self.requests.append(['call_object_method', obj, method, params])
+        return len(self.requests) - 1
+
+    def send(self):
+        requests = self.requests
+        self.requests = []
+        if len(requests):
+            self.results = self.node.send_requests_and_receive_responses(requests)
+        else:
+            self.results = []
+        return self.results
+
+# what a proxy returns for one of its methods: calling it is one 'call_object_method' request,
+# instead of fetching the bound method and then calling that
+# on an AsyncNode awaiting it fetches the attribute's value instead
+class ProxyMethod:
+    def __init__(self,proxy,name):
+        self.proxy = proxy
+        self.name = name
+
+    def __call__(self, *args):
+        return RMI.Wrap.delegate(self.proxy,self.name,*args)
+
+    def __await__(self):
+        node = node_for_object[id(self.proxy)]
+        return node.send_request_and_receive_response('call_function', None, 'getattr', [self.proxy,self.name]).__await__()
+
+    def __repr__(self):
+        return '<RMI.ProxyMethod ' + self.name + ' of ' + repr(self.proxy) + '>'
+
+# iterates over a remote iterable, with one request per chunk of items instead of one per item:
+#   for row in RMI.ProxyIterator(remote_rows, 1000):
+# items arrive as they would from any other call, so objects in the sequence are still proxies
+# on a ThreadedNode, each chunk is requested as the one before it is handed out, while a plain Node, which
+# waits for one response at a time, requests each chunk when the one before it is used up
+class ProxyIterator:
+    def __init__(self,proxy,chunk_size = None):
+        self.node = node_for_object[id(proxy)]
+        self.chunk_size = chunk_size if chunk_size != None else self.node.iter_chunk_size
+        self._items = collections.deque()
+        self._error = None
+        self._pending = self._fetch(proxy)
+
+    def _fetch(self,it):
+        return self.node._read_ahead(self.node.send_request_and_receive_response, 'call_function', None, 'RMI.Node._iter_chunk', [it, self.chunk_size])
+
+    def _take(self,chunk):
+        self._pending = None
+        status = chunk[0]
+        self._items.extend(chunk[2:])
+        if status == 0:
+            self._pending = self._fetch(chunk[1])
+        elif status != 1:
+            self._error = status
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._items:
+            if self._pending == None:
+                if self._error != None:
+                    raise(Exception(self._error))
+                raise StopIteration
+            self._take(self._pending())
+        return self._items.popleft()
+
+# the same for "async for" on an AsyncNode, where the next chunk is always fetched ahead
+class AsyncProxyIterator(ProxyIterator):
+    def _fetch(self,it):
+        return asyncio.ensure_future(self.node.send_request_and_receive_response('call_function', None, 'RMI.Node._iter_chunk', [it, self.chunk_size]))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            if self._pending == None:
+                if self._error != None:
+                    raise(Exception(self._error))
+                raise StopAsyncIteration
+            self._take(await self._pending)
+        return self._items.popleft()
+
 class ProxyMeta:
     def __init__(self):
         pass
 
 class ProxyObject:
     __metaclass__ = RMI.ProxyMeta
+
+    # options for calls to particular functions and methods, by class or module name and then method name:
+    #   RMI.ProxyObject.DEFAULT_OPTS['F1']['getarray'] = {'copy_results': True}
+    # copy_results returns a copy of the result instead of a proxy, and copy_params sends copies of the params
+    DEFAULT_OPTS = collections.defaultdict(dict)
     
     def __init__(self,node,remote_id):
         pass
 
     # Basically every method call will attempt to find the method
-    # reference in the object's symbol table.  We return a wrapper
-    # on demand, which ends up being called.
-    # This means we never really go through the "call_object_method" interface
-    # except to go to 
+    # reference in the object's symbol table.  For methods we return a ProxyMethod
+    # on demand, which ends up being called through the "call_object_method" interface.
+    # Other attributes are fetched from the remote side.
     def __getattr__(self,attr):
         node = None
         try:
-            local_id = str(self)
-            node = node_for_object[local_id]
+            node = node_for_object[id(self)]
         except KeyError: 
             print("no node for object?! " + str(self))
             raise
-        response = node.send_request_and_receive_response('call_function', None, 'getattr', [self,attr]);
-        return response
+        return node._proxy_attribute(self,attr)
 
     # Some methods which implement standard language functionality are "special", and won't be
     # seen by __getattr__ above.  We need to catch these calls and delegate them across the connection.
@@ -574,11 +4059,25 @@ class ProxyObject:
         #delegate = self.__getattr__('__call__');
         #return delegate(*args,**kwargs)
     
-    def __len__(self,*args,**kwargs):
-        return RMI.Wrap.delegate(self,'__len__',*args)
+    # list() and friends ask for the length of anything iterable first, and need
+    # a TypeError to carry on for remote iterators, as they do for local ones
+    def __len__(self):
+        node = None
+        try:
+            node = node_for_object[id(self)]
+        except KeyError: 
+            print("no node for object?! " + str(self))
+            raise
+        return node._proxy_len(self)
 
     def __getitem__(self,*args):
         return RMI.Wrap.delegate(self,'__getitem__',*args)
+
+    def __iter__(self):
+        return node_for_object[id(self)]._proxy_iterator(self)
+
+    def __aiter__(self):
+        return RMI.AsyncProxyIterator(self)
     
     def can():
         raise(Exception(__LINE__))
@@ -0,0 +1,2 @@
+#!/usr/bin/env bash
+PYTHONPATH=./lib:$PYTHONPATH bench/bench.py "$@"
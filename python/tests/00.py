@@ -1,7 +1,21 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import platform
 import posix
+import asyncio
+import time
+import signal
+import importlib
+import tempfile
+import shutil
+import io
+import collections
+import socket
+import struct
+import threading
+import concurrent.futures
 import RMI
 import F1
 import F2
@@ -60,6 +74,28 @@ def addo(a,b):
 def getarray():
     return([111,222,333]);
 
+class SameStr:
+    def __str__(self):
+        return("same")
+
+class Slow:
+    def __init__(self):
+        self.calls = 0
+
+    def m1(self):
+        self.calls = self.calls + 1
+        time.sleep(0.1)
+        return 1
+
+def call_n(o, n):
+    return sum(o.m1() for i in range(n))
+
+# whether the request still finds its own node after sleeping, while others come and go
+def same_node_after(seconds):
+    node = RMI.executing_nodes[-1]
+    time.sleep(seconds)
+    return RMI.executing_nodes[-1] is node
+
 # make a pair of forked pipes
 c = RMI.Client.ForkedPipes()
 ok(c, "got forked pipe client");
@@ -128,9 +164,661 @@ imp = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval
 print('imp: ' + str(imp))
 '''
 
-# Somehow, closing the connection doesn't cause the server to catch the close, so we have a hack to
-# signal to it that it should exit.  Fix me.
-c.close
-c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['"exitnow"']);
+note("test objects are identified by handle, not by stringification")
+same1 = SameStr()
+same2 = SameStr()
+echo1 = c.send_request_and_receive_response('call_function', None, 'F1.echo', [same1]);
+echo2 = c.send_request_and_receive_response('call_function', None, 'F1.echo', [same2]);
+ok(echo1 is same1 and echo2 is same2, 'objects with the same stringification are kept apart')
+is_ok(c._id_to_class(RMI.remote_id_for_object[id(remote5)]), 'F1.C1', 'the class of a remote object is known from its handle')
+
+note("test releasing remote objects when their proxies are garbage collected")
+remote8 = c.send_request_and_receive_response('call_function', None, 'F1.C1', []);
+ok(c._remote_has_sent(remote8), 'the remote side holds the object behind a live proxy')
+remote8_id = RMI.remote_id_for_object[id(remote8)]
+remote8 = None
+ok(not c.send_request_and_receive_response('call_function', None, 'RMI.Node._has_sent', [remote8_id]), 'the remote side drops the object once the proxy is gone')
+held1 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['len(RMI.executing_nodes[-1]._sent_objects)']);
+for n in range(100):
+    c.send_request_and_receive_response('call_function', None, 'F1.C1', []).m1()
+c.flush_releases()
+held2 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['len(RMI.executing_nodes[-1]._sent_objects)']);
+is_ok(held2, held1, 'the remote side holds nothing more after many short-lived proxies')
+
+note("test method calls on proxies")
+remote9 = c.send_request_and_receive_response('call_function', None, 'F1.C1', []);
+ok(isinstance(remote9.m1, RMI.ProxyMethod), 'methods of a remote object of a known class come back as local stubs')
+is_ok(remote9.m1(), "456", 'remote method call through a stub works')
+is_ok(remote9.a1, "123", 'remote plain attribute access still returns the value')
+
+note("test the resolved callable cache")
+misses1 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['RMI.resolved_callables.misses']);
+sum3 = c.send_request_and_receive_response('call_function', None, 'F1.add', [1,2]);
+sum3 = c.send_request_and_receive_response('call_function', None, 'F1.add', [3,4]);
+is_ok(sum3,7,'repeated remote function call works')
+misses2 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['RMI.resolved_callables.misses']);
+is_ok(misses2,misses1,'repeated remote function calls are resolved from the cache')
+resolver = RMI.ResolvedCallableCache(size = 2)
+with concurrent.futures.ThreadPoolExecutor(4) as pool:
+    resolved = list(pool.map(lambda n: resolver.resolve(['F1.add', 'F1.echo', 'F1.cat'][n % 3]), range(3000)))
+is_ok(len(resolved), 3000, 'a cache shared by threads which evict from it keeps resolving')
+package_dir = tempfile.mkdtemp()
+os.mkdir(os.path.join(package_dir, 'rmi_test_package'))
+open(os.path.join(package_dir, 'rmi_test_package', '__init__.py'), 'w').close()
+def write_submodule(value):
+    with open(os.path.join(package_dir, 'rmi_test_package', 'sub.py'), 'w') as f:
+        f.write('def f():\n    return ' + repr(value) + '\n')
+sys.dont_write_bytecode = True
+sys.path.insert(0, package_dir)
+write_submodule(1)
+import rmi_test_package.sub
+is_ok(resolver.resolve('rmi_test_package.sub.f')(), 1, 'a function in a submodule is resolved')
+write_submodule(22)
+importlib.reload(rmi_test_package.sub)
+is_ok(resolver.resolve('rmi_test_package.sub.f')(), 22, 'a function from a reloaded submodule is resolved again')
+sys.path.remove(package_dir)
+sys.dont_write_bytecode = False
+shutil.rmtree(package_dir)
+
+note("test sending a batch of requests in one message")
+remote7 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['lambda o: o.m1()']);
+with c.batch() as b:
+    b.call_function('F1.add', 1, 2)
+    b.call_function('F1.add', 1, 'a')
+    b.call_object_method(remote7, '__call__', local1)
+    b.call_function('F1.echo', local1)
+is_ok(len(b.results),4,'got one result per batched request')
+is_ok(b.results[0],3,'batched remote function call works')
+ok(isinstance(b.results[1],RMI.Exception),'batched remote function call which fails returns an exception in its place')
+is_ok(b.results[2],"456",'batched call with a counter-request back to the client works')
+is_ok(b.results[3],local1,'batched remote function call with object echo works')
+
+note("test passing results and params by value")
+rows = c.send_request_and_receive_response('call_function', None, '__main__.getarray', [], {'copy_results': True});
+ok(isinstance(rows, list), 'a result requested by copy arrives as a plain list')
+is_ok(rows, [111,222,333], 'the copied list has the remote values')
+RMI.ProxyObject.DEFAULT_OPTS['__main__']['getarray'] = {'copy_results': True}
+rows = c.send_request_and_receive_response('call_function', None, '__main__.getarray', []);
+ok(isinstance(rows, list), 'functions registered in DEFAULT_OPTS return copies')
+del RMI.ProxyObject.DEFAULT_OPTS['__main__']
+nested = c.send_request_and_receive_response('call_function', None, 'F1.echo', [{'a': (1,[2,b'3']), 'o': local1}], {'copy_results': True, 'copy_params': True});
+is_ok(nested['a'], (1,[2,b'3']), 'nested containers and bytes are copied both ways')
+is_ok(nested['o'], local1, 'objects inside a copy are still passed as proxies')
+remote10 = c.send_request_and_receive_response('call_function', None, 'F1.C1', [], {'copy_results': True});
+ok(isinstance(remote10, F1.C1) and remote10.a1 == "123", 'an object requested by copy is rebuilt locally')
+import decimal
+is_ok(c.send_request_and_receive_response('call_function', None, 'decimal.Decimal', ['1.25'], {'copy_results': True}), decimal.Decimal('1.25'), 'an object without attributes of its own, such as a Decimal, is copied')
+slotted = c.send_request_and_receive_response('call_function', None, 'F1.Slotted', [1, [2]], {'copy_results': True})
+ok(isinstance(slotted, F1.Slotted) and slotted.a == 1 and slotted.b() == [2], 'an object with __slots__ is copied')
+Point = collections.namedtuple('Point', ['x', 'y'])
+is_ok(type(c.send_request_and_receive_response('call_function', None, 'F1.echo', [Point(1, 2)], {'copy_results': True, 'copy_params': True})), tuple, 'a namedtuple is copied as a tuple')
+c.copy_types.add(decimal.Decimal)
+is_ok(c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['lambda d: type(d).__name__'])(decimal.Decimal('2')), 'Decimal', 'a type in copy_types without a __dict__ is copied')
+c.copy_types.discard(decimal.Decimal)
+try:
+    c.send_request_and_receive_response('call_function', None, 'F1.echo', [RMI.Copy(threading.Lock())])
+    ok(0, 'an object which cannot be rebuilt is not copied')
+except RMI.Exception:
+    ok(1, 'an object which cannot be rebuilt is not copied')
+import wsgiref.headers
+remote_headers = c.send_request_and_receive_response('call_function', None, 'F1.echo', [wsgiref.headers.Headers([('a', 'b')])], {'copy_params': True});
+is_ok(remote_headers.get('a'), 'b', 'an object of a class in a submodule the other side has not imported is rebuilt there')
+remote_headers = None
+is_local = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['lambda o: isinstance(o, __import__("F1").C1)']);
+c.copy_types.add(F1.C1)
+ok(is_local(local1), 'objects of a type in copy_types are sent by value')
+c.copy_types.discard(F1.C1)
+ok(not is_local(local1), 'objects of other types are sent as proxies')
+
+note("test per-call metrics and tracing")
+ok(c.metrics is None, 'metrics are off by default')
+traced = []
+c.metrics = RMI.Metrics(trace = traced.append)
+c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['setattr(RMI.executing_nodes[-1], "metrics", RMI.Metrics())']);
+remote17 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['lambda f: f()']);
+is_ok(remote17(lambda: c.send_request_and_receive_response('call_function', None, 'F1.add', [1,2])), 3, 'a call with a nested callback works with metrics on')
+snapshot1 = c.metrics.snapshot()
+is_ok(snapshot1['counters']['calls'], 4, 'each request made is counted')
+ok(snapshot1['counters']['bytes_sent'] > 0 and snapshot1['counters']['bytes_received'] > 0, 'message sizes are counted')
+ok(all(name in snapshot1['histograms'] for name in ['call','encode','write','wait','read','decode','execute']), 'each step of a call is timed')
+is_ok(snapshot1['histograms']['call']['count'], 4, 'call latencies are recorded')
+is_ok([t['method'] for t in traced if t['event'] == 'call'], ['RMI.Node._eval','RMI.Node._eval','F1.add','__call__'], 'each call is traced, innermost first')
+remote_snapshot = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['RMI.executing_nodes[-1].metrics.snapshot()'], {'copy_results': True});
+is_ok(remote_snapshot['histograms']['depth']['max'], 2, 'the depth of nested callbacks is recorded on the remote side')
+c.metrics = None
+
+note("test iterating over remote sequences and iterators in chunks")
+remote11 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['list(range(1000))']);
+is_ok(list(remote11), list(range(1000)), 'iterating over a remote list gets every item')
+is_ok(list(RMI.ProxyIterator(remote11, 7))[-3:], [997,998,999], 'iterating with a small chunk size gets every item')
+remote12 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['(__import__("F1").C1() for n in range(3))']);
+items12 = list(remote12)
+ok(len(items12) == 3 and items12[0].m1() == "456", 'objects from a remote generator arrive as proxies')
+is_ok(list(remote12), [], 'a remote generator is exhausted after iterating over it')
+is_ok(len(remote11), 1000, 'the length of a remote list is its length')
+remote12 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['(n for n in range(3))'])
+c.metrics = RMI.Metrics()
+is_ok(list(remote12), [0,1,2], 'iterating over another remote generator gets every item')
+queries12 = c.metrics.snapshot()['counters']['messages_sent.query']
+remote12 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['(n for n in range(3))'])
+c.metrics = RMI.Metrics()
+list(RMI.ProxyIterator(remote12))
+is_ok(queries12, c.metrics.snapshot()['counters']['messages_sent.query'], 'a remote class without a length is not asked for one again')
+c.metrics = None
+remote13 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['(10 // n for n in [5,2,0,1])']);
+got13 = []
+try:
+    for n in remote13:
+        got13.append(n)
+    ok(0, 'an error in a remote generator is raised after the items before it')
+except RMI.Exception:
+    is_ok(got13, [2,5], 'an error in a remote generator is raised after the items before it')
+
+note("test concurrent calls from many threads on one connection")
+tc = RMI.ThreadedClient.ForkedPipes(workers = 4)
+ok(tc, "got threaded forked pipe client")
+sleeper = tc.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['lambda t,x: (__import__("time").sleep(t), x)[1]']);
+started = time.time()
+with concurrent.futures.ThreadPoolExecutor(4) as pool:
+    slept = list(pool.map(lambda n: sleeper(0.2, n), range(4)))
+is_ok(slept, [0,1,2,3], 'concurrent calls from threads each get their own result')
+ok(time.time() - started < 0.6, 'independent requests run in parallel on the server')
+with concurrent.futures.ThreadPoolExecutor(4) as pool:
+    list(pool.map(lambda n: tc.send_request_and_receive_response('call_function', None, 'F1.echo', [F1.C1()]), range(200)))
+for n in range(30):
+    if not len(tc._sent_objects):
+        break
+    time.sleep(0.1)
+    tc.send_request_and_receive_response('call_function', None, 'F1.add', [1,1])
+is_ok(len(tc._sent_objects), 0, 'objects sent from many threads at once are all released')
+n17 = RMI.Node(None, io.BytesIO())
+with concurrent.futures.ThreadPoolExecutor(2) as pool:
+    tops = list(pool.map(lambda request_id: n17._process_query(['RMI.Node._eval', 0, None, 1, '(time.sleep(0.2), RMI.executing_nodes[-1]._executing_requests[-1])[1]'], request_id).message_data, [1,2]))
+is_ok(tops, [1,2], 'requests processed at once on different threads each see their own request id')
+tcaller = tc.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['lambda f,x: f(x)']);
+with concurrent.futures.ThreadPoolExecutor(4) as pool:
+    tripled = list(pool.map(lambda n: tcaller(lambda x: x*3, n), range(8)))
+is_ok(tripled, [0,3,6,9,12,15,18,21], 'concurrent counter-requests are routed back to the right thread')
+tremote = tc.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['range(1000)']);
+is_ok(sum(RMI.ProxyIterator(tremote, 100)), 499500, 'iterating with read-ahead on a threaded client gets every item')
+tc.close()
+
+note("test concurrent calls from asyncio")
+
+async def double_later(x):
+    await asyncio.sleep(0.01)
+    return x*2
+
+async def async_tests():
+    ac = await RMI.AsyncClient.ForkedPipes().connect()
+    ok(ac, "got async forked pipe client")
+    sums = await asyncio.gather(*[ac.send_request_and_receive_response('call_function', None, 'F1.add', [n,1]) for n in range(20)])
+    is_ok(sums, list(range(1,21)), 'concurrent remote function calls each get their own result')
+    caller = await ac.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['lambda f,x: f(x)']);
+    doubles = await asyncio.gather(*[caller(double_later, n) for n in range(3)])
+    is_ok(doubles, [0,2,4], 'concurrent counter-requests to a local coroutine are routed back to the right caller')
+    try:
+        await ac.send_request_and_receive_response('call_function', None, 'F1.add', [1,'a'])
+        ok(0, 'remote exception is raised to the awaiting caller')
+    except RMI.Exception:
+        ok(1, 'remote exception is raised to the awaiting caller')
+    aremote = await ac.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['range(1000)']);
+    aitems = [n async for n in aremote]
+    is_ok(aitems, list(range(1000)), 'async iteration over a remote sequence gets every item')
+    try:
+        len(aremote)
+        ok(0, 'len() of an async proxy raises, pointing to an awaitable call')
+    except RMI.Exception:
+        ok(1, 'len() of an async proxy raises, pointing to an awaitable call')
+    is_ok(await ac.send_request_and_receive_response('call_function', None, 'len', [aremote]), 1000, 'the length of an async proxy is awaited through a call')
+    try:
+        iter(aremote)
+        ok(0, 'plain iteration over an async proxy raises, pointing to async for')
+    except RMI.Exception:
+        ok(1, 'plain iteration over an async proxy raises, pointing to async for')
+    ablob = bytearray(range(256)) * 4096
+    is_ok(await ac.send_request_and_receive_response('call_function', None, 'F1.echo', [ablob]), ablob, 'large buffers are passed to an async client')
+    is_ok([await ac.call_shipped_function(lambda x: x * 2, n) for n in range(2)], [0,2], 'a shipped function is called from an async client, and again by its key')
+    ac.peer_features = set()
+    abatch = await ac.send_requests_and_receive_responses([['call_function', None, 'F1.add', [1,2]], ['call_function', None, 'F1.add', [1,'a']]])
+    ok(abatch[0] == 3 and isinstance(abatch[1], RMI.Exception), 'an async batch to a peer without batches is sent one request at a time')
+    ac.peer_features = None
+    ac.close()
+    try:
+        await ac.handshake()
+        ok(0, 'a handshake on a closed async connection raises Closed')
+    except RMI.Closed:
+        ok(1, 'a handshake on a closed async connection raises Closed')
+
+asyncio.run(async_tests())
+
+note("test passing bytes, bytearrays and memoryviews by value, out of band when large")
+blob = bytes(range(256)) * 4096
+small1 = c.send_request_and_receive_response('call_function', None, 'F1.echo', [b'a\nb']);
+ok(type(small1) is bytes and small1 == b'a\nb', 'small bytes are passed by value')
+cb = RMI.Client.ForkedPipes()
+cb.metrics = RMI.Metrics()
+cb.send_request_and_receive_response('call_function', None, 'F1.echo', [blob]);
+ok(cb.metrics.snapshot()['counters']['bytes_sent'] > 2 * len(blob), 'large bytes are passed inside the message before a handshake')
+cb.handshake()
+cb.metrics = RMI.Metrics()
+big2 = cb.send_request_and_receive_response('call_function', None, 'F1.echo', [blob]);
+ok(type(big2) is bytes and big2 == blob, 'large bytes are passed out of band after a handshake and arrive intact')
+ok(cb.metrics.snapshot()['counters']['bytes_sent'] < len(blob) + 4096, 'out-of-band bytes are sent raw')
+cb.close()
+big3 = c.send_request_and_receive_response('call_function', None, 'F1.echo', [bytearray(blob)]);
+ok(type(big3) is bytearray and big3 == blob, 'large bytearrays arrive as bytearrays')
+big4 = c.send_request_and_receive_response('call_function', None, 'F1.echo', [memoryview(blob)[1:]]);
+ok(type(big4) is memoryview and big4 == blob[1:], 'large memoryviews arrive as memoryviews')
+big5 = c.send_request_and_receive_response('call_function', None, 'F1.echo', [[blob, {'k': bytearray(blob)}]], {'copy_results': True});
+ok(big5[0] == blob and big5[1]['k'] == blob, 'several large buffers inside a copy arrive intact')
+
+note("test the shared memory transport")
+if platform.machine().lower() in RMI.SharedMemoryRing.architectures:
+    c3 = RMI.Client.ForkedSharedMemory(ring_size = 4096)
+    ok(c3, "got forked shared memory client")
+    s5 = c3.send_request_and_receive_response('call_function', None, 'F1.add', [4,5]);
+    is_ok(s5,9,'remote function call with primitives works over shared memory')
+    remote14 = c3.send_request_and_receive_response('call_function', None, 'F1.echo', [local1]);
+    is_ok(remote14, local1, 'remote function call with object echo works over shared memory')
+    big1 = c3.send_request_and_receive_response('call_function', None, 'F1.add', ['x' * 100000, 'y']);
+    is_ok(len(big1), 100001, 'messages larger than the ring are streamed through it')
+    is_ok(c3.send_request_and_receive_response('call_function', None, 'F1.echo', [bytearray(blob)]), bytearray(blob), 'large buffers are read straight from the ring')
+    is_ok(list(c3.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['range(5000)']))[-1], 4999, 'many chunks of items go through the ring')
+    c3.close()
+architectures = RMI.SharedMemoryRing.architectures
+RMI.SharedMemoryRing.architectures = ()
+try:
+    RMI.SharedMemoryRing(4096)
+    ok(0, 'a shared memory ring cannot be made on an architecture which may reorder stores')
+except RMI.Exception:
+    ok(1, 'a shared memory ring cannot be made on an architecture which may reorder stores')
+RMI.SharedMemoryRing.architectures = architectures
+
+note("test the TCP client and server, and pooled connections")
+tcp_server = RMI.Server.Tcp(port = 0)
+tcp_server_pid = os.fork()
+if not tcp_server_pid:
+    tcp_server.run()
+    os._exit(0)
+tcp_server.close()
+c4 = RMI.Client.Tcp(port = tcp_server.port)
+ok(c4, "got tcp client")
+s6 = c4.send_request_and_receive_response('call_function', None, 'F1.add', [4,5]);
+is_ok(s6,9,'remote function call with primitives works over tcp')
+remote15 = c4.send_request_and_receive_response('call_function', None, 'F1.echo', [local1]);
+is_ok(remote15, local1, 'remote function call with object echo works over tcp')
+pool = RMI.ClientPool(port = tcp_server.port, size = 2)
+for n in range(5):
+    with pool.connection() as pc:
+        s7 = pc.send_request_and_receive_response('call_function', None, 'F1.add', [n,1]);
+is_ok(s7, 5, 'calls through pooled connections work')
+is_ok(pool.connects, 1, 'a pooled connection is reused by later callers')
+with pool.connection() as pc1:
+    with pool.connection() as pc2:
+        ok(pc1 is not pc2, 'concurrent callers get their own connections')
+        is_ok(pc1.send_request_and_receive_response('call_function', None, 'F1.add', [1,2]) + pc2.send_request_and_receive_response('call_function', None, 'F1.add', [3,4]), 10, 'both connections are served')
+        try:
+            pool.acquire(0.1)
+            ok(0, 'the pool does not open more connections than its size')
+        except RMI.Exception:
+            ok(1, 'the pool does not open more connections than its size')
+pc1.close()
+with pool.connection() as pc3:
+    is_ok(pc3.send_request_and_receive_response('call_function', None, 'F1.add', [1,1]), 2, 'a closed connection is replaced')
+try:
+    with pool.connection() as pc4:
+        pc4.send_request_and_receive_response('call_function', None, 'time.sleep', [0.5], timeout = 0.05)
+except RMI.Timeout:
+    pass
+with pool.connection() as pc5:
+    ok(pc5 is not pc4 and pc4.writer == None, 'a connection whose request timed out is closed instead of reused')
+class TcpWithoutIsOpen(RMI.Client.Tcp):
+    is_open = None
+opool = RMI.ClientPool(port = tcp_server.port, size = 1, check_interval = 0, client_class = TcpWithoutIsOpen)
+with opool.connection() as oc1:
+    pass
+with opool.connection() as oc2:
+    ok(oc2 is oc1, 'a client class without is_open is checked with a round trip')
+opool.close()
+pool.close()
+silent = socket.socket()
+silent.bind(('127.0.0.1', 0))
+silent.listen(8)
+spool = RMI.ClientPool(port = silent.getsockname()[1], size = 2, check_interval = 0, check_timeout = 0.3)
+(sc1, sc2) = (spool.acquire(), spool.acquire())
+spool.release(sc1)
+checked = []
+checker = threading.Thread(target = lambda: checked.append(spool.acquire()), daemon = True)
+checker.start()
+time.sleep(0.1)
+started = time.monotonic()
+spool.release(sc2)
+ok(time.monotonic() - started < 0.1, 'the pool is not locked while an idle connection is checked')
+checker.join(5)
+ok(len(checked) and checked[0] is not sc1 and checked[0] is not sc2, 'a check which gets no answer times out and the connection is replaced')
+spool.release(checked[0], True)
+spool.close()
+silent.close()
+c4.close()
+os.kill(tcp_server_pid, signal.SIGTERM)
+os.waitpid(tcp_server_pid, 0)
+
+note("test a pool of forked servers")
+fpool = RMI.ForkedPool(2)
+is_ok(len(fpool.clients), 2, "got a pool of two forked servers")
+is_ok(fpool.call_function('F1.add', 2, 3), 5, 'remote function call through the pool works')
+pids = fpool.map('RMI.Node._eval', ['__import__("os").getpid()'] * 8)
+is_ok(len(set(pids)), 2, 'calls are spread across the children')
+is_ok(fpool.map('F1.add', range(100), range(100)), [n*2 for n in range(100)], 'map returns the results in order')
+remote16 = fpool.call_function('F1.C1')
+is_ok(fpool.call_object_method(remote16, 'm1'), "456", 'method calls go to the child with the object')
+echoes = [fpool.call_function('F1.echo', remote16) for n in range(4)]
+ok(all(e is remote16 for e in echoes), 'function calls with an object from a child go to that child')
+started = time.time()
+fpool.map('time.sleep', [0.2, 0.2])
+ok(time.time() - started < 0.35, 'map runs calls in parallel across the children')
+try:
+    fpool.map('F1.add', [1, 2], [1, 'a'])
+    ok(0, 'an exception in a mapped call is raised')
+except RMI.Exception:
+    ok(1, 'an exception in a mapped call is raised')
+fpool.close()
+
+note("test shipping functions to run remotely")
+def total(items, attr = 'real'):
+    return sum(getattr(o, attr) for o in items)
+remote18 = c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['[complex(n, 1) for n in range(10000)]']);
+c.metrics = RMI.Metrics()
+is_ok(c.call_shipped_function(total, remote18), sum(range(10000)), 'a shipped function works on remote objects')
+is_ok(c.metrics.snapshot()['counters']['calls'], 1, 'a shipped function over 10000 remote objects takes one call')
+c.metrics = None
+is_ok(c.call_shipped_function(total, remote18, 'imag'), 10000, 'a shipped function takes params after the objects')
+is_ok(c.call_shipped_function('lambda items, n: [o.real for o in items[:n]]', remote18, 3)[2], 2, 'a shipped lambda from source works')
+is_ok(c.call_shipped_function('import math\ndef f(x):\n    return math.floor(x)\n', 2.5), 2, 'a shipped def from source works')
+stats18 = c.send_request_and_receive_response('call_function', None, 'RMI.shipped_functions.stats', [], {'copy_results': True})
+ok(stats18['misses'] == 3 and stats18['hits'] == 1, 'shipped functions are compiled once and then found by their hash')
+c.send_request_and_receive_response('call_function', None, 'RMI.shipped_functions.clear', [])
+is_ok(c.call_shipped_function(total, remote18, 'imag'), 10000, 'a shipped function dropped from the remote cache is shipped again')
+def below(limit):
+    return lambda x: x < limit
+try:
+    c.call_shipped_function(below(3), 1)
+    ok(0, 'a function with free variables cannot be shipped')
+except RMI.Exception:
+    ok(1, 'a function with free variables cannot be shipped')
+def scaled(x, *, by = 2):
+    return x * by
+is_ok(c.call_shipped_function(scaled, 3), 6, 'a shipped function keeps the defaults of its keyword-only params')
+
+note("test compression of large frames")
+c6 = RMI.Client.ForkedPipes(compression = 'zlib', serialization_protocol = 'b1')
+c6.metrics = RMI.Metrics()
+text6 = 'abc' * 100000
+is_ok(c6.send_request_and_receive_response('call_function', None, 'str', [text6]), text6, 'a large message goes out before a handshake')
+ok(c6.metrics.snapshot()['counters'].get('frames_compressed', 0) == 0 and c6.metrics.snapshot()['counters']['bytes_received'] > 300000, 'nothing is compressed before a handshake')
+c6.handshake()
+c6.metrics = RMI.Metrics()
+is_ok(c6.send_request_and_receive_response('call_function', None, 'str', [text6]), text6, 'a compressed request and response arrive intact')
+ok(c6.metrics.snapshot()['counters']['bytes_received'] < 100000, 'the other side compresses a large response after a handshake')
+is_ok(c6.metrics.snapshot()['counters'].get('frames_compressed', 0), 1, 'large requests are compressed once the other side has said it can read them')
+is_ok(c6.send_request_and_receive_response('call_function', None, 'F1.add', [1,2]), 3, 'small messages are not compressed')
+is_ok(c6.metrics.snapshot()['counters'].get('frames_compressed', 0), 1, 'small messages are not counted as compressed')
+c6.close()
+c7 = RMI.Client.ForkedPipes(compression = 'zlib')
+c7.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['setattr(RMI.executing_nodes[-1], "compression", None)'])
+c7.handshake()
+c7.metrics = RMI.Metrics()
+is_ok(c7.send_request_and_receive_response('call_function', None, 'str', [text6]), text6, 'a large message to a side without compression works')
+ok(c7.metrics.snapshot()['counters'].get('frames_compressed', 0) == 0 and c7.metrics.snapshot()['counters']['bytes_received'] > 300000, 'nothing is compressed unless both sides have compression')
+c7.close()
+
+note("test large messages, and messages split into frames")
+ids20 = list(range(200000))
+started = time.time()
+is_ok(c.send_request_and_receive_response('call_function', None, 'max', ids20), 199999, 'a call with 200000 params works')
+is_ok(c.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['list(range(200000))'], {'copy_results': True}), ids20, 'a copied result with 200000 items works')
+ok(time.time() - started < 10, 'large messages are encoded and decoded in linear time')
+c9 = RMI.Client.ForkedPipes(serialization_protocol = 'b1')
+c9.max_frame_size = 4096
+frames20 = list(c9._serialize(RMI.Message('query', ['max', 0, None, 10000] + ids20[:10000])))
+ok(len(frames20) > 10 and max(len(f) for f in frames20) < 8192, 'a large message is split into bounded frames')
+c9.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['setattr(RMI.executing_nodes[-1], "max_frame_size", 4096)'])
+is_ok(c9.send_request_and_receive_response('call_function', None, 'max', ids20), 199999, 'a call split into frames works')
+is_ok(c9.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['list(range(200000))'], {'copy_results': True}), ids20, 'a result split into frames works')
+is_ok(c9.send_request_and_receive_response('call_function', None, 'F1.add', [1,2]), 3, 'a small message after frames works')
+c9.close()
+
+note("test the handshake")
+c10 = RMI.Client.ForkedPipes(compression = 'zlib')
+answer10 = c10.handshake()
+is_ok(answer10['serializer'], 'b1', 'the handshake picks the fastest serializer both sides have')
+is_ok((c10.serialization_protocol, c10.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['RMI.executing_nodes[-1].serialization_protocol'])), ('b1', 'b1'), 'both sides switch to it')
+is_ok(sorted(c10.peer_features), ['batch', 'compression', 'frames', 'out_of_band'], 'the handshake finds the features both sides have')
+c10.metrics = RMI.Metrics()
+is_ok(c10.send_request_and_receive_response('call_function', None, 'str', [text6]), text6, 'a call after the handshake works')
+is_ok(c10.metrics.snapshot()['counters'].get('frames_compressed', 0), 1, 'compression starts with the first message after the handshake')
+c10.close()
+c11 = RMI.Client.ForkedPipes()
+c11.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['delattr(RMI.Node, "_handshake")'])
+is_ok(c11.handshake(), None, 'a peer without the handshake gives no answer')
+ok(c11.serialization_protocol == 's0' and c11.peer_features == set() and not c11._peer_out_of_band, 'with a peer without the handshake the node keeps its serializer and drops optional features')
+c11.metrics = RMI.Metrics()
+is_ok(c11.send_requests_and_receive_responses([['call_function', None, 'F1.add', [1,2]], ['call_function', None, 'F1.add', [3,4]]]), [3,7], 'a batch to a peer without batches is sent one request at a time')
+is_ok(c11.metrics.snapshot()['counters']['messages_sent.query'], 2, 'each request of the batch goes as its own query')
+c11.close()
+try:
+    c11.handshake()
+    ok(0, 'a handshake on a closed connection raises Closed')
+except RMI.Closed:
+    ok(1, 'a handshake on a closed connection raises Closed')
+
+note("test a fork server")
+fs = RMI.ForkServer(preload = ['wave'], resolve = ['F2.x2'])
+c5 = RMI.Client.ForkedPipes(fork_server = fs)
+is_ok(c5.send_request_and_receive_response('call_function', None, 'F1.add', [2,3]), 5, 'remote function call through a server from the fork server works')
+ok('wave' not in sys.modules and c5.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['"wave" in sys.modules']), 'servers from the fork server start with the preloaded modules')
+ok(c5.send_request_and_receive_response('call_function', None, 'RMI.Node._eval', ['"F2.x2" in RMI.resolved_callables._entries']), 'servers from the fork server start with the resolved functions cached')
+fpool2 = RMI.ForkedPool(2, fork_server = fs)
+is_ok(fpool2.map('F1.add', [1,2], [3,4]), [4,6], 'a pool of servers from the fork server works')
+is_ok(fs.forks, 3, 'the fork server forked each server')
+fpool2.close()
+c5.close()
+fs.close()
+try:
+    RMI.ForkServer(preload = ['no_such_module'])
+    ok(0, 'a fork server which cannot preload raises an exception')
+except RMI.Exception:
+    ok(1, 'a fork server which cannot preload raises an exception')
+
+note("test the binary serialization protocol")
+c2 = RMI.Client.ForkedPipes(serialization_protocol = 'b1')
+ok(c2, "got forked pipe client with binary serialization")
+s2 = c2.send_request_and_receive_response('call_function', None, 'F1.add', [4,5]);
+is_ok(s2,9,'remote function call with primitives works over b1')
+s3 = c2.send_request_and_receive_response('call_function', None, 'F1.add', ["a\nb","\u00e9"]);
+is_ok(s3,"a\nb\u00e9",'strings with newlines and non-ascii characters survive b1')
+s4 = c2.send_request_and_receive_response('call_function', None, 'F1.add', [2**70,1.5]);
+is_ok(s4,2**70+1.5,'big integers and floats survive b1')
+remote6 = c2.send_request_and_receive_response('call_function', None, 'F1.echo', [local1]);
+is_ok(remote6, local1, 'remote function call with object echo works over b1')
+rows2 = c2.send_request_and_receive_response('call_function', None, 'F1.echo', [[1,b'\x00\xff']], {'copy_results': True, 'copy_params': True});
+is_ok(rows2, [1,b'\x00\xff'], 'copies with bytes survive b1')
+is_ok(c2.send_request_and_receive_response('call_function', None, 'F1.echo', [blob]), blob, 'large bytes survive b1')
+c2.close()
+
+note("test the text protocols without eval")
+s0 = RMI.serializers['s0']
+values19 = ['a\nb', "it's", 'q"q', '\\', '$x@y', '\u00e9\u263a\U0001f600', '\x00\x1b', b'\x00\xff', None, True, False, -5, 2**70, -2.5e-10, float('inf'), '']
+is_ok(s0.deserialize(s0.serialize('query', [1,2], values19)), ('query', [1,2], values19), 'the s0 parser reads back what pprint writes')
+is_ok(s0.parse('["result",[],0,"a\\$b\\n\\x{263a}\\101",undef,-12,"1.5"]'), ['result', [], 0, 'a$b\n\u263aA', None, -12, '1.5'], 'the s0 parser reads what Perl Data::Dumper writes')
+try:
+    s0.parse('[__import__("os").getpid()]')
+    ok(0, 'the s0 parser runs nothing it is sent')
+except RMI.Exception:
+    ok(1, 'the s0 parser runs nothing it is sent')
+s1 = RMI.serializers['s1']
+is_ok(s1.deserialize(s1.serialize('query', [1,2], values19)), ('query', [1,2], values19), 'the s1 serializer reads back what it writes')
+is_ok(s1.deserialize(b'\x01["s1","perl5e1","perl5r1","query",2,5,6,"F1::add",undef,"\\x{e9}\\@"]\n'), ('query', [5,6], ['F1::add', None, '\u00e9@']), 'the s1 serializer reads what Perl RMI::Serializer::S1 writes')
+c8 = RMI.Client.ForkedPipes(serialization_protocol = 's1')
+is_ok(c8.send_request_and_receive_response('call_function', None, 'F1.add', ["a\n$b",'\u00e9']), 'a\n$b\u00e9', 'remote function call works over s1')
+remote19 = c8.send_request_and_receive_response('call_function', None, 'F1.echo', [local1]);
+is_ok(remote19, local1, 'remote function call with object echo works over s1')
+c8.close()
+
+note("test the multiplexed server")
+mserver = RMI.Server.Multiplexed(executor = concurrent.futures.ThreadPoolExecutor(8))
+mport = mserver.listen_tcp(port = 0)[1]
+mpath = '/tmp/rmi-test-' + str(os.getpid()) + '.sock'
+mserver.listen_unix(mpath)
+mserver_pid = os.fork()
+if not mserver_pid:
+    mserver.run()
+    os._exit(0)
+mserver.close()
+c11 = RMI.Client.Tcp(port = mport)
+is_ok(c11.send_request_and_receive_response('call_function', None, 'F1.add', [4,5]), 9, 'remote function call works through the multiplexed server over tcp')
+c12 = RMI.Client.Unix(mpath, serialization_protocol = 'b1')
+is_ok(c12.send_request_and_receive_response('call_function', None, 'F1.add', [4,5]), 9, 'remote function call works through the multiplexed server over a unix socket')
+is_ok(c12.send_request_and_receive_response('call_function', None, 'getattr', [F1.C1(), 'a1']), '123', 'a request can call back to its client')
+is_ok(c12.send_request_and_receive_response('call_function', None, 'bytes', [blob]), blob, 'out-of-band buffers arrive through the multiplexed server')
+frame11 = RMI.Node(None, None)._serialize(RMI.Message('query', ['F1.add',0,None,2,1,1]))[0]
+stalled = socket.create_connection(('127.0.0.1', mport))
+stalled.sendall(frame11[:10])
+is_ok(c11.send_request_and_receive_response('call_function', None, 'F1.add', [1,1]), 2, 'a client which has sent part of a message holds up no one else')
+stalled.sendall(frame11[10:])
+is_ok(stalled.makefile('rb').readline(), b"['result', [], 0, 2]\n", 'the rest of the message is processed once it arrives')
+stalled.close()
+mserver2 = RMI.Server.Multiplexed(serialization_protocol = 'b1')
+mport2 = mserver2.listen_tcp(port = 0)[1]
+mserver2_pid = os.fork()
+if not mserver2_pid:
+    mserver2.run()
+    os._exit(0)
+mserver2.close()
+stalled = socket.create_connection(('127.0.0.1', mport2))
+stalled.sendall(RMI.Node(None, None)._serialize(RMI.Message('query', ['RMI.Node._eval',0,None,1,'"x" * 64000000']))[0])
+time.sleep(0.2)
+c15 = RMI.Client.Tcp(port = mport2)
+is_ok(c15.send_request_and_receive_response('call_function', None, 'F1.add', [1,1], timeout = 2), 2, 'a client which does not read its large response holds up no one else')
+stalled_reader = stalled.makefile('rb')
+(stalled_length,) = struct.unpack('>I', stalled_reader.read(5)[1:])
+ok(stalled_length > 64000000 and len(stalled_reader.read(stalled_length)) == stalled_length, 'the large response is sent once the client reads it')
+stalled.close()
+c15.close()
+os.kill(mserver2_pid, signal.SIGTERM)
+os.waitpid(mserver2_pid, 0)
+sleeper = threading.Thread(target = lambda: c12.send_request_and_receive_response('call_function', None, 'time.sleep', [0.5]))
+sleeper.start()
+time.sleep(0.1)
+started = time.time()
+c11.send_request_and_receive_response('call_function', None, 'F1.add', [1,1])
+ok(time.time() - started < 0.3, 'a request which blocks on the executor holds up no one else')
+sleeper.join()
+same_nodes = []
+sleeper = threading.Thread(target = lambda: same_nodes.append(c12.send_request_and_receive_response('call_function', None, '__main__.same_node_after', [0.3])))
+sleeper.start()
+time.sleep(0.05)
+same_nodes.append(c11.send_request_and_receive_response('call_function', None, '__main__.same_node_after', [0.5]))
+sleeper.join()
+is_ok(same_nodes, [True, True], 'requests running at once on the executor each find their own node')
+mclients = [RMI.Client.Tcp(port = mport) for n in range(100)]
+is_ok(sum(mc.send_request_and_receive_response('call_function', None, 'F1.add', [n,1]) for (n, mc) in enumerate(mclients)), 5050, 'many connections are served at once')
+for mc in mclients:
+    mc.close()
+c11.close()
+c12.close()
+os.kill(mserver_pid, signal.SIGTERM)
+os.waitpid(mserver_pid, 0)
+os.unlink(mpath)
+
+note("test deadlines, cancellation and closed connections")
+c13 = RMI.Client.ForkedPipes()
+started = time.time()
+try:
+    c13.send_request_and_receive_response('call_function', None, 'time.sleep', [1], timeout = 0.2)
+    ok(0, 'a call which takes too long times out')
+except RMI.Timeout:
+    ok(time.time() - started < 0.5, 'a call which takes too long times out')
+is_ok(c13.send_request_and_receive_response('call_function', None, 'F1.add', [1,2]), 3, 'the late response is dropped, and the next call gets its own')
+slow = Slow()
+try:
+    c13.send_request_and_receive_response('call_function', None, '__main__.call_n', [slow, 20], timeout = 0.35)
+    ok(0, 'the deadline counts the calls the other side makes back')
+except RMI.Timeout:
+    ok(1, 'the deadline counts the calls the other side makes back')
+is_ok(c13.send_request_and_receive_response('call_function', None, 'F1.add', [1,2]), 3, 'a call after a cancelled one works')
+time.sleep(0.3)
+ok(slow.calls < 10, 'the other side stops a cancelled request at its next call back')
+c13.call_timeout = 0.2
+try:
+    c13.send_request_and_receive_response('call_function', None, 'time.sleep', [1])
+    ok(0, 'a node has a default timeout for its calls')
+except RMI.Timeout:
+    ok(1, 'a node has a default timeout for its calls')
+c13.call_timeout = None
+try:
+    c13.send_request_and_receive_response('call_function', None, 'os._exit', [0])
+    ok(0, 'a call to a side which goes away raises RMI.Closed')
+except RMI.Closed:
+    ok(1, 'a call to a side which goes away raises RMI.Closed')
+try:
+    c13.send_request_and_receive_response('call_function', None, 'F1.add', [1,2])
+    ok(0, 'a call on a closed connection raises RMI.Closed')
+except RMI.Closed:
+    ok(1, 'a call on a closed connection raises RMI.Closed')
+c13.close()
+tc2 = RMI.ThreadedClient.ForkedPipes(workers = 1)
+try:
+    tc2.send_request_and_receive_response('call_function', None, 'time.sleep', [0.5], timeout = 0.1)
+    ok(0, 'a call on a threaded client times out')
+except RMI.Timeout:
+    ok(1, 'a call on a threaded client times out')
+is_ok(tc2.send_request_and_receive_response('call_function', None, 'F1.add', [1,2]), 3, 'a threaded client drops the late response')
+tc2.close()
+async def async_timeout():
+    (s1, s2) = socket.socketpair()
+    (r1, w1) = await asyncio.open_connection(sock = s1)
+    (r2, w2) = await asyncio.open_connection(sock = s2)
+    a1 = RMI.AsyncNode(r1, w1).start()
+    a2 = RMI.AsyncNode(r2, w2).start()
+    try:
+        await a1.send_request_and_receive_response('call_function', None, 'asyncio.sleep', [5], timeout = 0.1)
+        ok(0, 'a call on an async node times out')
+    except RMI.Timeout:
+        ok(1, 'a call on an async node times out')
+    await asyncio.sleep(0.1)
+    is_ok(len(a2._handlers), 0, 'the other side cancels the task handling the request')
+    is_ok(await a1.send_request_and_receive_response('call_function', None, 'F1.add', [1,2]), 3, 'an async node works after a call times out')
+    a1.close()
+    a2.close()
+asyncio.run(async_timeout())
+
+note("test object table stats")
+c14 = RMI.Client.ForkedPipes()
+is_ok(c14.object_stats()['proxies'], 0, 'a new node has no proxies')
+remote20 = [c14.send_request_and_receive_response('call_function', None, 'F1.C1') for n in range(3)]
+stats20 = c14.object_stats()
+is_ok(stats20['proxies_by_class'], {'F1.C1': 3}, 'live proxies are counted by remote class')
+is_ok(stats20['growth']['proxies'], 3, 'the growth since the last stats is reported')
+is_ok(RMI.object_stats()['node_for_object'], len(RMI.node_for_object), 'the tables all nodes share are counted')
+remote_stats20 = c14.remote_object_stats()
+is_ok(remote_stats20['node']['sent_by_class'], {'F1.C1': 3}, 'the other side counts the objects it has sent by class')
+ok(remote_stats20['node']['sent_bytes'] > 0, 'the other side reports roughly how much memory its sent objects hold')
+ok('resolved_callables' in remote_stats20['process'], 'the other side reports the tables of its process')
+remote20 = None
+c14.flush_releases()
+is_ok(c14.remote_object_stats()['node']['growth'].get('sent_objects'), -3, 'released objects show up as negative growth')
+is_ok(c14.object_stats()['remote_classes'], 0, 'the classes of released proxies are forgotten')
+c14.close()
+
+note("test that a server exits when its client closes")
+c.close()
+for n in range(50):
+    (pid, status) = os.waitpid(c.server_pid, os.WNOHANG)
+    if pid:
+        break
+    time.sleep(0.1)
+is_ok(pid, c.server_pid, 'the server exits when the client closes the connection')
 print("CLIENT DONE")
    
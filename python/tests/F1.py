@@ -27,3 +27,13 @@ class C1:
         except:
             return object.__getattribute__(self,'a1')
 
+
+class Slotted:
+    __slots__ = ('a', '__b')
+
+    def __init__(self, a, b):
+        self.a = a
+        self.__b = b
+
+    def b(self):
+        return self.__b